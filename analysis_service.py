@@ -1,75 +1,186 @@
+import os
+import threading
+import time
 from datetime import datetime, timedelta
-from collections import defaultdict
-import pandas as pd
-import numpy as np
-from sklearn.linear_model import LinearRegression
+
+# pandas, NumPy and scikit-learn take seconds to import, so they are imported inside the
+# functions that use them: the app starts serving without them and the first analysis
+# pays the cost. Set ANALYSIS_PREWARM=1 to import them in a background thread at startup.
+
+_prewarm_pid = None
+_prewarm_lock = threading.Lock()
+
+def prewarm():
+    """Import the analysis libraries now. Returns the time taken in seconds."""
+    started = time.perf_counter()
+    import pandas
+    import numpy
+    import sklearn.linear_model
+    return time.perf_counter() - started
+
+def _prewarm_in_background():
+    try:
+        print(f"Analysis libraries loaded in {prewarm() * 1000:.0f} ms")
+    except Exception as e:
+        print(f"Warning: analysis pre-warm failed ({e})")
+
+def start_prewarm():
+    """
+    Import the analysis libraries in a daemon thread, once per process, if ANALYSIS_PREWARM is set.
+    Call it after fork (worker startup), not in a process that will fork afterwards.
+    """
+    global _prewarm_pid
+    # Read at call time: app.py loads .env after this module is imported
+    if os.getenv("ANALYSIS_PREWARM", "0") != "1":
+        return
+    with _prewarm_lock:
+        if _prewarm_pid == os.getpid():
+            return
+        _prewarm_pid = os.getpid()
+    threading.Thread(target=_prewarm_in_background, name="analysis-prewarm", daemon=True).start()
 
 def get_local_time():
     """Get current local time (UTC+7 for Thailand timezone)"""
     return datetime.now() + timedelta(hours=7)
 
-def analyze_expenses(expenses, uid=None):
+# day value for a missing or unparseable date (NaT's integer value)
+NO_DAY = -2 ** 63
+
+class ExpenseFrame:
+    """
+    A user's expenses as typed columns, built once per request and passed to each
+    analysis function in place of the expense list, so dates and amounts are parsed once.
+    frame has one row per expense: category (categorical), day (int64 days since
+    1970-01-01, NO_DAY if the date is missing or invalid) and amount (float64, NaN if
+    invalid). spending holds the rows with a valid date and a negative amount, with
+    positive amounts and a datetime64 date column.
+    """
+
+    def __init__(self, expenses):
+        import pandas as pd
+        import numpy as np
+
+        # Dates are parsed strictly as YYYY-MM-DD, the format the app stores
+        dates = pd.to_datetime(pd.Series([e.get("date") for e in expenses], dtype=object), format="%Y-%m-%d", errors="coerce")
+        amounts = pd.to_numeric(pd.Series([e.get("amount") for e in expenses], dtype=object), errors="coerce")
+        self.frame = pd.DataFrame({
+            "category": pd.Categorical([e.get("category") for e in expenses]),
+            "day": dates.to_numpy().astype("datetime64[D]").astype(np.int64),
+            "amount": amounts.astype(np.float64)
+        })
+
+        valid = self.frame[(self.frame["day"] != NO_DAY) & self.frame["amount"].notna()]
+        self.valid_count = len(valid)
+        spending = valid[valid["amount"] < 0]
+        self.spending = pd.DataFrame({
+            "category": spending["category"],
+            "date": pd.to_datetime(spending["day"], unit="D"),
+            "amount": spending["amount"].abs()
+        })
+
+    def __len__(self):
+        return len(self.frame)
+
+def _running_sum(values):
+    """Sum left to right from 0, as a Python loop does, so totals match one to the last bit"""
+    import numpy as np
+    return float(np.cumsum(values)[-1]) if len(values) else 0
+
+def _spending_by_category(columns, amounts, spent):
+    """
+    {category: [sum, count]} of the spending rows (mask spent over the frame's amounts,
+    summed as positive values), in order of each category's first expense, with a
+    missing category counted as "other"
+    """
+    import numpy as np
+    
+    labels = list(columns["category"].cat.categories)
+    codes = columns["category"].cat.codes.to_numpy()[spent].astype(np.intp)
+    if (codes == -1).any():
+        if "other" not in labels:
+            labels.append("other")
+        codes[codes == -1] = labels.index("other")
+    # bincount adds each bin's weights in row order, like a per-row loop
+    sums = np.bincount(codes, weights=np.abs(amounts[spent]), minlength=len(labels))
+    counts = np.bincount(codes, minlength=len(labels))
+    seen, first_index = np.unique(codes, return_index=True)
+    return {labels[code]: [float(sums[code]), int(counts[code])] for code in seen[np.argsort(first_index)]}
+
+def to_expense_frame(expenses):
+    """Get an ExpenseFrame for expense dicts, ExpenseRow tuples or an existing ExpenseFrame"""
+    if isinstance(expenses, ExpenseFrame):
+        return expenses
+    return ExpenseFrame(expenses)
+
+def _no_expenses():
+    return {
+        "error": "No expenses found",
+        "total_spent": 0,
+        "total_income": 0,
+        "balance": 0,
+        "categories": {},
+        "percentages": {},
+        "most_spent_category": {
+            "name": None,
+            "amount": 0,
+            "percentage": 0
+        },
+        "suggestions": [],
+        "monthly_stats": {
+            "days_passed": 0,
+            "days_remaining": 0,
+            "monthly_spent": 0,
+            "avg_daily_spending": 0,
+            "remaining_budget": 0,
+            "max_daily_spending": 0,
+            "projected_monthly_spending": 0,
+            "projected_end_balance": 0
+        }
+    }
+
+def analyze_expenses(expenses, uid=None, monthly_aggregate=None):
     """
     Analyze expenses and provide insights.
+    expenses can be expense dicts, ExpenseRow tuples (see database_service.get_expense_rows)
+    or an ExpenseFrame of them.
+    monthly_aggregate is the current month's aggregate document (see
+    database_service.get_monthly_aggregate); when given, monthly income and spend
+    are read from it instead of being recomputed from the expenses.
     Returns a dictionary with analysis results.
     """
-    if not expenses:
-        return {
-            "error": "No expenses found",
-            "total_spent": 0,
-            "total_income": 0,
-            "balance": 0,
-            "categories": {},
-            "percentages": {},
-            "most_spent_category": {
-                "name": None,
-                "amount": 0,
-                "percentage": 0
-            },
-            "suggestions": [],
-            "monthly_stats": {
-                "days_passed": 0,
-                "days_remaining": 0,
-                "monthly_spent": 0,
-                "avg_daily_spending": 0,
-                "remaining_budget": 0,
-                "max_daily_spending": 0,
-                "projected_monthly_spending": 0,
-                "projected_end_balance": 0
-            }
-        }
+    if not len(expenses):
+        return _no_expenses()
     
-    # Calculate totals
-    total_income = 0
-    total_expense = 0
-    category_totals = defaultdict(float)
-    category_counts = defaultdict(int)
+    import numpy as np
+    
+    frame = to_expense_frame(expenses)
+    columns = frame.frame
+    
+    # Calculate totals (a missing amount counts as 0)
+    amounts = columns["amount"].fillna(0).to_numpy()
+    spent = amounts < 0
+    total_income = _running_sum(amounts[~spent])
+    total_expense = _running_sum(np.abs(amounts[spent]))
+    
+    # Per-category spending, in order of each category's first expense (missing category is "other")
+    category_totals = {category: total for category, (total, _) in _spending_by_category(columns, amounts, spent).items()}
     
     # Get current month
     now = get_local_time()
     current_month_start = datetime(now.year, now.month, 1)
-    current_month_expenses = []
+    current_month = columns["day"].to_numpy() >= (current_month_start - datetime(1970, 1, 1)).days
     
-    for expense in expenses:
-        amount = float(expense.get("amount", 0))
-        category = expense.get("category", "other")
-        date_str = expense.get("date", "")
-        
-        # Parse date
-        try:
-            expense_date = datetime.strptime(date_str, "%Y-%m-%d")
-            if expense_date >= current_month_start:
-                current_month_expenses.append(expense)
-        except:
-            pass
-        
-        if amount >= 0:
-            total_income += amount
-        else:
-            total_expense += abs(amount)
-            category_totals[category] += abs(amount)
-            category_counts[category] += 1
+    if monthly_aggregate is not None:
+        monthly_spent = monthly_aggregate["spend"]
+        monthly_income = monthly_aggregate["income"]
+    else:
+        monthly_spent = _running_sum(np.abs(amounts[current_month & spent]))
+        monthly_income = _running_sum(amounts[current_month & ~spent])
     
+    return _summarize(now, total_income, total_expense, category_totals, monthly_spent, monthly_income, _pandas_analysis(frame))
+
+def _summarize(now, total_income, total_expense, category_totals, monthly_spent, monthly_income, pandas_analysis):
+    """Build the analyze_expenses result from the totals (category_totals: positive spend per category)"""
     total_spent = total_expense
     balance = total_income - total_expense
     
@@ -103,7 +214,6 @@ def analyze_expenses(expenses, uid=None):
     days_remaining = max(0, days_in_month - days_passed)
     
     # Calculate average daily spending this month
-    monthly_spent = sum(abs(float(e.get("amount", 0))) for e in current_month_expenses if float(e.get("amount", 0)) < 0)
     avg_daily_spending = monthly_spent / days_passed if days_passed > 0 else 0
     
     # Project end of month spending
@@ -112,7 +222,6 @@ def analyze_expenses(expenses, uid=None):
     
     # Calculate remaining budget (assuming income is monthly)
     # Get monthly income from current month
-    monthly_income = sum(float(e.get("amount", 0)) for e in current_month_expenses if float(e.get("amount", 0)) >= 0)
     if monthly_income == 0:
         # If no income this month, use total income as fallback
         monthly_income = total_income
@@ -163,69 +272,88 @@ def analyze_expenses(expenses, uid=None):
             "message": f"⚠️ At current spending rate, you'll have a deficit of {abs(projected_end_balance):.2f} ฿ by month end"
         })
     
+    return {
+        "total_spent": round(total_spent, 2),
+        "total_income": round(total_income, 2),
+        "balance": round(balance, 2),
+        "categories": {k: round(v, 2) for k, v in category_totals.items()},
+        "percentages": {k: round(v, 1) for k, v in percentages.items()},
+        "most_spent_category": {
+            "name": most_spent_category_name,
+            "amount": round(most_spent_amount, 2),
+            "percentage": round(percentages.get(most_spent_category_name, 0), 1) if most_spent_category_name else 0
+        },
+        "suggestions": suggestions,
+        "monthly_stats": {
+            "days_passed": days_passed,
+            "days_remaining": days_remaining,
+            "monthly_spent": round(monthly_spent, 2),
+            "avg_daily_spending": round(avg_daily_spending, 2),
+            "remaining_budget": round(remaining_budget, 2),
+            "max_daily_spending": round(max_daily_spending, 2),
+            "projected_monthly_spending": round(projected_monthly_spending, 2),
+            "projected_end_balance": round(projected_end_balance, 2)
+        },
+        "pandas_analysis": pandas_analysis
+    }
+
+def _fit_trend(monthly_totals):
+    """Fit a line through monthly spending totals (oldest first) and predict the next month"""
+    import numpy as np
+    from sklearn.linear_model import LinearRegression
+    X = np.array(range(len(monthly_totals))).reshape(-1, 1)
+    y = np.asarray(monthly_totals)
+    
+    model = LinearRegression()
+    model.fit(X, y)
+    
+    # Predict next month
+    next_month_pred = model.predict([[len(monthly_totals)]])[0]
+    return {
+        'predicted_next_month': max(0, round(next_month_pred, 2)),
+        'spending_trend': "increasing" if model.coef_[0] > 0 else "decreasing",
+        'trend_slope': round(model.coef_[0], 2)
+    }
+
+def _pandas_analysis(frame):
+    """The pandas_analysis section of analyze_expenses, from an ExpenseFrame"""
+    import pandas as pd
     # Use pandas for enhanced analysis
-    df = None
     pandas_analysis = {}
     
     try:
-        # Convert expenses to DataFrame
-        df = pd.DataFrame(expenses)
-        
-        # Convert date column
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        df['datetime'] = pd.to_datetime(df.get('datetime', df['date']), errors='coerce')
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        
-        # Remove rows with invalid dates or amounts
-        df = df.dropna(subset=['date', 'amount'])
-        
-        if len(df) > 0:
+        if frame.valid_count > 0:
             # Use pandas GROUPBY for category analysis
-            expenses_df = df[df['amount'] < 0].copy()
-            expenses_df['amount'] = expenses_df['amount'].abs()
+            expenses_df = frame.spending
             
             # GROUPBY category - sum, mean, count
-            category_grouped = expenses_df.groupby('category')
+            category_grouped = expenses_df.groupby('category', observed=True)
             pandas_analysis['category_totals'] = category_grouped['amount'].sum().to_dict()
             pandas_analysis['category_avg'] = category_grouped['amount'].mean().to_dict()
             pandas_analysis['category_counts'] = category_grouped.size().to_dict()
             
             # GROUPBY month
-            df['month'] = df['date'].dt.to_period('M')
             monthly_grouped = expenses_df.groupby(expenses_df['date'].dt.to_period('M'))
             pandas_analysis['monthly_totals'] = {str(k): v for k, v in monthly_grouped['amount'].sum().to_dict().items()}
             pandas_analysis['monthly_avg'] = {str(k): v for k, v in monthly_grouped['amount'].mean().to_dict().items()}
             
             # GROUPBY day of week
-            df['day_of_week'] = df['date'].dt.day_name()
             weekday_grouped = expenses_df.groupby(expenses_df['date'].dt.day_name())
             pandas_analysis['weekday_avg'] = weekday_grouped['amount'].mean().to_dict()
             
             # GROUPBY category and month (multi-level)
-            category_monthly = expenses_df.groupby(['category', expenses_df['date'].dt.to_period('M')])['amount'].sum()
+            category_monthly = expenses_df.groupby(['category', expenses_df['date'].dt.to_period('M')], observed=True)['amount'].sum()
             pandas_analysis['category_monthly'] = {f"{cat}_{str(month)}": amt for (cat, month), amt in category_monthly.to_dict().items()}
             
             # Calculate trends using linear regression
             if len(monthly_grouped) >= 2:
-                monthly_data = monthly_grouped['amount'].sum().sort_index()
-                X = np.array(range(len(monthly_data))).reshape(-1, 1)
-                y = monthly_data.values
-                
-                model = LinearRegression()
-                model.fit(X, y)
-                
-                # Predict next month
-                next_month_pred = model.predict([[len(monthly_data)]])[0]
-                pandas_analysis['predicted_next_month'] = max(0, round(next_month_pred, 2))
-                pandas_analysis['spending_trend'] = "increasing" if model.coef_[0] > 0 else "decreasing"
-                pandas_analysis['trend_slope'] = round(model.coef_[0], 2)
+                pandas_analysis.update(_fit_trend(monthly_grouped['amount'].sum().sort_index().values))
             
-            # Rolling averages
-            expenses_sorted = expenses_df.sort_values('date')
-            expenses_sorted['7day_rolling'] = expenses_sorted['amount'].rolling(window=7, min_periods=1).mean()
-            expenses_sorted['30day_rolling'] = expenses_sorted['amount'].rolling(window=30, min_periods=1).mean()
-            pandas_analysis['current_7day_avg'] = round(expenses_sorted['7day_rolling'].iloc[-1] if len(expenses_sorted) > 0 else 0, 2)
-            pandas_analysis['current_30day_avg'] = round(expenses_sorted['30day_rolling'].iloc[-1] if len(expenses_sorted) > 0 else 0, 2)
+            # Rolling averages over the latest transactions, from per-day totals as in analyze_state
+            daily = expenses_df.groupby('date')['amount'].agg(['sum', 'count']).sort_index(ascending=False)
+            newest_first = list(zip(daily['sum'].tolist(), daily['count'].tolist()))
+            pandas_analysis['current_7day_avg'] = round(_recent_mean(newest_first, 7), 2)
+            pandas_analysis['current_30day_avg'] = round(_recent_mean(newest_first, 30), 2)
             
             # Category growth analysis
             recent_30_days = expenses_df[expenses_df['date'] >= (expenses_df['date'].max() - pd.Timedelta(days=30))]
@@ -233,8 +361,8 @@ def analyze_expenses(expenses, uid=None):
                                         (expenses_df['date'] >= (expenses_df['date'].max() - pd.Timedelta(days=60)))]
             
             if len(older_30_days) > 0:
-                recent_by_cat = recent_30_days.groupby('category')['amount'].mean()
-                older_by_cat = older_30_days.groupby('category')['amount'].mean()
+                recent_by_cat = recent_30_days.groupby('category', observed=True)['amount'].mean()
+                older_by_cat = older_30_days.groupby('category', observed=True)['amount'].mean()
                 
                 category_growth = {}
                 for cat in recent_by_cat.index:
@@ -254,42 +382,131 @@ def analyze_expenses(expenses, uid=None):
         import traceback
         traceback.print_exc()
         pandas_analysis = {}
+    return pandas_analysis
+
+_WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def _recent_mean(days, count):
+    """
+    Mean of the latest count spending transactions from per-day [sum, count] totals
+    (newest days first). Transactions within a day have no order, so when the window
+    ends partway through a day, that day's transactions are valued at its mean.
+    """
+    total, taken = 0.0, 0
+    for day_sum, day_count in days:
+        if taken + day_count <= count:
+            total += day_sum
+            taken += day_count
+        else:
+            total += (count - taken) * day_sum / day_count
+            taken = count
+        if taken == count:
+            break
+    return total / taken if taken else 0
+
+def _state_pandas_analysis(data):
+    """The pandas_analysis section of analyze_expenses, from AnalysisState.to_dict() data"""
+    if not data["spend_days"] and not data["uncategorized_days"] and not data["income_days"]:
+        return {}
     
-    return {
-        "total_spent": round(total_spent, 2),
-        "total_income": round(total_income, 2),
-        "balance": round(balance, 2),
-        "categories": {k: round(v, 2) for k, v in category_totals.items()},
-        "percentages": {k: round(v, 1) for k, v in percentages.items()},
-        "most_spent_category": {
-            "name": most_spent_category_name,
-            "amount": round(most_spent_amount, 2),
-            "percentage": round(percentages.get(most_spent_category_name, 0), 1) if most_spent_category_name else 0
-        },
-        "suggestions": suggestions,
-        "monthly_stats": {
-            "days_passed": days_passed,
-            "days_remaining": days_remaining,
-            "monthly_spent": round(monthly_spent, 2),
-            "avg_daily_spending": round(avg_daily_spending, 2),
-            "remaining_budget": round(remaining_budget, 2),
-            "max_daily_spending": round(max_daily_spending, 2),
-            "projected_monthly_spending": round(projected_monthly_spending, 2),
-            "projected_end_balance": round(projected_end_balance, 2)
-        },
-        "pandas_analysis": pandas_analysis
+    categories, months, weekdays, category_months, days = {}, {}, {}, {}, {}
+    # Spending without a category counts towards the day, month and weekday but, as in
+    # pandas (which drops missing groupby keys), towards no category
+    uncategorized = {day: {None: stats} for day, stats in data["uncategorized_days"].items()}
+    for by_day in (data["spend_days"], uncategorized):
+        for day, day_stats in by_day.items():
+            day = int(day)
+            date = datetime(1970, 1, 1) + timedelta(days=day)
+            month = date.strftime("%Y-%m")
+            weekday = _WEEKDAYS[date.weekday()]
+            for category, (amount, count) in day_stats.items():
+                keys = ((months, month), (weekdays, weekday), (days, day))
+                if category is not None:
+                    keys += ((categories, category),)
+                    category_months[(category, month)] = category_months.get((category, month), 0.0) + amount
+                for stats, key in keys:
+                    entry = stats.setdefault(key, [0.0, 0])
+                    entry[0] += amount
+                    entry[1] += count
+    
+    # Keys in sorted order, as pandas groupby returns them
+    pandas_analysis = {
+        'category_totals': {k: categories[k][0] for k in sorted(categories)},
+        'category_avg': {k: categories[k][0] / categories[k][1] for k in sorted(categories)},
+        'category_counts': {k: categories[k][1] for k in sorted(categories)},
+        'monthly_totals': {k: months[k][0] for k in sorted(months)},
+        'monthly_avg': {k: months[k][0] / months[k][1] for k in sorted(months)},
+        'weekday_avg': {k: weekdays[k][0] / weekdays[k][1] for k in sorted(weekdays)},
+        'category_monthly': {f"{cat}_{month}": category_months[(cat, month)] for cat, month in sorted(category_months)}
     }
+    
+    if len(months) >= 2:
+        pandas_analysis.update(_fit_trend([months[k][0] for k in sorted(months)]))
+    
+    newest_first = [days[day] for day in sorted(days, reverse=True)]
+    pandas_analysis['current_7day_avg'] = round(_recent_mean(newest_first, 7), 2)
+    pandas_analysis['current_30day_avg'] = round(_recent_mean(newest_first, 30), 2)
+    
+    # Category growth: last 30 days against the 30 before, counted back from the latest expense
+    if days:
+        latest = max(days)
+        recent, older = {}, {}
+        for day, day_stats in data["spend_days"].items():
+            day = int(day)
+            window = recent if day >= latest - 30 else older if day >= latest - 60 else None
+            if window is None:
+                continue
+            for category, (amount, count) in day_stats.items():
+                entry = window.setdefault(category, [0.0, 0])
+                entry[0] += amount
+                entry[1] += count
+        
+        if older:
+            category_growth = {}
+            for cat in sorted(recent):
+                if cat in older and older[cat][0] > 0:
+                    recent_avg = recent[cat][0] / recent[cat][1]
+                    older_avg = older[cat][0] / older[cat][1]
+                    category_growth[cat] = round(((recent_avg - older_avg) / older_avg) * 100, 2)
+            
+            pandas_analysis['category_growth'] = category_growth
+            if category_growth:
+                fastest_growing = max(category_growth.items(), key=lambda x: x[1])
+                pandas_analysis['fastest_growing_category'] = {
+                    'name': fastest_growing[0],
+                    'growth_percent': fastest_growing[1]
+                }
+    return pandas_analysis
+
+def analyze_state(state, uid=None, monthly_aggregate=None):
+    """
+    analyze_expenses output computed from an AnalysisState (see analysis_state.py)
+    instead of the expense rows, in time proportional to the number of days with
+    expenses. Matches analyze_expenses, up to floating-point summation order.
+    """
+    data = state.to_dict()
+    if not data["income"][1] and not data["spent"][1]:
+        return _no_expenses()
+    
+    now = get_local_time()
+    if monthly_aggregate is not None:
+        monthly_spent = monthly_aggregate["spend"]
+        monthly_income = monthly_aggregate["income"]
+    else:
+        month_start = (datetime(now.year, now.month, 1) - datetime(1970, 1, 1)).days
+        monthly_spent = sum(amount for day, day_stats in data["spend_days"].items() if int(day) >= month_start
+                            for amount, _ in day_stats.values())
+        monthly_spent += sum(amount for day, (amount, _) in data["uncategorized_days"].items() if int(day) >= month_start)
+        monthly_income = sum(amount for day, (amount, _) in data["income_days"].items() if int(day) >= month_start)
+    
+    category_totals = {category: amount for category, (amount, _) in data["categories"].items()}
+    return _summarize(now, data["income"][0], data["spent"][0], category_totals, monthly_spent, monthly_income,
+                      _state_pandas_analysis(data))
 
 def get_average_spending(expenses, category=None, time_period=None):
     """Get average spending using pandas mean operations"""
     try:
-        df = pd.DataFrame(expenses)
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        df = df.dropna(subset=['date', 'amount'])
-        
-        expenses_df = df[df['amount'] < 0].copy()
-        expenses_df['amount'] = expenses_df['amount'].abs()
+        expenses_df = to_expense_frame(expenses).spending
         
         if category:
             expenses_df = expenses_df[expenses_df['category'] == category]
@@ -323,13 +540,7 @@ def get_average_spending(expenses, category=None, time_period=None):
 def get_spending_trends(expenses):
     """Get spending trends using linear regression"""
     try:
-        df = pd.DataFrame(expenses)
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        df = df.dropna(subset=['date', 'amount'])
-        
-        expenses_df = df[df['amount'] < 0].copy()
-        expenses_df['amount'] = expenses_df['amount'].abs()
+        expenses_df = to_expense_frame(expenses).spending
         
         monthly_grouped = expenses_df.groupby(expenses_df['date'].dt.to_period('M'))
         monthly_totals = monthly_grouped['amount'].sum().sort_index()
@@ -337,20 +548,12 @@ def get_spending_trends(expenses):
         if len(monthly_totals) < 2:
             return None
         
-        X = np.array(range(len(monthly_totals))).reshape(-1, 1)
-        y = monthly_totals.values
-        
-        model = LinearRegression()
-        model.fit(X, y)
-        
-        # Predict next month
-        next_month_pred = model.predict([[len(monthly_totals)]])[0]
-        
+        trend = _fit_trend(monthly_totals.values)
         return {
-            'trend': "increasing" if model.coef_[0] > 0 else "decreasing",
-            'slope': round(model.coef_[0], 2),
-            'predicted_next_month': max(0, round(next_month_pred, 2)),
-            'current_month': round(monthly_totals.iloc[-1], 2) if len(monthly_totals) > 0 else 0
+            'trend': trend['spending_trend'],
+            'slope': trend['trend_slope'],
+            'predicted_next_month': trend['predicted_next_month'],
+            'current_month': round(monthly_totals.iloc[-1], 2)
         }
     except Exception as e:
         print(f"Error in get_spending_trends: {e}")
@@ -359,18 +562,11 @@ def get_spending_trends(expenses):
 def get_weekday_analysis(expenses):
     """Get spending by day of week using pandas GROUPBY"""
     try:
-        df = pd.DataFrame(expenses)
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        df = df.dropna(subset=['date', 'amount'])
-        
-        expenses_df = df[df['amount'] < 0].copy()
+        expenses_df = to_expense_frame(expenses).spending
         
         if len(expenses_df) == 0:
             return None
         
-        expenses_df['amount'] = expenses_df['amount'].abs()
-        
         weekday_grouped = expenses_df.groupby(expenses_df['date'].dt.day_name())
         weekday_avg = weekday_grouped['amount'].mean()
         weekday_totals = weekday_grouped['amount'].sum()
@@ -395,14 +591,9 @@ def get_weekday_analysis(expenses):
 
 def get_category_growth(expenses):
     """Get category growth analysis using pandas GROUPBY"""
+    import pandas as pd
     try:
-        df = pd.DataFrame(expenses)
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        df = df.dropna(subset=['date', 'amount'])
-        
-        expenses_df = df[df['amount'] < 0].copy()
-        expenses_df['amount'] = expenses_df['amount'].abs()
+        expenses_df = to_expense_frame(expenses).spending
         
         recent_30_days = expenses_df[expenses_df['date'] >= (expenses_df['date'].max() - pd.Timedelta(days=30))]
         older_30_days = expenses_df[(expenses_df['date'] < (expenses_df['date'].max() - pd.Timedelta(days=30))) & 
@@ -411,8 +602,8 @@ def get_category_growth(expenses):
         if len(older_30_days) == 0:
             return None
         
-        recent_by_cat = recent_30_days.groupby('category')['amount'].mean()
-        older_by_cat = older_30_days.groupby('category')['amount'].mean()
+        recent_by_cat = recent_30_days.groupby('category', observed=True)['amount'].mean()
+        older_by_cat = older_30_days.groupby('category', observed=True)['amount'].mean()
         
         category_growth = {}
         for cat in recent_by_cat.index:
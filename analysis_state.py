@@ -0,0 +1,185 @@
+import threading
+from datetime import datetime
+
+# Running totals behind /analyze. Each add applies an expense and each delete reverts
+# it, so the analysis is derived from the totals (see analysis_service.analyze_state)
+# instead of from a re-read of the user's whole history.
+
+STATE_FORMAT = 2
+_EPOCH = datetime(1970, 1, 1)
+
+def _parse_amount(value):
+    """An amount as a float, or None if it is missing or not a number"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _parse_day(value):
+    """Days since 1970-01-01 of a "YYYY-MM-DD" date, or None if it does not parse"""
+    try:
+        return (datetime.strptime(value, "%Y-%m-%d") - _EPOCH).days
+    except (TypeError, ValueError):
+        return None
+
+def _add(stats, key, amount, sign):
+    """Add sign * amount to stats[key] = [sum, count]; the entry is removed when its count reaches 0"""
+    entry = stats.get(key)
+    if entry is None:
+        entry = stats[key] = [0.0, 0]
+    entry[0] += sign * amount
+    entry[1] += sign
+    if entry[1] <= 0:
+        del stats[key]
+
+def _grouped(frame, keys, amounts):
+    """
+    Yield (key, sum, count) of amounts grouped by columns of frame, with int days and
+    Python numbers, in order of each group's first row (the order apply adds them in)
+    """
+    import numpy as np
+    groups = amounts.groupby([frame[key] for key in keys], observed=True, sort=False)
+    sizes = groups.size()
+    # bincount sums each group in row order, as apply does (pandas' own sum compensates).
+    # Rows with a missing key are in no group (ngroup is NaN).
+    ids = groups.ngroup()
+    grouped = ids.notna().to_numpy()
+    sums = np.bincount(ids.to_numpy()[grouped].astype(np.intp), weights=amounts.to_numpy()[grouped], minlength=len(sizes))
+    for key, total, count in zip(sizes.index.tolist(), sums.tolist(), sizes.tolist()):
+        yield (int(key[0]), key[1]) if isinstance(key, tuple) else int(key), total, count
+
+class AnalysisState:
+    """
+    A user's expense totals, updated per transaction with apply/revert.
+    income and spent are [sum, count] over all expenses (a missing amount counts as 0
+    income, as in analyze_expenses); categories is {category: [sum, count]} of spending.
+    spend_days ({day: {category: [sum, count]}}) and income_days ({day: [sum, count]})
+    cover expenses with a valid date and amount, by days since 1970-01-01; spending with
+    no category is counted as "other" in categories but kept apart in uncategorized_days
+    ({day: [sum, count]}), since analyze_expenses leaves it out of per-category stats.
+    Spending sums are positive. Thread-safe: changes and to_dict copies hold the state's lock.
+    """
+
+    def __init__(self):
+        self.income = [0.0, 0]
+        self.spent = [0.0, 0]
+        self.categories = {}
+        self.spend_days = {}
+        self.uncategorized_days = {}
+        self.income_days = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_expenses(cls, expenses):
+        """
+        Build the state of expense dicts, ExpenseRow tuples or an ExpenseFrame of them,
+        grouping the frame's parsed day and amount columns (the same totals apply gives)
+        """
+        state = cls()
+        if not len(expenses):
+            return state
+        
+        from analysis_service import NO_DAY, to_expense_frame, _running_sum, _spending_by_category
+        import numpy as np
+        
+        columns = to_expense_frame(expenses).frame
+        amounts = columns["amount"].to_numpy()
+        values = np.nan_to_num(amounts, nan=0.0)  # A missing amount counts as 0 income
+        spent = values < 0
+        state.income = [float(_running_sum(values[~spent])), int((~spent).sum())]
+        state.spent = [float(_running_sum(-values[spent])), int(spent.sum())]
+        state.categories = _spending_by_category(columns, values, spent)
+        
+        dated = columns["day"].to_numpy() != NO_DAY
+        income = columns[dated & (amounts >= 0)]
+        for day, total, count in _grouped(income, ["day"], income["amount"]):
+            state.income_days[day] = [total, count]
+        
+        spending = columns[dated & spent]
+        uncategorized = spending["category"].isna().to_numpy()
+        # groupby leaves out rows without a category, which go to uncategorized_days
+        for (day, category), total, count in _grouped(spending, ["day", "category"], -spending["amount"]):
+            state.spend_days.setdefault(day, {})[category] = [total, count]
+        for day, total, count in _grouped(spending[uncategorized], ["day"], -spending["amount"][uncategorized]):
+            state.uncategorized_days[day] = [total, count]
+        return state
+
+    def apply(self, expense, sign=1):
+        """Add an expense to the totals (sign=-1 takes it out again, see revert)"""
+        with self._lock:
+            self._apply(expense, sign)
+
+    def revert(self, expense):
+        """Take a previously applied expense out of the totals"""
+        self.apply(expense, sign=-1)
+
+    def update(self, added=(), removed=()):
+        """Apply added and revert removed expenses as one change: to_dict sees all of it or none"""
+        with self._lock:
+            for expense in added:
+                self._apply(expense, 1)
+            for expense in removed:
+                self._apply(expense, -1)
+
+    def _apply(self, expense, sign):
+        # Call with the lock held
+        amount = _parse_amount(expense.get("amount"))
+        value = amount if amount is not None else 0.0
+        category = expense.get("category")
+        day = _parse_day(expense.get("date"))
+
+        totals = self.income if value >= 0 else self.spent
+        totals[0] += sign * abs(value)
+        totals[1] += sign
+        if totals[1] <= 0:
+            totals[0], totals[1] = 0.0, 0
+
+        if value >= 0:
+            if day is not None and amount is not None:
+                _add(self.income_days, day, value, sign)
+            return
+        _add(self.categories, "other" if category is None else category, -value, sign)
+        if day is None:
+            return
+        if category is None:
+            _add(self.uncategorized_days, day, -value, sign)
+        else:
+            day_stats = self.spend_days.setdefault(day, {})
+            _add(day_stats, category, -value, sign)
+            if not day_stats:
+                del self.spend_days[day]
+
+    def to_dict(self):
+        """A copy of the totals as plain JSON-compatible data (string keys, [sum, count] lists)"""
+        with self._lock:
+            return {
+                "format": STATE_FORMAT,
+                "income": list(self.income),
+                "spent": list(self.spent),
+                "categories": {category: list(stats) for category, stats in self.categories.items()},
+                "spend_days": {
+                    str(day): {category: list(stats) for category, stats in day_stats.items()}
+                    for day, day_stats in self.spend_days.items()
+                },
+                "uncategorized_days": {str(day): list(stats) for day, stats in self.uncategorized_days.items()},
+                "income_days": {str(day): list(stats) for day, stats in self.income_days.items()}
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a state from to_dict output. Raises ValueError for another format."""
+        if data.get("format") != STATE_FORMAT:
+            raise ValueError(f"Unsupported analysis state format: {data.get('format')}")
+        state = cls()
+        state.income = list(data["income"])
+        state.spent = list(data["spent"])
+        state.categories = {category: list(stats) for category, stats in data["categories"].items()}
+        state.spend_days = {
+            int(day): {category: list(stats) for category, stats in day_stats.items()}
+            for day, day_stats in data["spend_days"].items()
+        }
+        state.uncategorized_days = {int(day): list(stats) for day, stats in data["uncategorized_days"].items()}
+        state.income_days = {int(day): list(stats) for day, stats in data["income_days"].items()}
+        return state
@@ -1,11 +1,17 @@
+import time
+STARTUP_STARTED = time.perf_counter()
 import sys
 import os
+import json
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from flask import Flask, request, jsonify, render_template
-from auth_service import register_user, login_user, verify_token
-from database_service import add_expense, get_expenses, add_category, get_categories, delete_expense, search_transactions
+from datetime import datetime
+from functools import wraps
+from flask import Flask, Response, request, jsonify, render_template, g, stream_with_context
+from auth_service import register_user, login_user, resolve_uid, issue_session_token, is_auth_throttled, record_auth_failure, init_session_keys
+from database_service import add_expense, add_expenses, get_expenses, iter_expenses, get_expenses_page, get_monthly_aggregate, add_category, get_categories, delete_expense, delete_expenses, delete_expenses_matching, search_transactions, save_user, find_user_by_email, get_changes, get_sync_token, get_analysis
 from chatbot_service import parse_natural_language
-from analysis_service import analyze_expenses
+from analysis_service import start_prewarm
+from export_service import csv_chunks, parquet_chunks
 
 # Load environment variables
 try:
@@ -27,8 +33,20 @@ except Exception as e:
     import traceback
     traceback.print_exc()
 
+# Fail now rather than on the first login if session tokens cannot be signed
+init_session_keys()
+
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
+# Number of proxies in front of the app (load balancer, Cloud Run/Render frontend) that
+# append the peer address to X-Forwarded-For. The client address used for auth throttling
+# is the one the outermost trusted proxy saw; anything further left in the header is
+# client-supplied and ignored. Set to 0 when clients connect to the app directly.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+if TRUSTED_PROXY_HOPS > 0:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # Error handler to ensure JSON responses
 @app.errorhandler(404)
 def not_found(error):
@@ -42,6 +60,23 @@ def internal_error(error):
 def bad_request(error):
     return jsonify({"error": "Bad request"}), 400
 
+def require_auth(view):
+    """Resolve the Authorization header to g.uid, or respond 401 (429 once a client keeps failing)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # remote_addr is already the trusted hop's view (ProxyFix above)
+        client_ip = request.remote_addr
+        throttled = is_auth_throttled(client_ip)
+        uid = resolve_uid(request.headers.get("Authorization"), allow_lookup=not throttled)
+        if not uid:
+            if throttled:
+                return jsonify({"error": "Invalid token (too many attempts, please log in again)"}), 429
+            record_auth_failure(client_ip)
+            return jsonify({"error": "Invalid token"}), 401
+        g.uid = uid
+        return view(*args, **kwargs)
+    return wrapper
+
 @app.route("/", methods=["GET"])
 def index():
     """Homepage"""
@@ -249,10 +284,14 @@ def api_docs():
         "version": "1.0",
         "endpoints": {
             "POST /register": "Register a new user",
-            "POST /login": "Login with Firebase ID token",
+            "POST /login": "Login with email/password or Firebase ID token, returns a session token",
             "POST /add_expense": "Add a new expense (requires Authorization header)",
-            "GET /expenses": "Get all expenses for the authenticated user (requires Authorization header)",
-            "GET /search_transactions": "Search transactions by query (requires Authorization header, query parameter: q)"
+            "POST /add_expenses": "Add many expenses from a JSON array or NDJSON body (requires Authorization header)",
+            "POST /delete_expenses": "Delete expenses by expense_ids, or by filter {start, end, category} (requires Authorization header)",
+            "GET /expenses": "Get all expenses for the authenticated user, or one page with limit/cursor (requires Authorization header)",
+            "GET /expenses/changes": "Get expenses added and deleted since a sync token (requires Authorization header, query parameter: since)",
+            "GET /search_transactions": "Search transactions by query and filters (requires Authorization header, query parameter: q)",
+            "GET /export": "Download transactions as CSV or Parquet (requires Authorization header, query parameters: format, start, end)"
         },
         "usage": {
             "register": {
@@ -274,7 +313,7 @@ def api_docs():
                 "method": "POST",
                 "url": "/add_expense",
                 "headers": {
-                    "Authorization": "firebase_id_token",
+                    "Authorization": "session_token",
                     "Content-Type": "application/json"
                 },
                 "body": {
@@ -286,19 +325,62 @@ def api_docs():
             },
             "get_expenses": {
                 "method": "GET",
-                "url": "/expenses",
+                "url": "/expenses?limit=50&order_by=datetime",
                 "headers": {
-                    "Authorization": "firebase_id_token"
+                    "Authorization": "session_token"
+                },
+                "request_headers": {
+                    "Accept": "application/x-ndjson streams the full list, one expense per line"
+                },
+                "query_parameters": {
+                    "limit": "Page size (1-500). When set, the response is {expenses, next_cursor}",
+                    "order_by": "datetime (newest first)",
+                    "cursor": "next_cursor from the previous page"
+                },
+                "response_headers": {
+                    "X-Sync-Token": "Sync token for /expenses/changes (full list only)"
+                }
+            },
+            "expense_changes": {
+                "method": "GET",
+                "url": "/expenses/changes?since=sync_token",
+                "headers": {
+                    "Authorization": "session_token"
+                },
+                "query_parameters": {
+                    "since": "X-Sync-Token from /expenses, or sync_token from the previous call"
+                },
+                "response": "{expenses, deleted, sync_token}, or {reset: true} if the full list must be reloaded"
+            },
+            "export": {
+                "method": "GET",
+                "url": "/export?format=parquet&start=2024-01-01&end=2025-01-01",
+                "headers": {
+                    "Authorization": "session_token"
+                },
+                "query_parameters": {
+                    "format": "csv (default) or parquet (typed columns: date, timestamp datetime, categorical category, float amount)",
+                    "start": "First day to include (YYYY-MM-DD, optional)",
+                    "end": "Day to stop before (YYYY-MM-DD, optional)"
                 }
             },
             "search_transactions": {
                 "method": "GET",
                 "url": "/search_transactions?q=search_query",
                 "headers": {
-                    "Authorization": "firebase_id_token"
+                    "Authorization": "session_token"
                 },
                 "query_parameters": {
-                    "q": "Search query (searches in category, description, and amount)"
+                    "q": "Search query (searches in category, description, and amount), with optional filters",
+                    "match": "substring (default) or prefix"
+                },
+                "filters": {
+                    "category:food": "Only this category",
+                    "amount>100": "Amount comparison (>, >=, <, <=, =); expenses are negative",
+                    "date>=2024-01-01": "Date comparison (:, >, >=, <, <=)",
+                    "before:2024-02-01": "Dates before this day",
+                    "after:2024-01-01": "Dates after this day",
+                    "\"coffee shop\"": "Exact phrase"
                 }
             }
         }
@@ -316,11 +398,7 @@ def register():
         # Save user data to Firestore for login
         if result.get("success"):
             try:
-                from firebase_config import db
-                db.collection("users").document(result["uid"]).set({
-                    "email": data["email"],
-                    "uid": result["uid"]
-                })
+                save_user(result["uid"], data["email"])
             except Exception as e:
                 # If Firestore error, log but still return success because user was created
                 print(f"Warning: Could not save user to Firestore: {e}")
@@ -340,23 +418,15 @@ def login():
         # Support both email/password and id_token
         if "email" in data and "password" in data:
             try:
-                # Find user from email in Firestore
-                from firebase_config import db
-                users_ref = db.collection("users")
-                # Use where with positional arguments
-                query = users_ref.where("email", "==", data["email"]).limit(1).stream()
+                # Find user from email
+                user_uid = find_user_by_email(data["email"])
                 
-                user_doc = None
-                for doc in query:
-                    user_doc = doc
-                    break
-                
-                if user_doc:
+                if user_uid:
                     # For demo - in production should verify password
                     return jsonify({
                         "success": True,
-                        "uid": user_doc.id,
-                        "token": user_doc.id  # Use uid as temporary token
+                        "uid": user_uid,
+                        "token": issue_session_token(user_uid)
                     })
                 else:
                     return jsonify({"success": False, "error": "Invalid email or password"}), 401
@@ -380,56 +450,19 @@ def login():
         return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
 
 @app.route("/add_expense", methods=["POST"])
+@require_auth
 def add_expense_route():
-    token = request.headers.get("Authorization")
-    # If token is uid, use it directly, otherwise verify
-    if token:
-        # Check if token is uid
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
-    
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    uid = g.uid
 
     data = request.json
     amount = float(data["amount"])
     
     # If adding an expense (negative amount), check if it would exceed income
     if amount < 0:
-        from database_service import get_expenses
-        from datetime import datetime
-        from analysis_service import get_local_time
-        expenses = get_expenses(uid)
-        
-        # Calculate current month income and expenses
-        now = get_local_time()
-        current_month_start = datetime(now.year, now.month, 1)
-        
-        monthly_income = 0
-        monthly_expenses = 0
-        
-        for expense in expenses:
-            expense_date_str = expense.get("datetime") or expense.get("date", "")
-            try:
-                if " " in expense_date_str:
-                    expense_date = datetime.strptime(expense_date_str.split()[0], "%Y-%m-%d")
-                else:
-                    expense_date = datetime.strptime(expense_date_str, "%Y-%m-%d")
-                
-                if expense_date >= current_month_start:
-                    exp_amount = float(expense.get("amount", 0))
-                    if exp_amount >= 0:
-                        monthly_income += exp_amount
-                    else:
-                        monthly_expenses += abs(exp_amount)
-            except:
-                pass
+        # Current month income and expenses from the monthly aggregate document
+        monthly = get_monthly_aggregate(uid)
+        monthly_income = monthly["income"]
+        monthly_expenses = monthly["spend"]
         
         # Check if adding this expense would exceed income
         new_expense_amount = abs(amount)
@@ -448,43 +481,160 @@ def add_expense_route():
     )
     return jsonify({"success": True})
 
+# Largest number of items accepted by /add_expenses in one request
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "20000"))
+
+@app.route("/add_expenses", methods=["POST"])
+@require_auth
+def add_expenses_route():
+    """Add many expenses in one request (JSON array, or NDJSON with Content-Type application/x-ndjson)"""
+    uid = g.uid
+    
+    items = []
+    if request.mimetype == "application/x-ndjson":
+        # One JSON object per line, read from the stream without loading the body as one document
+        for line_number, line in enumerate(request.stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                return jsonify({"error": f"Invalid JSON on line {line_number}"}), 400
+            if len(items) > BULK_MAX_ITEMS:
+                break
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get("expenses")
+        if not isinstance(data, list):
+            return jsonify({"error": "Expected a JSON array of expenses"}), 400
+        items = data
+    
+    if not items:
+        return jsonify({"error": "No expenses provided"}), 400
+    if len(items) > BULK_MAX_ITEMS:
+        return jsonify({"error": f"Too many expenses, the limit is {BULK_MAX_ITEMS} per request"}), 413
+    
+    results = add_expenses(uid, items)
+    added = sum(1 for r in results if r["success"])
+    return jsonify({
+        "success": added == len(results),
+        "added": added,
+        "failed": len(results) - added,
+        "results": results
+    })
+
+# Bytes of NDJSON gathered before each write of a streamed response
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(64 * 1024)))
+
+def wants_ndjson():
+    """Check if the client asked for NDJSON (Accept: application/x-ndjson) over JSON"""
+    return request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+def ndjson_lines(expenses):
+    """Encode expenses as NDJSON, yielding chunks of about STREAM_CHUNK_BYTES"""
+    buffer, size = [], 0
+    for expense in expenses:
+        line = app.json.dumps(expense, separators=(",", ":")) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
 @app.route("/expenses", methods=["GET"])
+@require_auth
 def expenses():
-    token = request.headers.get("Authorization")
-    # If token is uid, use it directly, otherwise verify
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
+    uid = g.uid
+
+    # Without paging parameters return the full list, as the dashboard expects
+    if not any(param in request.args for param in ("limit", "cursor", "order_by")):
+        sync_token = get_sync_token()
+        if wants_ndjson():
+            # One expense per line, written as storage returns them
+            response = Response(stream_with_context(ndjson_lines(iter_expenses(uid))), mimetype="application/x-ndjson")
         else:
-            uid = verify_token(token)
-    else:
-        uid = None
+            response = jsonify(get_expenses(uid))
+        # For later GET /expenses/changes?since= calls
+        response.headers["X-Sync-Token"] = sync_token
+        return response
+    
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, 500))
     
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    try:
+        page, next_cursor = get_expenses_page(
+            uid,
+            limit=limit,
+            cursor=request.args.get("cursor") or None,
+            order_by=request.args.get("order_by", "datetime")
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"expenses": page, "next_cursor": next_cursor})
 
-    result = get_expenses(uid)
-    return jsonify(result)
+@app.route("/expenses/changes", methods=["GET"])
+@require_auth
+def expense_changes():
+    """Get the expenses added and deleted since a sync token"""
+    uid = g.uid
+    
+    since = request.args.get("since")
+    if not since:
+        return jsonify({"error": "since (sync token) required"}), 400
+    
+    try:
+        changes = get_changes(uid, since)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(changes)
+
+@app.route("/export", methods=["GET"])
+@require_auth
+def export():
+    """Download the user's transactions as CSV or Parquet, optionally for a date range"""
+    uid = g.uid
+    
+    export_format = request.args.get("format", "csv").lower()
+    start = request.args.get("start") or None
+    end = request.args.get("end") or None
+    for value in (start, end):
+        if value is not None:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return jsonify({"error": "start and end must be YYYY-MM-DD"}), 400
+    
+    # Rows are written as the storage iterator produces them
+    expenses = iter_expenses(uid, start=start, end=end)
+    if export_format == "csv":
+        chunks, mimetype = csv_chunks(expenses), "text/csv"
+    elif export_format == "parquet":
+        try:
+            chunks = parquet_chunks(expenses)
+        except ImportError:
+            return jsonify({"error": "Parquet export is not available (pyarrow is not installed)"}), 501
+        mimetype = "application/vnd.apache.parquet"
+    else:
+        return jsonify({"error": "format must be csv or parquet"}), 400
+    
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="expenses.{export_format}"'}
+    )
 
 @app.route("/search_transactions", methods=["GET"])
+@require_auth
 def search_transactions_route():
     """Search transactions by query string"""
-    token = request.headers.get("Authorization")
-    # If token is uid, use it directly, otherwise verify
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
-    
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    uid = g.uid
     
     # Get search query from query parameters
     query = request.args.get("q", "").strip()
@@ -492,25 +642,17 @@ def search_transactions_route():
     if not query:
         return jsonify({"error": "Search query required"}), 400
     
-    result = search_transactions(uid, query)
+    try:
+        result = search_transactions(uid, query, prefix=request.args.get("match") == "prefix")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify(result)
 
 @app.route("/delete_expense", methods=["POST"])
+@require_auth
 def delete_expense_route():
     """Delete an expense"""
-    token = request.headers.get("Authorization")
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
-    
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    uid = g.uid
     
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 400
@@ -527,23 +669,54 @@ def delete_expense_route():
     else:
         return jsonify({"error": result.get("error", "Failed to delete expense")}), 400
 
+@app.route("/delete_expenses", methods=["POST"])
+@require_auth
+def delete_expenses_route():
+    """Delete many expenses by ID, or all expenses matching a date range and/or category"""
+    uid = g.uid
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request must be JSON"}), 400
+    
+    if "expense_ids" in data:
+        expense_ids = data["expense_ids"]
+        if not isinstance(expense_ids, list) or not expense_ids or not all(isinstance(i, str) and i for i in expense_ids):
+            return jsonify({"error": "expense_ids must be a non-empty list of IDs"}), 400
+        if len(expense_ids) > BULK_MAX_ITEMS:
+            return jsonify({"error": f"Too many IDs, the limit is {BULK_MAX_ITEMS} per request"}), 413
+        results = delete_expenses(uid, expense_ids)
+        deleted = sum(1 for r in results if r["success"])
+        return jsonify({
+            "success": deleted == len(results),
+            "deleted": deleted,
+            "failed": len(results) - deleted,
+            "results": results
+        })
+    
+    if "filter" in data:
+        filters = data["filter"]
+        if not isinstance(filters, dict):
+            return jsonify({"error": "filter must be an object with start, end and/or category"}), 400
+        try:
+            deleted = delete_expenses_matching(
+                uid,
+                start=filters.get("start"),
+                end=filters.get("end"),
+                category=filters.get("category")
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"success": True, "deleted": deleted})
+    
+    return jsonify({"error": "Provide expense_ids or filter"}), 400
+
 @app.route("/chatbot", methods=["POST"])
+@require_auth
 def chatbot():
     """Parse natural language input and return structured data"""
     try:
-        token = request.headers.get("Authorization")
-        if token:
-            from firebase_config import db
-            user_doc = db.collection("users").document(token).get()
-            if user_doc.exists:
-                uid = token
-            else:
-                uid = verify_token(token)
-        else:
-            uid = None
-        
-        if not uid:
-            return jsonify({"error": "Invalid token"}), 401
+        uid = g.uid
         
         if not request.is_json:
             return jsonify({"error": "Request must be JSON"}), 400
@@ -589,9 +762,7 @@ def chatbot():
         
         # Check if it's an analysis request
         if result.get("action") == "analyze":
-            # Get all expenses for analysis
-            expenses = get_expenses(uid)
-            analysis = analyze_expenses(expenses, uid)
+            analysis = get_analysis(uid)
             return jsonify({
                 "action": "analysis",
                 "analysis": analysis
@@ -606,21 +777,10 @@ def chatbot():
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 @app.route("/add_category", methods=["POST"])
+@require_auth
 def add_category_route():
     """Add a custom category"""
-    token = request.headers.get("Authorization")
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
-    
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    uid = g.uid
     
     data = request.json
     category_name = data.get("category", "").strip().lower()
@@ -632,45 +792,25 @@ def add_category_route():
     return jsonify(result)
 
 @app.route("/categories", methods=["GET"])
+@require_auth
 def categories():
     """Get all categories for the user"""
-    token = request.headers.get("Authorization")
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
-    
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
+    uid = g.uid
     
     categories_list = get_categories(uid)
     return jsonify({"categories": categories_list})
 
 @app.route("/analyze", methods=["GET"])
+@require_auth
 def analyze():
-    """Get expense analysis"""
-    token = request.headers.get("Authorization")
-    if token:
-        from firebase_config import db
-        user_doc = db.collection("users").document(token).get()
-        if user_doc.exists:
-            uid = token
-        else:
-            uid = verify_token(token)
-    else:
-        uid = None
+    """Get expense analysis (?full=1 recomputes it from every expense)"""
+    uid = g.uid
     
-    if not uid:
-        return jsonify({"error": "Invalid token"}), 401
-    
-    expenses = get_expenses(uid)
-    analysis = analyze_expenses(expenses, uid)
-    return jsonify(analysis)
+    return jsonify(get_analysis(uid, full=request.args.get("full") == "1"))
+
+# Startup report: analysis libraries are not loaded yet (see analysis_service)
+print(f"App ready in {(time.perf_counter() - STARTUP_STARTED) * 1000:.0f} ms")
 
 if __name__ == "__main__":
+    start_prewarm()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,204 @@
+import os
+from contextlib import asynccontextmanager
+from functools import wraps
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from app import app as flask_app, STREAM_CHUNK_BYTES, TRUSTED_PROXY_HOPS
+from auth_service import resolve_uid, is_auth_throttled, record_auth_failure
+from async_database_service import add_expense, get_expenses, iter_expenses, get_expenses_page, get_monthly_aggregate, delete_expense, get_categories, get_analysis
+from analysis_service import start_prewarm
+from database_service import get_sync_token
+
+# ASGI entry point (uvicorn asgi:app). The busiest JSON routes run on asyncio with the
+# async database functions; every other route is served by the Flask app through a
+# WSGI bridge, so both entry points expose the same API.
+
+# Threads for the routes served by the Flask app
+WSGI_BRIDGE_WORKERS = int(os.getenv("WSGI_BRIDGE_WORKERS", "10"))
+
+def jsonify(data, status_code=200, headers=None):
+    """JSON response encoded like Flask's jsonify"""
+    body = flask_app.json.dumps(data, separators=(",", ":")) + "\n"
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
+
+def wants_ndjson(request):
+    """Check if the client asked for NDJSON (Accept: application/x-ndjson) over JSON"""
+    accept = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+    return accept.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+async def ndjson_lines(expenses):
+    """Encode expenses from an async iterator as NDJSON, yielding chunks of about STREAM_CHUNK_BYTES"""
+    buffer, size = [], 0
+    async for expense in expenses:
+        line = flask_app.json.dumps(expense, separators=(",", ":")) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def client_address(request):
+    """
+    The client IP as seen by the outermost of TRUSTED_PROXY_HOPS proxies, like ProxyFix
+    on the Flask app: entries further left in X-Forwarded-For are client-supplied
+    """
+    peer = request.client.host if request.client else None
+    forwarded = request.headers.get("x-forwarded-for")
+    if TRUSTED_PROXY_HOPS <= 0 or not forwarded:
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",")]
+    if len(hops) < TRUSTED_PROXY_HOPS:
+        return peer
+    return hops[-TRUSTED_PROXY_HOPS]
+
+def require_auth(view):
+    """Resolve the Authorization header to request.state.uid, or respond 401 (429 once a client keeps failing)"""
+    @wraps(view)
+    async def wrapper(request):
+        client_ip = client_address(request)
+        throttled = is_auth_throttled(client_ip)
+        token = request.headers.get("authorization")
+
+        # Session tokens and cached tokens resolve in-process; lookups go to a worker thread
+        uid = resolve_uid(token, allow_lookup=False)
+        if not uid and token and not throttled:
+            uid = await run_in_threadpool(resolve_uid, token)
+        if not uid:
+            if throttled:
+                return jsonify({"error": "Invalid token (too many attempts, please log in again)"}, 429)
+            record_auth_failure(client_ip)
+            return jsonify({"error": "Invalid token"}, 401)
+        request.state.uid = uid
+        return await view(request)
+    return wrapper
+
+@require_auth
+async def add_expense_route(request):
+    uid = request.state.uid
+
+    data = await _json_body(request)
+    try:
+        amount = float(data["amount"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Bad request"}, 400)
+
+    # If adding an expense (negative amount), check if it would exceed income
+    if amount < 0:
+        monthly = await get_monthly_aggregate(uid)
+        monthly_income = monthly["income"]
+        monthly_expenses = monthly["spend"]
+
+        new_expense_amount = abs(amount)
+        if monthly_income > 0 and (monthly_expenses + new_expense_amount) > monthly_income:
+            return jsonify({
+                "error": f"Expense would exceed monthly income. Remaining budget: {monthly_income - monthly_expenses:.2f} ฿"
+            }, 400)
+
+    try:
+        await add_expense(
+            uid,
+            data["category"],
+            data["amount"],
+            data["date"],
+            data.get("description", ""),
+            data.get("time", None)
+        )
+    except KeyError:
+        return jsonify({"error": "Bad request"}, 400)
+    return jsonify({"success": True})
+
+@require_auth
+async def expenses(request):
+    uid = request.state.uid
+
+    # Without paging parameters return the full list, as the dashboard expects
+    if not any(param in request.query_params for param in ("limit", "cursor", "order_by")):
+        sync_token = get_sync_token()
+        if wants_ndjson(request):
+            return StreamingResponse(ndjson_lines(iter_expenses(uid)), media_type="application/x-ndjson",
+                                     headers={"X-Sync-Token": sync_token})
+        return jsonify(await get_expenses(uid), headers={"X-Sync-Token": sync_token})
+
+    try:
+        limit = int(request.query_params.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}, 400)
+    limit = max(1, min(limit, 500))
+
+    try:
+        page, next_cursor = await get_expenses_page(
+            uid,
+            limit=limit,
+            cursor=request.query_params.get("cursor") or None,
+            order_by=request.query_params.get("order_by", "datetime")
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}, 400)
+    return jsonify({"expenses": page, "next_cursor": next_cursor})
+
+@require_auth
+async def delete_expense_route(request):
+    """Delete an expense"""
+    uid = request.state.uid
+
+    data = await _json_body(request) if request.headers.get("content-type", "").startswith("application/json") else None
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request must be JSON"}, 400)
+
+    expense_id = data.get("expense_id")
+    if not expense_id:
+        return jsonify({"error": "Expense ID required"}, 400)
+
+    result = await delete_expense(uid, expense_id)
+    if result.get("success"):
+        return jsonify({"success": True, "message": "Expense deleted successfully"})
+    return jsonify({"error": result.get("error", "Failed to delete expense")}, 400)
+
+@require_auth
+async def categories(request):
+    """Get all categories for the user"""
+    return jsonify({"categories": await get_categories(request.state.uid)})
+
+@require_auth
+async def analyze(request):
+    """Get expense analysis (?full=1 recomputes it from every expense)"""
+    return jsonify(await get_analysis(request.state.uid, full=request.query_params.get("full") == "1"))
+
+@asynccontextmanager
+async def lifespan(app):
+    # Each uvicorn worker builds its Firestore clients before taking requests
+    start_prewarm()
+    if os.getenv("STORAGE_BACKEND", "firestore").lower() == "firestore":
+        from firebase_config import warm_up
+        await run_in_threadpool(warm_up, async_client=True)
+    yield
+
+async def internal_error(request, exc):
+    return jsonify({"error": "Internal server error"}, 500)
+
+app = Starlette(
+    routes=[
+        Route("/add_expense", add_expense_route, methods=["POST"]),
+        Route("/expenses", expenses, methods=["GET"]),
+        Route("/delete_expense", delete_expense_route, methods=["POST"]),
+        Route("/categories", categories, methods=["GET"]),
+        Route("/analyze", analyze, methods=["GET"]),
+        # Everything else (pages, login, chatbot, bulk and search endpoints)
+        Mount("/", app=WSGIMiddleware(flask_app, workers=WSGI_BRIDGE_WORKERS))
+    ],
+    exception_handlers={500: internal_error},
+    lifespan=lifespan
+)
@@ -0,0 +1,150 @@
+import asyncio
+import user_cache
+from analysis_service import analyze_expenses, analyze_state, to_expense_frame
+from analysis_state import AnalysisState
+from repository import get_async_repository, ExpenseRow
+from database_service import get_local_time, get_data_version, build_expense, merge_categories
+from database_service import ANALYSIS_SNAPSHOTS, SYNC_OVERLAP_MS
+
+# Coroutine versions of the database_service functions on the ASGI request path. The
+# caches are user_cache's, shared with database_service, so both entry points see the
+# same data; only the storage I/O differs.
+
+async def _check_cached(uid):
+    """Drop a user's cached data if another worker has changed it, as in database_service._check_cached"""
+    check = user_cache.start_check(uid)
+    if check is not None:
+        started, checked_at = check
+        since = checked_at - SYNC_OVERLAP_MS
+        user_cache.finish_check(uid, started, since, await get_async_repository().get_changed_ids(uid, since))
+
+async def get_monthly_aggregate(uid, month=None):
+    """Get a user's aggregate for a "YYYY-MM" month (default: the current month)"""
+    month = month or get_local_time().strftime("%Y-%m")
+    return await get_async_repository().get_monthly_aggregate(uid, month)
+
+async def add_expense(uid, category, amount, date, description="", time=None):
+    expense = build_expense(uid, category, amount, date, description, time)
+    expense_id = await get_async_repository().add_expense(expense)
+    user_cache.record_add(uid, dict(expense, id=expense_id))
+
+async def get_expenses(uid, start=None, end=None, category=None):
+    """Get a user's expenses, filtered and cached as in database_service.get_expenses"""
+    await _check_cached(uid)
+    start = user_cache.date_bound(start)
+    end = user_cache.date_bound(end)
+
+    cached = user_cache.cached_expenses(uid, start, end, category)
+    if cached is not None:
+        return cached
+
+    version = get_data_version(uid)
+    expenses = await get_async_repository().get_expenses(uid, start=start, end=end, category=category)
+
+    # Only complete histories are cached
+    if start is None and end is None and category is None:
+        user_cache.store_expenses(uid, expenses, version)
+    return list(expenses)
+
+async def iter_expenses(uid, start=None, end=None):
+    """Yield a user's expenses as they are read, as in database_service.iter_expenses"""
+    await _check_cached(uid)
+    start = user_cache.date_bound(start)
+    end = user_cache.date_bound(end)
+
+    cached = user_cache.cached_expenses(uid, start, end)
+    if cached is not None:
+        for expense in cached:
+            yield expense
+        return
+    async for expense in get_async_repository().iter_expenses(uid, start=start, end=end):
+        yield expense
+
+async def get_expense_rows(uid, start=None, end=None, category=None):
+    """Get a user's expenses as ExpenseRow tuples, as in database_service.get_expense_rows"""
+    await _check_cached(uid)
+    if user_cache.has_cached_expenses(uid):
+        return [ExpenseRow.from_expense(e) for e in await get_expenses(uid, start, end, category)]
+    return await get_async_repository().get_expense_rows(
+        uid, start=user_cache.date_bound(start), end=user_cache.date_bound(end), category=category)
+
+async def get_analysis_state(uid):
+    """Get a user's AnalysisState, as in database_service.get_analysis_state"""
+    await _check_cached(uid)
+    state = user_cache.cached_state(uid)
+    if state is None:
+        version = get_data_version(uid)
+        expenses = await get_expense_rows(uid)
+        state = await asyncio.to_thread(AnalysisState.from_expenses, expenses)
+        user_cache.store_state(uid, version, state)
+    return state
+
+async def _snapshot_analysis(uid, key):
+    if not ANALYSIS_SNAPSHOTS:
+        return None
+    repository = get_async_repository()
+    snapshot = await repository.get_analysis_snapshot(uid)
+    if not user_cache.snapshot_for_today(snapshot, key):
+        return None
+    if await repository.has_changes(uid, snapshot["as_of"] - SYNC_OVERLAP_MS):
+        return None
+    return user_cache.use_snapshot(uid, key, snapshot)
+
+async def get_analysis(uid, full=False):
+    """
+    Get a user's analysis, cached and derived as in database_service.get_analysis.
+    The computation runs in a worker thread.
+    """
+    await _check_cached(uid)
+    key = user_cache.analysis_key(uid)
+    analysis = None if full else user_cache.cached_analysis(uid, key)
+    if analysis is not None:
+        return analysis
+
+    if full:
+        monthly_aggregate = await get_monthly_aggregate(uid)
+        expenses = await get_expense_rows(uid)
+        # pandas work is CPU-bound, keep it off the event loop
+        frame = await asyncio.to_thread(to_expense_frame, expenses)
+        analysis = await asyncio.to_thread(analyze_expenses, frame, uid, monthly_aggregate=monthly_aggregate)
+        user_cache.store_state(uid, key[0], await asyncio.to_thread(AnalysisState.from_expenses, frame))
+    else:
+        if not user_cache.has_state(uid):
+            analysis = await _snapshot_analysis(uid, key)
+        if analysis is None:
+            state = await get_analysis_state(uid)
+            monthly_aggregate = await get_monthly_aggregate(uid)
+            analysis = await asyncio.to_thread(analyze_state, state, uid, monthly_aggregate=monthly_aggregate)
+    user_cache.store_analysis(uid, key, analysis)
+    return analysis
+
+async def get_expenses_page(uid, limit=50, cursor=None, order_by="datetime"):
+    """
+    Get one page of a user's expenses, newest first, as in database_service.get_expenses_page.
+    Raises ValueError for an unsupported order or bad cursor.
+    """
+    if order_by != "datetime":
+        raise ValueError(f"Unsupported order_by: {order_by}")
+    after = user_cache.decode_cursor(cursor) if cursor else None
+
+    await _check_cached(uid)
+    page = user_cache.cached_page(uid, limit, after)
+    if page is not None:
+        return page
+    return user_cache.finish_page(await get_async_repository().get_expenses_page(uid, limit + 1, after=after), limit)
+
+async def delete_expense(uid, expense_id):
+    """Delete an expense by document ID"""
+    result = await get_async_repository().delete_expense(uid, expense_id)
+    if not result["success"]:
+        return result
+    user_cache.record_delete(uid, expense_id, result.get("expense"))
+    return {"success": True}
+
+async def get_categories(uid):
+    """Get all categories (default + custom) for a user"""
+    custom = user_cache.cached_categories(uid)
+    if custom is None:
+        custom = await get_async_repository().get_custom_categories(uid)
+        user_cache.store_categories(uid, custom)
+    return merge_categories(custom)
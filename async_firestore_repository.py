@@ -0,0 +1,89 @@
+from google.cloud import firestore
+from firestore_repository import FirestoreStore, doc_to_expense
+from repository import ExpenseRow, ROW_FIELDS, month_key, empty_aggregate, apply_to_aggregate
+from repository import record_to_snapshot
+
+class AsyncFirestoreRepository(FirestoreStore):
+    """
+    Coroutine versions of the FirestoreRepository operations used on the ASGI request
+    path, on a Firestore AsyncClient. Same data layout and semantics as FirestoreRepository.
+    """
+
+    @property
+    def db(self):
+        # Without an explicit client, use the current process's (rebuilt after fork)
+        if self._db is not None:
+            return self._db
+        from firebase_config import get_async_db
+        return get_async_db()
+
+    async def _read_aggregate(self, uid, month, transaction=None):
+        """Read a monthly aggregate, building it from that month's expenses if it does not exist yet"""
+        snapshot = await self._aggregate_ref(uid, month).get(transaction=transaction)
+        if snapshot.exists:
+            return snapshot.to_dict()
+
+        aggregate = empty_aggregate(uid, month)
+        async for doc in self._month_query(uid, month).stream(transaction=transaction):
+            apply_to_aggregate(aggregate, doc.to_dict())
+        return aggregate
+
+    async def add_expense(self, expense):
+        @firestore.async_transactional
+        async def add(transaction, expense_ref):
+            aggregate = await self._read_aggregate(expense["uid"], month_key(expense), transaction)
+            self._write_add(transaction, expense_ref, expense, aggregate)
+
+        expense_ref = self.db.collection("expenses").document()
+        await add(self.db.transaction(), expense_ref)
+        return expense_ref.id
+
+    async def get_expenses(self, uid, start=None, end=None, category=None):
+        return [doc_to_expense(doc) async for doc in self._range_query(uid, start, end, category).stream()]
+
+    async def iter_expenses(self, uid, start=None, end=None):
+        async for doc in self._range_query(uid, start, end).stream():
+            yield doc_to_expense(doc)
+
+    async def get_expense_rows(self, uid, start=None, end=None, category=None):
+        query = self._range_query(uid, start, end, category).select(list(ROW_FIELDS))
+        return [ExpenseRow.from_expense(doc.to_dict()) async for doc in query.stream()]
+
+    async def get_expenses_page(self, uid, limit, after=None):
+        return [doc_to_expense(doc) async for doc in self._page_query(uid, limit, after).stream()]
+
+    async def delete_expense(self, uid, expense_id):
+        @firestore.async_transactional
+        async def delete(transaction, expense_ref):
+            expense_doc = await expense_ref.get(transaction=transaction)
+            error = self._check_delete(uid, expense_doc)
+            if error:
+                return error
+
+            expense_data = expense_doc.to_dict()
+            aggregate = await self._read_aggregate(uid, month_key(expense_data), transaction)
+            return self._write_delete(transaction, uid, expense_ref, expense_data, aggregate)
+
+        return await delete(self.db.transaction(), self.db.collection("expenses").document(expense_id))
+
+    async def get_monthly_aggregate(self, uid, month):
+        return await self._read_aggregate(uid, month)
+
+    async def get_custom_categories(self, uid):
+        category_doc = await self.db.collection("user_categories").document(uid).get()
+        if category_doc.exists:
+            return category_doc.to_dict().get("categories", [])
+        return []
+
+    async def has_changes(self, uid, since):
+        for query in self._change_queries(uid, since):
+            async for _ in query.select([]).limit(1).stream():
+                return True
+        return False
+
+    async def get_changed_ids(self, uid, since):
+        return {doc.id for query in self._change_queries(uid, since) async for doc in query.select([]).stream()}
+
+    async def get_analysis_snapshot(self, uid):
+        doc = await self.db.collection("analysis_snapshots").document(uid).get()
+        return record_to_snapshot(doc.to_dict()) if doc.exists else None
@@ -1,10 +1,52 @@
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), 'cpe101finalproject'))
-from firebase_config import auth
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from cache_service import LRUCache
+from database_service import user_exists
+
+# Resolved tokens: sha256(token) -> uid. Entries for Firebase ID tokens expire with
+# the token's `exp` claim; uid tokens are re-checked against Firestore after AUTH_CACHE_TTL.
+# Bare uids from logins before session tokens are accepted only with ALLOW_UID_TOKENS=1:
+# uids appear in API responses, so anyone who has seen one could use it as a token.
+ALLOW_UID_TOKENS = os.getenv("ALLOW_UID_TOKENS", "0") == "1"
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "600"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "4096"))
+_token_cache = LRUCache(max_entries=AUTH_CACHE_SIZE, default_ttl=AUTH_CACHE_TTL)
+
+# Recently rejected tokens: sha256(token) -> True, so stale tokens from polling clients
+# are refused without another Firestore read or certificate check.
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "60"))
+_rejected_tokens = LRUCache(max_entries=AUTH_CACHE_SIZE, default_ttl=NEGATIVE_CACHE_TTL)
+
+# Per-IP token buckets for failed authentications. Each 401 spends one token; once a
+# client runs dry, only tokens that can be checked in-process are considered.
+AUTH_FAILURE_BURST = float(os.getenv("AUTH_FAILURE_BURST", "10"))
+AUTH_FAILURE_RATE = float(os.getenv("AUTH_FAILURE_RATE", "0.2"))  # tokens per second
+_failure_buckets = LRUCache(max_entries=10000, default_ttl=600)
+_failure_lock = threading.Lock()
+
+# Session tokens issued by /login: "s1.<kid>.<payload>.<signature>", HMAC-SHA256 signed.
+# SESSION_SECRET_KEYS is a comma-separated keyring of "kid:secret" pairs. The first key
+# signs new tokens; the others are still accepted so keys can be rotated without logging
+# everyone out. In Firestore mode the keyring may be left unset and a key is derived from
+# the service account; otherwise it is required, since every worker and restart must
+# verify the same tokens. SESSION_EPHEMERAL_KEY=1 allows a random key for a single local
+# process instead.
+SESSION_TOKEN_PREFIX = "s1"
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+_session_keys = None
 
 def register_user(email, password):
     try:
+        from firebase_config import get_auth
+        auth = get_auth()
         user = auth.create_user(
             email=email,
             password=password
@@ -27,8 +69,10 @@ def register_user(email, password):
 
 def login_user(id_token):
     try:
+        from firebase_config import get_auth
+        auth = get_auth()
         decoded = auth.verify_id_token(id_token)
-        return {"success": True, "uid": decoded["uid"]}
+        return {"success": True, "uid": decoded["uid"], "token": issue_session_token(decoded["uid"])}
     except Exception as e:
         error_msg = str(e)
         
@@ -42,7 +86,175 @@ def login_user(id_token):
 
 def verify_token(id_token):
     try:
+        from firebase_config import get_auth
+        auth = get_auth()
         decoded = auth.verify_id_token(id_token)
         return decoded["uid"]
     except:
         return None
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _load_session_keys():
+    """Load the signing keyring as an ordered list of (kid, key) pairs"""
+    keys = []
+    for entry in os.getenv("SESSION_SECRET_KEYS", "").split(","):
+        kid, sep, secret = entry.strip().partition(":")
+        if sep and kid and secret:
+            keys.append((kid, secret.encode("utf-8")))
+    if keys:
+        return keys
+    
+    if os.getenv("SESSION_EPHEMERAL_KEY") == "1":
+        print("Warning: SESSION_SECRET_KEYS not set, using a random key (SESSION_EPHEMERAL_KEY=1). "
+              "Sessions are valid in this process only and end on restart.")
+        return [("tmp", secrets.token_bytes(32))]
+    if os.getenv("STORAGE_BACKEND", "firestore").lower() != "firestore":
+        raise RuntimeError("SESSION_SECRET_KEYS must be set (\"kid:secret\") when STORAGE_BACKEND is not firestore")
+    
+    # No keyring configured - derive a key from the service account, which every worker shares.
+    # RSA PKCS#1 v1.5 signatures are deterministic, so all workers arrive at the same key.
+    try:
+        from firebase_config import get_credentials
+        cred = get_credentials()
+        derived = hashlib.sha256(cred.signer.sign(b"session-token-key")).digest()
+    except Exception as e:
+        raise RuntimeError(f"SESSION_SECRET_KEYS is not set and no session key can be derived "
+                           f"from the service account ({e})") from e
+    return [("sa", derived)]
+
+def _get_session_keys():
+    global _session_keys
+    if _session_keys is None:
+        _session_keys = _load_session_keys()
+    return _session_keys
+
+def init_session_keys():
+    """
+    Load the session keyring at startup (before gunicorn forks workers), so a missing
+    SESSION_SECRET_KEYS fails the app instead of its first login. Raises RuntimeError.
+    A key derived from the service account is left for first use, as Firebase is.
+    """
+    if os.getenv("SESSION_SECRET_KEYS") or os.getenv("STORAGE_BACKEND", "firestore").lower() != "firestore":
+        _get_session_keys()
+
+def _sign(key, message):
+    return _b64encode(hmac.new(key, message.encode("ascii"), hashlib.sha256).digest())
+
+def issue_session_token(uid, ttl=None):
+    """Issue a signed session token for a uid"""
+    kid, key = _get_session_keys()[0]
+    payload = _b64encode(json.dumps({"uid": uid, "exp": int(time.time()) + (ttl or SESSION_TTL)},
+                                    separators=(",", ":")).encode("utf-8"))
+    message = f"{SESSION_TOKEN_PREFIX}.{kid}.{payload}"
+    return f"{message}.{_sign(key, message)}"
+
+def verify_session_token(token):
+    """Verify a session token locally. Returns the uid, or None if invalid or expired."""
+    # Tokens we issue are ASCII; other characters cannot be signed or compared
+    if not token.isascii():
+        return None
+    try:
+        prefix, kid, payload, signature = token.split(".")
+    except ValueError:
+        return None
+    if prefix != SESSION_TOKEN_PREFIX:
+        return None
+    
+    key = dict(_get_session_keys()).get(kid)
+    if key is None:
+        return None
+    if not hmac.compare_digest(signature, _sign(key, f"{prefix}.{kid}.{payload}")):
+        return None
+    
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims.get("exp", 0) <= time.time():
+        return None
+    return claims.get("uid")
+
+def is_session_token(token):
+    return token.startswith(SESSION_TOKEN_PREFIX + ".")
+
+def hash_token(token):
+    """Hash a token so raw credentials are never kept as cache keys"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def resolve_uid(token, allow_lookup=True):
+    """
+    Resolve an Authorization header value to a uid.
+    Accepts a session token (verified locally), a Firebase ID token, or (with
+    ALLOW_UID_TOKENS) a bare uid from older logins. Successful lookups are cached, so repeat requests skip
+    Firestore and signature checks; rejected tokens are cached for NEGATIVE_CACHE_TTL.
+    With allow_lookup=False only in-process checks are made.
+    Returns None if the token is invalid.
+    """
+    if not token:
+        return None
+    
+    if is_session_token(token):
+        return verify_session_token(token)
+    
+    token_hash = hash_token(token)
+    uid = _token_cache.get(token_hash)
+    if uid:
+        return uid
+    if not allow_lookup or _rejected_tokens.get(token_hash):
+        return None
+    
+    if ALLOW_UID_TOKENS:
+        # Check if token is uid
+        try:
+            is_uid = user_exists(token)
+        except Exception:
+            is_uid = False
+        if is_uid:
+            _token_cache.set(token_hash, token)
+            return token
+    
+    try:
+        from firebase_config import get_auth
+        auth = get_auth()
+        decoded = auth.verify_id_token(token)
+    except Exception:
+        _rejected_tokens.set(token_hash, True)
+        return None
+    
+    uid = decoded["uid"]
+    expires_at = decoded.get("exp")
+    if expires_at and expires_at > time.time():
+        _token_cache.set(token_hash, uid, expires_at=min(expires_at, time.time() + AUTH_CACHE_TTL))
+    return uid
+
+def _refill_bucket(client_ip):
+    """Get the failure bucket for a client, topped up for the time elapsed. Call with _failure_lock held."""
+    now = time.time()
+    bucket = _failure_buckets.get(client_ip)
+    if bucket is None:
+        bucket = [AUTH_FAILURE_BURST, now]
+        _failure_buckets.set(client_ip, bucket)
+    else:
+        bucket[0] = min(AUTH_FAILURE_BURST, bucket[0] + (now - bucket[1]) * AUTH_FAILURE_RATE)
+        bucket[1] = now
+    return bucket
+
+def is_auth_throttled(client_ip):
+    """Check if a client has used up its allowance of failed authentications"""
+    with _failure_lock:
+        return _refill_bucket(client_ip)[0] < 1
+
+def record_auth_failure(client_ip):
+    """Spend one token from a client's failure bucket"""
+    with _failure_lock:
+        bucket = _refill_bucket(client_ip)
+        bucket[0] = max(0.0, bucket[0] - 1)
+
+def get_auth_cache_stats():
+    """Get hit/miss counters for the token caches"""
+    return {"tokens": _token_cache.stats(), "rejected": _rejected_tokens.stats()}
@@ -0,0 +1,197 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Nightly batch analysis: computes every registered user's analysis in a pool of worker
+# processes and stores it in analysis_snapshots, which /analyze serves until the user's
+# data changes or the local date rolls over (database_service.get_analysis). Run it
+# after local midnight (UTC+7), e.g. from cron:
+#
+#     python batch_analysis.py --workers 4
+#
+# Each finished user is appended to a JSON-lines checkpoint file with its timings, so
+# an interrupted run resumes where it stopped when restarted on the same local date.
+
+def _load_env():
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+    if os.path.exists(env_path):
+        load_dotenv(env_path, override=True)
+
+# Like app.py, read .env before the settings below
+_load_env()
+
+BATCH_WORKERS = int(os.getenv("ANALYSIS_BATCH_WORKERS", str(os.cpu_count() or 1)))
+# Users queued per worker, which bounds how far the uid listing runs ahead
+BATCH_QUEUE_PER_WORKER = int(os.getenv("ANALYSIS_BATCH_QUEUE_PER_WORKER", "2"))
+BATCH_CHECKPOINT = os.getenv("ANALYSIS_BATCH_CHECKPOINT", "analysis_batch.jsonl")
+PROGRESS_INTERVAL = 10
+
+def _init_worker():
+    # Pay for the Firestore client and pandas once per worker, not on its first user
+    from analysis_service import prewarm
+    if os.getenv("STORAGE_BACKEND", "firestore").lower() == "firestore":
+        from firebase_config import warm_up
+        warm_up()
+    prewarm()
+
+def analyze_user(uid):
+    """Compute and store one user's snapshot (runs in a worker process). Returns its timings."""
+    from analysis_service import analyze_expenses, get_local_time, to_expense_frame
+    from analysis_state import AnalysisState
+    from repository import get_repository, now_ms
+
+    repository = get_repository()
+    started = time.perf_counter()
+    as_of = now_ms()
+    expenses = repository.get_expense_rows(uid)
+    local_time = get_local_time()
+    monthly_aggregate = repository.get_monthly_aggregate(uid, local_time.strftime("%Y-%m"))
+    read = time.perf_counter()
+
+    frame = to_expense_frame(expenses)
+    analysis = analyze_expenses(frame, uid, monthly_aggregate=monthly_aggregate)
+    state = AnalysisState.from_expenses(frame)
+    analyzed = time.perf_counter()
+
+    repository.save_analysis_snapshot(uid, {
+        "uid": uid,
+        "local_date": local_time.strftime("%Y-%m-%d"),
+        "as_of": as_of,
+        "analysis": analysis,
+        "state": state.to_dict()
+    })
+    written = time.perf_counter()
+    return {
+        "uid": uid,
+        "expenses": len(expenses),
+        "read_ms": round((read - started) * 1000, 1),
+        "analyze_ms": round((analyzed - read) * 1000, 1),
+        "write_ms": round((written - analyzed) * 1000, 1),
+        "total_ms": round((written - started) * 1000, 1)
+    }
+
+def _open_checkpoint(path, local_date, restart=False):
+    """
+    Open the checkpoint for appending. Returns (file, uids already done). A checkpoint
+    from another local date, or restart=True, starts a new run.
+    """
+    done = set()
+    if not restart and os.path.exists(path):
+        lines = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    lines.append(json.loads(line))
+                except ValueError:
+                    # A line cut short when the run was killed
+                    continue
+        if lines and lines[0].get("local_date") == local_date:
+            done = {line["uid"] for line in lines[1:] if "error" not in line}
+            return open(path, "a"), done
+    f = open(path, "w")
+    f.write(json.dumps({"local_date": local_date}) + "\n")
+    f.flush()
+    return f, done
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _report(results, failed, elapsed):
+    count = len(results)
+    rate = count / elapsed if elapsed else 0.0
+    expenses = sum(r["expenses"] for r in results)
+    print(f"Analyzed {count} users ({failed} failed) in {elapsed:.1f}s: "
+          f"{rate:.1f} users/s, {expenses / elapsed if elapsed else 0.0:.0f} expenses/s")
+    if not results:
+        return
+    for phase in ("read_ms", "analyze_ms", "write_ms", "total_ms"):
+        values = sorted(r[phase] for r in results)
+        print(f"  {phase}: p50 {_percentile(values, 0.5):.1f}  p95 {_percentile(values, 0.95):.1f}  max {values[-1]:.1f}")
+    slowest = sorted(results, key=lambda r: r["total_ms"], reverse=True)[:5]
+    print("  slowest: " + ", ".join(f"{r['uid']} ({r['total_ms']:.0f} ms, {r['expenses']} expenses)" for r in slowest))
+
+def run(workers=BATCH_WORKERS, checkpoint_path=BATCH_CHECKPOINT, restart=False, limit=None):
+    """Snapshot every registered user. Returns the number of users that failed."""
+    from analysis_service import get_local_time
+    from repository import get_repository
+
+    local_date = get_local_time().strftime("%Y-%m-%d")
+    checkpoint, done = _open_checkpoint(checkpoint_path, local_date, restart)
+    if done:
+        print(f"Resuming {local_date} run: {len(done)} users already done")
+
+    results = []
+    failed = 0
+    started = last_progress = time.perf_counter()
+
+    def record(future, uid):
+        nonlocal failed, last_progress
+        try:
+            result = future.result()
+            results.append(result)
+        except Exception as e:
+            failed += 1
+            result = {"uid": uid, "error": str(e)}
+            print(f"Error analyzing user {uid}: {e}")
+        checkpoint.write(json.dumps(result) + "\n")
+        checkpoint.flush()
+
+        now = time.perf_counter()
+        if now - last_progress >= PROGRESS_INTERVAL:
+            last_progress = now
+            print(f"  {len(results)} users done, {failed} failed, {len(results) / (now - started):.1f} users/s")
+
+    max_queued = workers * BATCH_QUEUE_PER_WORKER
+    pending = {}
+    try:
+        # Spawned, not forked: the parent already holds a Firestore gRPC client (from
+        # iter_user_ids), which must not be copied into children; _init_worker builds theirs
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            submitted = 0
+            for uid in get_repository().iter_user_ids():
+                if uid in done:
+                    continue
+                if limit is not None and submitted >= limit:
+                    break
+                while len(pending) >= max_queued:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(future, pending.pop(future))
+                pending[pool.submit(analyze_user, uid)] = uid
+                submitted += 1
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future, pending.pop(future))
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume from the checkpoint")
+        raise
+    finally:
+        checkpoint.close()
+
+    _report(results, failed, time.perf_counter() - started)
+    print(f"Per-user timings: {checkpoint_path}")
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute every user's analysis into analysis_snapshots")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="worker processes")
+    parser.add_argument("--checkpoint", default=BATCH_CHECKPOINT, help="JSON-lines checkpoint and per-user timings")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint for today")
+    parser.add_argument("--limit", type=int, help="stop after this many users")
+    args = parser.parse_args(argv)
+
+    failed = run(args.workers, args.checkpoint, args.restart, args.limit)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
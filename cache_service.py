@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+# In-process caches shared by the service modules
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with per-entry expiry.
+    Entries are evicted least-recently-used first once max_entries is reached (or the
+    summed entry weights exceed max_weight), and are treated as missing once their
+    expiry time has passed.
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=None, max_weight=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_weight = max_weight
+        self._data = OrderedDict()
+        self._weights = {}
+        self.weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Get a live value without touching LRU order or the hit/miss counters"""
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl=None, expires_at=None, weight=1):
+        """Store a value. expires_at (epoch seconds) wins over ttl, which wins over default_ttl."""
+        if expires_at is None:
+            ttl = ttl if ttl is not None else self.default_ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires_at)
+            self._weights[key] = weight
+            self.weight += weight
+            # Always keep the newest entry, even if it alone is over budget
+            while len(self._data) > 1 and (len(self._data) > self.max_entries or
+                                           (self.max_weight is not None and self.weight > self.max_weight)):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def replace(self, key, value, weight=None, weight_delta=0):
+        """
+        Swap the value of a live entry, keeping its expiry so repeated writes do not
+        extend how long it is served. weight sets the entry's new weight; without it the
+        old weight changes by weight_delta. Returns False if the entry is missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                return False
+            new_weight = weight if weight is not None else self._weights[key] + weight_delta
+            self.weight += new_weight - self._weights[key]
+            self._weights[key] = new_weight
+            self._data[key] = (value, entry[1])
+            self._data.move_to_end(key)
+            while len(self._data) > 1 and self.max_weight is not None and self.weight > self.max_weight:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+            return True
+
+    def _remove(self, key):
+        """Drop an entry. Call with the lock held."""
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.weight -= self._weights.pop(key)
+        return entry
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Get hit/miss counters and current size"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "weight": self.weight
+        }
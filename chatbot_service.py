@@ -8,6 +8,32 @@ def get_local_time():
     """Get current local time (UTC+7 for Thailand timezone)"""
     return datetime.now() + timedelta(hours=7)
 
+def get_period_range(time_period, now=None):
+    """
+    Get the (start, end) dates for a named time period; end is exclusive.
+    Returns (None, None) for all time.
+    """
+    now = now or get_local_time()
+    today = datetime(now.year, now.month, now.day)
+    this_week = today - timedelta(days=now.weekday())
+    this_month = datetime(now.year, now.month, 1)
+    
+    if time_period == "today":
+        return today, None
+    elif time_period == "yesterday":
+        return today - timedelta(days=1), today
+    elif time_period == "this_week":
+        return this_week, None
+    elif time_period == "last_week":
+        return this_week - timedelta(days=7), this_week
+    elif time_period == "this_month":
+        return this_month, None
+    elif time_period == "last_month":
+        if now.month == 1:
+            return datetime(now.year - 1, 12, 1), this_month
+        return datetime(now.year, now.month - 1, 1), this_month
+    return None, None
+
 def get_conversational_response(text, uid=None):
     """
     Handle conversational inputs like greetings, questions, and general chat.
@@ -286,8 +312,7 @@ def handle_total_spending_query(text, uid=None):
     
     if is_total_query:
         try:
-            from database_service import get_expenses
-            expenses = get_expenses(uid)
+            from database_service import get_expense_rows
             
             # Determine time period
             now = get_local_time()
@@ -314,54 +339,16 @@ def handle_total_spending_query(text, uid=None):
             total_income = 0
             total_expense = 0
             
-            today_start = None
-            if time_period == "today":
-                today_start = datetime(now.year, now.month, now.day)
-            elif time_period == "yesterday":
-                yesterday = now - timedelta(days=1)
-                today_start = datetime(yesterday.year, yesterday.month, yesterday.day)
-            elif time_period == "this_month":
-                today_start = datetime(now.year, now.month, 1)
-            elif time_period == "last_month":
-                if now.month == 1:
-                    today_start = datetime(now.year - 1, 12, 1)
-                else:
-                    today_start = datetime(now.year, now.month - 1, 1)
-            elif time_period == "this_week":
-                days_since_monday = now.weekday()
-                today_start = now - timedelta(days=days_since_monday)
-                today_start = datetime(today_start.year, today_start.month, today_start.day)
+            # Only the period's expenses are fetched
+            period_start, period_end = get_period_range(time_period, now)
+            expenses = get_expense_rows(uid, start=period_start, end=period_end)
             
             for expense in expenses:
                 amount = float(expense.get("amount", 0))
-                
-                # Check time period if specified
-                if today_start:
-                    try:
-                        expense_date_str = expense.get("datetime") or expense.get("date", "")
-                        if expense_date_str:
-                            if " " in expense_date_str:
-                                expense_date = datetime.strptime(expense_date_str.split()[0], "%Y-%m-%d")
-                            else:
-                                expense_date = datetime.strptime(expense_date_str, "%Y-%m-%d")
-                            
-                            if expense_date >= today_start:
-                                if amount >= 0:
-                                    total_income += amount
-                                else:
-                                    total_expense += abs(amount)
-                    except:
-                        # If date parsing fails, include it anyway
-                        if amount >= 0:
-                            total_income += amount
-                        else:
-                            total_expense += abs(amount)
+                if amount >= 0:
+                    total_income += amount
                 else:
-                    # All time
-                    if amount >= 0:
-                        total_income += amount
-                    else:
-                        total_expense += abs(amount)
+                    total_expense += abs(amount)
             
             balance = total_income - total_expense
             
@@ -416,9 +403,9 @@ def handle_pandas_analysis_query(text, uid=None):
         return None
     
     try:
-        from database_service import get_expenses
-        from analysis_service import get_average_spending, get_spending_trends, get_weekday_analysis, get_category_growth
-        expenses = get_expenses(uid)
+        from database_service import get_expense_rows
+        from analysis_service import get_average_spending, get_spending_trends, get_weekday_analysis, get_category_growth, ExpenseFrame
+        expenses = get_expense_rows(uid)
         
         if not expenses or len(expenses) == 0:
             # Return helpful message instead of None
@@ -429,6 +416,9 @@ def handle_pandas_analysis_query(text, uid=None):
                 }
             return None
         
+        # Parsed once and shared by every analysis below
+        expenses = ExpenseFrame(expenses)
+        
         # Average spending queries (expanded patterns)
         avg_patterns = [
             r'average (?:spending|spent|expense|expenses)',
@@ -718,8 +708,7 @@ def handle_category_spending_query(text, uid=None):
     # If we found a category, get the spending data
     if matched_category:
         try:
-            from database_service import get_expenses
-            expenses = get_expenses(uid)
+            from database_service import get_expense_rows
             
             # Determine time period
             now = get_local_time()
@@ -749,28 +738,9 @@ def handle_category_spending_query(text, uid=None):
             category_spending = 0
             category_count = 0
             
-            # Calculate spending for the category
-            today_start = None
-            if time_period == "today":
-                today_start = datetime(now.year, now.month, now.day)
-            elif time_period == "yesterday":
-                yesterday = now - timedelta(days=1)
-                today_start = datetime(yesterday.year, yesterday.month, yesterday.day)
-            elif time_period == "this_month":
-                today_start = datetime(now.year, now.month, 1)
-            elif time_period == "last_month":
-                if now.month == 1:
-                    today_start = datetime(now.year - 1, 12, 1)
-                else:
-                    today_start = datetime(now.year, now.month - 1, 1)
-            elif time_period == "this_week":
-                days_since_monday = now.weekday()
-                today_start = now - timedelta(days=days_since_monday)
-                today_start = datetime(today_start.year, today_start.month, today_start.day)
-            elif time_period == "last_week":
-                days_since_monday = now.weekday()
-                last_week_start = now - timedelta(days=days_since_monday + 7)
-                today_start = datetime(last_week_start.year, last_week_start.month, last_week_start.day)
+            # Calculate spending for the category over the period's expenses only
+            period_start, period_end = get_period_range(time_period, now)
+            expenses = get_expense_rows(uid, start=period_start, end=period_end, category=matched_category)
             
             for expense in expenses:
                 amount = float(expense.get("amount", 0))
@@ -778,27 +748,8 @@ def handle_category_spending_query(text, uid=None):
                 
                 # Only count expenses (negative amounts or expenses)
                 if amount < 0 and category == matched_category:
-                    # Check time period if specified
-                    if today_start:
-                        try:
-                            expense_date_str = expense.get("datetime") or expense.get("date", "")
-                            if expense_date_str:
-                                if " " in expense_date_str:
-                                    expense_date = datetime.strptime(expense_date_str.split()[0], "%Y-%m-%d")
-                                else:
-                                    expense_date = datetime.strptime(expense_date_str, "%Y-%m-%d")
-                                
-                                if expense_date >= today_start:
-                                    category_spending += abs(amount)
-                                    category_count += 1
-                        except:
-                            # If date parsing fails, include it anyway
-                            category_spending += abs(amount)
-                            category_count += 1
-                    else:
-                        # All time
-                        category_spending += abs(amount)
-                        category_count += 1
+                    category_spending += abs(amount)
+                    category_count += 1
             
             # Format response
             category_name = matched_category.capitalize()
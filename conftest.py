@@ -0,0 +1,37 @@
+import os
+import sys
+import uuid
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Tests run on SQLite with a fixed session keyring; nothing here talks to Firebase
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SESSION_SECRET_KEYS", "test:test-secret")
+
+@pytest.fixture
+def repository(tmp_path):
+    """A fresh SQLite repository installed as the storage backend for the test"""
+    import repository as repository_module
+    from sqlite_repository import SQLiteRepository
+
+    previous = repository_module._repository
+    repo = SQLiteRepository(str(tmp_path / "expenses.db"))
+    repository_module.set_repository(repo)
+    yield repo
+    repository_module.set_repository(previous)
+
+@pytest.fixture
+def uid():
+    # database_service caches per uid, so each test gets its own user
+    return f"user-{uuid.uuid4().hex}"
+
+def make_expense(uid, amount, category="food", date="2024-01-15", time="12:00:00", description=""):
+    return {
+        "uid": uid,
+        "amount": amount,
+        "category": category,
+        "date": date,
+        "datetime": f"{date} {time}",
+        "description": description
+    }
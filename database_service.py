@@ -1,14 +1,63 @@
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), 'cpe101finalproject'))
-from firebase_config import db
 from datetime import datetime, timedelta
+import user_cache
+from analysis_service import analyze_expenses, analyze_state, to_expense_frame
+from analysis_state import AnalysisState
+from repository import get_repository, ExpenseRow, now_ms, TOMBSTONE_RETENTION_DAYS
+from search_index import ExpenseSearchIndex, matches_text, sort_by_recency
+from search_query import parse_search_query, has_filters, matches_amount, matches_category
+
+# Per-user caches, data versions and write-through live in user_cache, shared with
+# async_database_service; this module does the storage reads and writes around them.
+
+# Read precomputed analysis from the analysis_snapshots written by batch_analysis.py
+ANALYSIS_SNAPSHOTS = os.getenv("ANALYSIS_SNAPSHOTS", "1") == "1"
 
 def get_local_time():
     """Get current local time (UTC+7 for Thailand timezone)"""
     return datetime.now() + timedelta(hours=7)
 
-def add_expense(uid, category, amount, date, description="", time=None):
+def get_data_version(uid):
+    """Get a value that changes whenever this process writes a user's data"""
+    return user_cache.get_data_version(uid)
+
+def invalidate_expense_cache(uid, added=(), removed=()):
+    """Drop a user's cached expenses after a bulk write (see user_cache.invalidate)"""
+    user_cache.invalidate(uid, added, removed)
+
+def _check_cached(uid):
+    """Drop a user's cached data if another worker has changed their expenses since it was last checked"""
+    check = user_cache.start_check(uid)
+    if check is not None:
+        started, checked_at = check
+        since = checked_at - SYNC_OVERLAP_MS
+        user_cache.finish_check(uid, started, since, get_repository().get_changed_ids(uid, since))
+
+def _get_search_index(uid):
+    _check_cached(uid)
+    index = user_cache.cached_search_index(uid)
+    if index is None:
+        version = get_data_version(uid)
+        index = ExpenseSearchIndex(get_expenses(uid))
+        user_cache.store_search_index(uid, index, version)
+    return index
+
+def get_expense_cache_stats():
+    """Get hit/miss/eviction counters for the expense cache"""
+    return user_cache.expense_cache_stats()
+
+def get_monthly_aggregate(uid, month=None):
+    """
+    Get a user's income, spend, count and per-category spend for a "YYYY-MM" month
+    (default: the current month) from a single aggregate document.
+    """
+    month = month or get_local_time().strftime("%Y-%m")
+    return get_repository().get_monthly_aggregate(uid, month)
+
+def build_expense(uid, category, amount, date, description="", time=None):
+    """Build the expense record that is stored"""
     # If time is provided, combine date and time into datetime string
     # Format: "YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DDTHH:MM:SS"
     if time:
@@ -21,90 +70,388 @@ def add_expense(uid, category, amount, date, description="", time=None):
         now = get_local_time()
         datetime_str = now.strftime("%Y-%m-%d %H:%M:%S")
     
-    expense = {
+    return {
         "uid": uid,
         "category": category,
         "amount": amount,
         "date": date,  # Keep date for backward compatibility
         "datetime": datetime_str,  # Store full datetime for sorting
         "description": description,
+        "updated_at": now_ms(),  # For delta sync (get_changes); restamped by the repository at commit
     }
-    db.collection("expenses").add(expense)
 
-def get_expenses(uid):
-    docs = db.collection("expenses") \
-             .where("uid", "==", uid) \
-             .stream()
+def add_expense(uid, category, amount, date, description="", time=None):
+    expense = build_expense(uid, category, amount, date, description, time)
+    # Write the expense and its monthly aggregate atomically
+    expense_id = get_repository().add_expense(expense)
+    user_cache.record_add(uid, dict(expense, id=expense_id))
 
-    expenses = []
-    for doc in docs:
-        expense_data = doc.to_dict()
-        expense_data['id'] = doc.id  # Include document ID
-        expenses.append(expense_data)
-    return expenses
+def validate_expense_item(item):
+    """
+    Validate one item of a bulk insert.
+    Returns (kwargs for build_expense, None) or (None, error message).
+    """
+    if not isinstance(item, dict):
+        return None, "Item must be an object"
+    missing = [field for field in ("category", "amount", "date") if item.get(field) in (None, "")]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+    if not isinstance(item["category"], str) or not item["category"].strip():
+        return None, "Category must be a non-empty string"
+    description = item.get("description")
+    if description is None:
+        description = ""
+    elif not isinstance(description, str):
+        return None, "Description must be a string"
+    try:
+        amount = float(item["amount"])
+    except (TypeError, ValueError):
+        return None, "Amount must be a number"
+    try:
+        datetime.strptime(str(item["date"]), "%Y-%m-%d")
+    except ValueError:
+        return None, "Date must be YYYY-MM-DD"
+    time = item.get("time")
+    if time:
+        try:
+            datetime.strptime(time if len(str(time).split(':')) == 3 else f"{time}:00", "%H:%M:%S")
+        except (TypeError, ValueError):
+            return None, "Time must be HH:MM or HH:MM:SS"
+    return {
+        "category": item["category"],
+        "amount": amount,
+        "date": str(item["date"]),
+        "description": description,
+        # Imported history without a time is placed at the start of its day rather than now
+        "time": time or "00:00:00"
+    }, None
 
-def delete_expense(uid, expense_id):
-    """Delete an expense by document ID"""
-    expense_ref = db.collection("expenses").document(expense_id)
-    expense_doc = expense_ref.get()
+def add_expenses(uid, items):
+    """
+    Add many expenses at once.
+    Items are validated in one pass, then written together (on Firestore, in parallel
+    batches of up to 500 writes that also increment the monthly aggregates of the
+    expenses they contain). Unlike /add_expense there is no budget check.
+    Returns one {"index", "success", "id" | "error"} result per item, in input order.
+    """
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        fields, error = validate_expense_item(item)
+        if error:
+            results[index] = {"index": index, "success": False, "error": error}
+        else:
+            valid.append((index, build_expense(uid, **fields)))
     
-    if not expense_doc.exists:
-        return {"success": False, "error": "Expense not found"}
+    outcome = get_repository().add_expenses(uid, [expense for _, expense in valid]) if valid else []
+    for (index, _), result in zip(valid, outcome):
+        if isinstance(result, Exception):
+            results[index] = {"index": index, "success": False, "error": f"Write failed: {result}"}
+        else:
+            results[index] = {"index": index, "success": True, "id": result}
     
-    expense_data = expense_doc.to_dict()
-    if expense_data.get("uid") != uid:
-        return {"success": False, "error": "Unauthorized"}
+    if valid:
+        invalidate_expense_cache(uid, added=[dict(expense, id=results[index]["id"])
+                                             for (index, expense) in valid if results[index]["success"]])
+    return results
+
+def delete_expenses(uid, expense_ids):
+    """
+    Delete many expenses by document ID.
+    Ownership is checked with batched reads before anything is deleted.
+    Returns one {"id", "success", "error"?} result per ID, in input order.
+    """
+    expense_ids = list(dict.fromkeys(expense_ids))  # Drop duplicates, keep order
+    repository = get_repository()
+    found = repository.get_expenses_by_ids(expense_ids)
+    errors = {}
+    owned = []
+    for expense_id in expense_ids:
+        if expense_id not in found:
+            errors[expense_id] = "Expense not found"
+        elif found[expense_id].get("uid") != uid:
+            errors[expense_id] = "Unauthorized"
+        else:
+            owned.append((expense_id, found[expense_id]))
     
-    expense_ref.delete()
+    deleted = repository.delete_expenses(uid, owned) if owned else set()
+    if owned:
+        invalidate_expense_cache(uid, removed=[expense for expense_id, expense in owned if expense_id in deleted])
+    results = []
+    for expense_id in expense_ids:
+        if expense_id in deleted:
+            results.append({"id": expense_id, "success": True})
+        else:
+            results.append({"id": expense_id, "success": False, "error": errors.get(expense_id, "Delete failed")})
+    return results
+
+def delete_expenses_matching(uid, start=None, end=None, category=None):
+    """
+    Delete all of a user's expenses in a date range (start inclusive, end exclusive)
+    and/or category. At least one filter is required.
+    Returns the number of expenses deleted.
+    """
+    start = _filter_date(start, "start")
+    end = _filter_date(end, "end")
+    if category == "":
+        category = None
+    if category is not None and not isinstance(category, str):
+        raise ValueError("category must be a string")
+    if start is None and end is None and category is None:
+        raise ValueError("At least one of start, end or category is required")
+    
+    repository = get_repository()
+    docs = [(expense["id"], expense) for expense in repository.get_expenses(uid, start=start, end=end, category=category)]
+    if not docs:
+        return 0
+    deleted = repository.delete_expenses(uid, docs)
+    invalidate_expense_cache(uid, removed=[expense for expense_id, expense in docs if expense_id in deleted])
+    return len(deleted)
+
+def _filter_date(value, name):
+    """
+    Validate a delete filter date bound: a date/datetime or a "YYYY-MM-DD" string,
+    returned as "YYYY-MM-DD"; None or "" means no bound. Raises ValueError otherwise.
+    """
+    if value is None or value == "":
+        return None
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d")
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be YYYY-MM-DD")
+
+def get_expenses(uid, start=None, end=None, category=None):
+    """
+    Get expenses for a user, optionally limited to a date range and/or one category.
+    start is inclusive and end exclusive, compared by day against the stored datetime,
+    and the filters are applied in the storage query so only matching expenses are read.
+    Served from the per-user cache when possible; the returned dicts are shared
+    with the cache and must not be modified.
+    """
+    _check_cached(uid)
+    start = user_cache.date_bound(start)
+    end = user_cache.date_bound(end)
+    
+    cached = user_cache.cached_expenses(uid, start, end, category)
+    if cached is not None:
+        return cached
+    
+    version = get_data_version(uid)
+    expenses = get_repository().get_expenses(uid, start=start, end=end, category=category)
+    
+    # Only complete histories are cached
+    if start is None and end is None and category is None:
+        user_cache.store_expenses(uid, expenses, version)
+    return list(expenses)
+
+def iter_expenses(uid, start=None, end=None):
+    """
+    Yield a user's expenses (filtered as in get_expenses) as they are read, without
+    building the whole list, for streaming responses. Uses the cached list if there is
+    one; otherwise streams from storage and leaves the cache alone.
+    """
+    _check_cached(uid)
+    start = user_cache.date_bound(start)
+    end = user_cache.date_bound(end)
+    
+    cached = user_cache.cached_expenses(uid, start, end)
+    if cached is not None:
+        return iter(cached)
+    return get_repository().iter_expenses(uid, start=start, end=end)
+
+def get_expense_rows(uid, start=None, end=None, category=None):
+    """
+    Get a user's expenses as ExpenseRow tuples (amount, category, date, datetime) for
+    callers that only aggregate them. Filters work as in get_expenses. When the user's
+    expenses are not cached, only those fields are read from storage.
+    """
+    _check_cached(uid)
+    if user_cache.has_cached_expenses(uid):
+        return [ExpenseRow.from_expense(e) for e in get_expenses(uid, start, end, category)]
+    return get_repository().get_expense_rows(
+        uid, start=user_cache.date_bound(start), end=user_cache.date_bound(end), category=category)
+
+def get_analysis_state(uid):
+    """Get a user's AnalysisState, building it from their expenses if it is not loaded"""
+    _check_cached(uid)
+    state = user_cache.cached_state(uid)
+    if state is None:
+        version = get_data_version(uid)
+        state = AnalysisState.from_expenses(get_expense_rows(uid))
+        user_cache.store_state(uid, version, state)
+    return state
+
+def _snapshot_analysis(uid, key):
+    """
+    The analysis in a user's batch snapshot if it was computed for today's local date
+    and nothing has changed since, else None
+    """
+    if not ANALYSIS_SNAPSHOTS:
+        return None
+    repository = get_repository()
+    snapshot = repository.get_analysis_snapshot(uid)
+    if not user_cache.snapshot_for_today(snapshot, key):
+        return None
+    # as_of was taken before the batch read, so any later write shows up as a change
+    if repository.has_changes(uid, snapshot["as_of"] - SYNC_OVERLAP_MS):
+        return None
+    return user_cache.use_snapshot(uid, key, snapshot)
+
+def get_analysis(uid, full=False):
+    """
+    Get a user's analysis (shared, treat as read-only), derived from their running
+    totals and recomputed only after their data changes or the local date rolls over.
+    A user whose totals are not loaded is served from their batch snapshot while it is
+    current. full=True runs analyze_expenses over every expense instead and rebuilds
+    the totals from the same rows (a repair if they have drifted).
+    """
+    _check_cached(uid)
+    key = user_cache.analysis_key(uid)
+    analysis = None if full else user_cache.cached_analysis(uid, key)
+    if analysis is not None:
+        return analysis
+    
+    if full:
+        # Parsed once for both
+        frame = to_expense_frame(get_expense_rows(uid))
+        analysis = analyze_expenses(frame, uid, monthly_aggregate=get_monthly_aggregate(uid))
+        user_cache.store_state(uid, key[0], AnalysisState.from_expenses(frame))
+    else:
+        if not user_cache.has_state(uid):
+            analysis = _snapshot_analysis(uid, key)
+        if analysis is None:
+            analysis = analyze_state(get_analysis_state(uid), uid, monthly_aggregate=get_monthly_aggregate(uid))
+    user_cache.store_analysis(uid, key, analysis)
+    return analysis
+
+def get_analysis_cache_stats():
+    """Get hit/miss/eviction counters for the analysis cache"""
+    return user_cache.analysis_cache_stats()
+
+# Delta sync: a sync token is a server time in epoch ms. Changes are read from
+# SYNC_OVERLAP_MS before it, so a write is not missed when it was stamped by a server
+# with a slightly slow clock, or stamped before it became visible. Repositories stamp
+# updated_at immediately before each commit (per transaction attempt or write batch),
+# so the overlap must exceed the clock skew between servers plus the latency of a
+# single commit, not the length of a whole bulk request. Clients apply changes by ID,
+# so repeats are harmless.
+SYNC_OVERLAP_MS = int(os.getenv("SYNC_OVERLAP_MS", "5000"))
+
+def get_sync_token():
+    """Get the sync token to hand out with a full expense list read now"""
+    # The list may come from the cache, last checked against storage up to
+    # CACHE_CHECK_INTERVAL_MS ago
+    return str(now_ms() - user_cache.CACHE_CHECK_INTERVAL_MS)
+
+def get_changes(uid, since):
+    """
+    Get what changed in a user's expenses since a sync token:
+    {"expenses": added expenses, "deleted": deleted IDs, "sync_token": token for the next call}.
+    Returns {"reset": True} when the token predates the kept tombstones and the client
+    must reload the full list. Raises ValueError for a malformed token.
+    """
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid sync token")
+    
+    now = now_ms()
+    if since < now - TOMBSTONE_RETENTION_DAYS * 86400 * 1000:
+        return {"reset": True}
+    expenses, deleted = get_repository().get_changes(uid, since - SYNC_OVERLAP_MS)
+    return {"expenses": expenses, "deleted": deleted, "sync_token": str(now)}
+
+def get_expenses_page(uid, limit=50, cursor=None, order_by="datetime"):
+    """
+    Get one page of a user's expenses, newest first.
+    Returns (expenses, next_cursor); next_cursor is None on the last page.
+    Pages are ordered by (datetime, ID) descending, which on Firestore needs the composite
+    index in firestore.indexes.json. Raises ValueError for an unsupported order or bad cursor.
+    """
+    if order_by != "datetime":
+        raise ValueError(f"Unsupported order_by: {order_by}")
+    after = user_cache.decode_cursor(cursor) if cursor else None
+    
+    _check_cached(uid)
+    page = user_cache.cached_page(uid, limit, after)
+    if page is not None:
+        return page
+    # Fetch one extra expense to know whether another page exists
+    return user_cache.finish_page(get_repository().get_expenses_page(uid, limit + 1, after=after), limit)
+
+def delete_expense(uid, expense_id):
+    """Delete an expense by document ID"""
+    result = get_repository().delete_expense(uid, expense_id)
+    if not result["success"]:
+        return result
+    user_cache.record_delete(uid, expense_id, result.get("expense"))
     return {"success": True}
 
 def add_category(uid, category_name):
-    """Add a custom category for a user"""
-    category_doc = db.collection("user_categories").document(uid).get()
-    if category_doc.exists:
-        categories = category_doc.to_dict().get("categories", [])
-        if category_name.lower() not in [c.lower() for c in categories]:
-            categories.append(category_name)
-            db.collection("user_categories").document(uid).update({"categories": categories})
-    else:
-        db.collection("user_categories").document(uid).set({"categories": [category_name]})
+    """Add a custom category for a user, unless one with the same name (ignoring case) exists"""
+    if category_name.lower() not in [c.lower() for c in _custom_categories(uid)]:
+        get_repository().add_category(uid, category_name)
+        user_cache.drop_categories(uid)
     return {"success": True, "category": category_name}
 
+def _custom_categories(uid):
+    custom = user_cache.cached_categories(uid)
+    if custom is None:
+        custom = get_repository().get_custom_categories(uid)
+        user_cache.store_categories(uid, custom)
+    return custom
+
+DEFAULT_CATEGORIES = ["food", "transport", "shopping", "entertainment", "bills", "health", "education", "salary", "bonus", "other"]
+
 def get_categories(uid):
     """Get all categories (default + custom) for a user"""
-    default_categories = ["food", "transport", "shopping", "entertainment", "bills", "health", "education", "salary", "bonus", "other"]
-    
-    category_doc = db.collection("user_categories").document(uid).get()
-    if category_doc.exists:
-        custom_categories = category_doc.to_dict().get("categories", [])
+    return merge_categories(_custom_categories(uid))
+
+def merge_categories(custom_categories):
+    default_categories = list(DEFAULT_CATEGORIES)
+    if custom_categories:
         # Combine and remove duplicates
-        all_categories = list(set(default_categories + custom_categories))
+        all_categories = list(set(default_categories + list(custom_categories)))
         return all_categories
     return default_categories
 
-def search_transactions(uid, query):
-    """Search transactions by category, description, or amount"""
-    # Get all expenses for the user
-    all_expenses = get_expenses(uid)
-    
-    if not query or not query.strip():
-        return all_expenses
-    
-    query_lower = query.strip().lower()
-    results = []
+def save_user(uid, email):
+    """Save user data used for email login"""
+    get_repository().save_user(uid, email)
+
+def find_user_by_email(email):
+    """Get the uid registered with an email, or None"""
+    return get_repository().find_user_by_email(email)
+
+def user_exists(uid):
+    return get_repository().user_exists(uid)
+
+def search_transactions(uid, query, prefix=False):
+    """
+    Search transactions, newest first. The query is free text matched against category,
+    description and amount, plus optional filters (see search_query), e.g.
+    category:food amount>100 date>=2024-01-01 before:2024-02-01 "coffee".
+    With prefix=True text matches words starting with it instead of any substring.
+    Text-only searches use the user's in-memory search index; filtered searches read
+    only the matching date range from storage and check the rest there (the category
+    filter ignores case, which the storage query cannot).
+    Raises ValueError for an invalid filter.
+    """
+    plan = parse_search_query(query)
+    phrases = plan["text"]
     
-    for expense in all_expenses:
-        # Search in category
-        category = str(expense.get("category", "")).lower()
-        # Search in description
-        description = str(expense.get("description", "")).lower()
-        # Search in amount (convert to string)
-        amount = str(expense.get("amount", ""))
-        
-        # Check if query matches any field
-        if (query_lower in category or 
-            query_lower in description or 
-            query_lower in amount):
-            results.append(expense)
+    if not has_filters(plan):
+        index = _get_search_index(uid)
+        if not phrases:
+            return index.search("")
+        results = index.search(phrases[0], prefix=prefix)
+        return [e for e in results if all(matches_text(e, p, prefix) for p in phrases[1:])]
     
-    return results
\ No newline at end of file
+    expenses = get_expenses(uid, start=plan["start"], end=plan["end"])
+    return sort_by_recency([
+        e for e in expenses
+        if matches_category(e, plan["category"]) and matches_amount(e, plan["amount"])
+        and all(matches_text(e, p, prefix) for p in phrases)
+    ])
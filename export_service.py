@@ -0,0 +1,123 @@
+import csv
+import io
+from datetime import datetime
+
+# Streaming exports of a user's transactions (GET /export). Both formats consume an
+# iterator of expenses and yield the file in chunks, so memory stays bounded by
+# EXPORT_BATCH_ROWS rather than the size of the history.
+
+EXPORT_COLUMNS = ("id", "date", "datetime", "category", "amount", "description")
+EXPORT_BATCH_ROWS = 5000
+
+def _batches(expenses, size=EXPORT_BATCH_ROWS):
+    batch = []
+    for expense in expenses:
+        batch.append(expense)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def csv_chunks(expenses):
+    """Yield a CSV file (header row first) of expenses, one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for batch in _batches(expenses):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([expense.get(column, "") for column in EXPORT_COLUMNS] for expense in batch)
+        yield buffer.getvalue()
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def _parse_datetime(value):
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+def _parse_amount(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class _ChunkSink:
+    """Write-only file object whose contents are taken out with drain() as they are written"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def parquet_schema():
+    """Typed columns, so readers get dates, timestamps, floats and categoricals without parsing strings"""
+    import pyarrow as pa
+    return pa.schema([
+        ("id", pa.string()),
+        ("date", pa.date32()),
+        ("datetime", pa.timestamp("s")),
+        ("category", pa.dictionary(pa.int32(), pa.string())),
+        ("amount", pa.float64()),
+        ("description", pa.string())
+    ])
+
+def parquet_chunks(expenses):
+    """
+    Yield a Parquet file of expenses, one row group per batch of rows.
+    Needs pyarrow; raises ImportError before yielding anything if it is missing.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+
+    def generate():
+        try:
+            for batch in _batches(expenses):
+                columns = {
+                    "id": [str(e.get("id", "")) for e in batch],
+                    "date": [_parse_date(e.get("date")) for e in batch],
+                    "datetime": [_parse_datetime(e.get("datetime")) for e in batch],
+                    "category": [e.get("category") for e in batch],
+                    "amount": [_parse_amount(e.get("amount")) for e in batch],
+                    "description": [e.get("description") for e in batch]
+                }
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
+    return generate()
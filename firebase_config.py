@@ -1,51 +1,143 @@
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
 import os
 import json
+import threading
 
-# Try to get Firebase credentials from environment variable first (for production/Render)
-# If not found, fall back to serviceAccountKey.json file (for local development)
-firebase_credentials = None
+# Firebase is set up on first use rather than at import, so importing the app never
+# opens a gRPC channel or fails on missing credentials. Clients are per process: a
+# forked worker (gunicorn --preload) drops the ones it inherited and builds its own,
+# since gRPC channels cannot be shared across fork. Call warm_up() after fork to pay
+# the setup before the first request (see gunicorn.conf.py).
 
-# Check for environment variable (used in Render/production)
-if os.getenv('FIREBASE_CREDENTIALS'):
-    try:
-        # Parse JSON from environment variable
-        firebase_credentials = json.loads(os.getenv('FIREBASE_CREDENTIALS'))
-    except json.JSONDecodeError:
-        print("Warning: FIREBASE_CREDENTIALS environment variable contains invalid JSON")
-        firebase_credentials = None
-
-# If no environment variable, try to load from file
-if firebase_credentials is None:
+_lock = threading.Lock()
+_cred = None
+_app = None
+_db = None
+_async_db = None
+
+def _load_credentials():
+    from firebase_admin import credentials
+
+    # Try to get Firebase credentials from environment variable first (for production/Render)
+    # If not found, fall back to serviceAccountKey.json file (for local development)
+    firebase_credentials = None
+
+    # Check for environment variable (used in Render/production)
+    if os.getenv('FIREBASE_CREDENTIALS'):
+        try:
+            # Parse JSON from environment variable
+            firebase_credentials = json.loads(os.getenv('FIREBASE_CREDENTIALS'))
+        except json.JSONDecodeError:
+            print("Warning: FIREBASE_CREDENTIALS environment variable contains invalid JSON")
+            firebase_credentials = None
+
+    if firebase_credentials is not None:
+        # Use credentials from environment variable
+        return credentials.Certificate(firebase_credentials)
+
+    # If no environment variable, try to load from file
     # Get the directory where this file is located
     current_dir = os.path.dirname(os.path.abspath(__file__))
     service_account_path = os.path.join(current_dir, "serviceAccountKey.json")
-    
+
     if os.path.exists(service_account_path):
         # Use file path directly
-        cred = credentials.Certificate(service_account_path)
-    else:
-        # File not found - try environment variable path
-        env_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-        if env_path and os.path.exists(env_path):
-            cred = credentials.Certificate(env_path)
-        else:
-            raise FileNotFoundError(
-                f"Firebase credentials not found. Please either:\n"
-                f"1. Set FIREBASE_CREDENTIALS environment variable with JSON content, or\n"
-                f"2. Place serviceAccountKey.json in the project root, or\n"
-                f"3. Set GOOGLE_APPLICATION_CREDENTIALS to the file path"
-            )
-else:
-    # Use credentials from environment variable
-    cred = credentials.Certificate(firebase_credentials)
-
-# Initialize Firebase Admin (only if not already initialized)
-try:
-    firebase_admin.initialize_app(cred)
-except ValueError:
-    # App already initialized, which is fine
-    pass
-
-db = firestore.client()
+        return credentials.Certificate(service_account_path)
+
+    # File not found - try environment variable path
+    env_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    if env_path and os.path.exists(env_path):
+        return credentials.Certificate(env_path)
+
+    raise FileNotFoundError(
+        f"Firebase credentials not found. Please either:\n"
+        f"1. Set FIREBASE_CREDENTIALS environment variable with JSON content, or\n"
+        f"2. Place serviceAccountKey.json in the project root, or\n"
+        f"3. Set GOOGLE_APPLICATION_CREDENTIALS to the file path"
+    )
+
+def get_credentials():
+    """Get the service account credentials. Raises FileNotFoundError if none are configured."""
+    global _cred
+    if _cred is None:
+        with _lock:
+            if _cred is None:
+                _cred = _load_credentials()
+    return _cred
+
+def get_app():
+    """Get the Firebase Admin app, initializing it on first use"""
+    global _app
+    if _app is None:
+        cred = get_credentials()
+        with _lock:
+            if _app is None:
+                import firebase_admin
+                try:
+                    _app = firebase_admin.initialize_app(cred)
+                except ValueError:
+                    # App already initialized, which is fine
+                    _app = firebase_admin.get_app()
+    return _app
+
+def get_db():
+    """Get this process's Firestore client"""
+    global _db
+    if _db is None:
+        app = get_app()
+        with _lock:
+            if _db is None:
+                # Not firestore.client(app): firebase_admin keeps that client on the app, across fork
+                from google.cloud.firestore import Client
+                _db = Client(project=app.project_id, credentials=get_credentials().get_credential())
+    return _db
+
+def get_async_db():
+    """Get this process's Firestore AsyncClient with the same credentials (used by the ASGI app)"""
+    global _async_db
+    if _async_db is None:
+        app = get_app()
+        with _lock:
+            if _async_db is None:
+                from google.cloud.firestore import AsyncClient
+                _async_db = AsyncClient(project=app.project_id, credentials=get_credentials().get_credential())
+    return _async_db
+
+def get_auth():
+    """Get the firebase_admin.auth module with the app initialized"""
+    get_app()
+    from firebase_admin import auth
+    return auth
+
+def warm_up(async_client=False):
+    """
+    Build the credentials, app and Firestore client now instead of on the first request.
+    Returns False (after printing a warning) if Firebase is not configured.
+    """
+    try:
+        get_db()
+        if async_client:
+            get_async_db()
+    except Exception as e:
+        print(f"Warning: Firebase warm-up failed ({e})")
+        return False
+    return True
+
+def _reset_clients_after_fork():
+    # The child's copies of the parent's channels are unusable; credentials and the app are plain data
+    global _lock, _db, _async_db
+    _lock = threading.Lock()
+    _db = None
+    _async_db = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+def __getattr__(name):
+    # Module attributes kept for older imports (from firebase_config import db)
+    if name == "db":
+        return get_db()
+    if name == "auth":
+        return get_auth()
+    if name == "cred":
+        return get_credentials()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
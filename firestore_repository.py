@@ -0,0 +1,346 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import firestore
+from google.cloud.firestore import Query
+from repository import ExpenseRepository, ExpenseRow, ROW_FIELDS, month_key, month_range, empty_aggregate, apply_to_aggregate, make_tombstone
+from repository import snapshot_to_record, record_to_snapshot, now_ms
+
+# Firestore allows at most 500 writes per batch
+BATCH_WRITE_LIMIT = 500
+BULK_WRITE_WORKERS = int(os.getenv("BULK_WRITE_WORKERS", "4"))
+# Page size when listing the users collection
+USER_PAGE_SIZE = 1000
+
+def _aggregate_increments(expenses, sign=1):
+    """
+    Sum a group of expenses into Increment transforms for a monthly aggregate,
+    so batches can update it without reading it first. sign=-1 removes them.
+    """
+    income = spend = 0.0
+    count = 0
+    categories = {}
+    for expense in expenses:
+        try:
+            amount = float(expense.get("amount", 0))
+        except (TypeError, ValueError):
+            continue
+        count += 1
+        if amount >= 0:
+            income += amount
+        else:
+            category = expense.get("category", "other")
+            categories[category] = categories.get(category, 0) + abs(amount)
+            spend += abs(amount)
+    return {
+        "income": firestore.Increment(sign * income),
+        "spend": firestore.Increment(sign * spend),
+        "count": firestore.Increment(sign * count),
+        "categories": {k: firestore.Increment(sign * v) for k, v in categories.items()}
+    }
+
+def _chunk_for_batches(entries, key, writes_per_entry=1):
+    """
+    Split entries into chunks that fit one write batch, counting writes_per_entry writes
+    per entry plus one aggregate update per distinct month in the chunk.
+    """
+    chunk, months = [], set()
+    for entry in entries:
+        month = key(entry)
+        if (len(chunk) + 1) * writes_per_entry + len(months | {month}) > BATCH_WRITE_LIMIT:
+            yield chunk
+            chunk, months = [], set()
+        chunk.append(entry)
+        months.add(month)
+    if chunk:
+        yield chunk
+
+def doc_to_expense(doc):
+    expense_data = doc.to_dict()
+    expense_data['id'] = doc.id  # Include document ID
+    return expense_data
+
+class FirestoreStore:
+    """
+    Document references, queries and transaction steps shared by FirestoreRepository and
+    AsyncFirestoreRepository; subclasses provide db and do the reads and commits.
+    """
+
+    def __init__(self, db=None):
+        self._db = db
+
+    def _aggregate_ref(self, uid, month):
+        return self.db.collection("monthly_aggregates").document(f"{uid}_{month}")
+
+    def _tombstone_ref(self, expense_id):
+        return self.db.collection("expense_tombstones").document(expense_id)
+
+    def _range_query(self, uid, start=None, end=None, category=None):
+        query = self.db.collection("expenses").where("uid", "==", uid)
+        if category is not None:
+            query = query.where("category", "==", category)
+        if start is not None:
+            query = query.where("datetime", ">=", start)
+        if end is not None:
+            query = query.where("datetime", "<", end)
+        return query
+
+    def _month_query(self, uid, month):
+        """The expenses a monthly aggregate is built from when it does not exist yet"""
+        start, end = month_range(month)
+        return self._range_query(uid, start, end)
+
+    def _page_query(self, uid, limit, after=None):
+        query = self.db.collection("expenses") \
+                  .where("uid", "==", uid) \
+                  .order_by("datetime", direction=Query.DESCENDING) \
+                  .order_by("__name__", direction=Query.DESCENDING)
+        if after:
+            query = query.start_after({"datetime": after[0], "__name__": after[1]})
+        return query.limit(limit)
+
+    def _change_queries(self, uid, since):
+        """(expenses updated after since, tombstones written after since)"""
+        updated = self.db.collection("expenses").where("uid", "==", uid).where("updated_at", ">", since)
+        deleted = self.db.collection("expense_tombstones").where("uid", "==", uid).where("deleted_at", ">", since)
+        return updated, deleted
+
+    def _write_add(self, transaction, expense_ref, expense, aggregate):
+        """Queue an add in its transaction, given the month's aggregate read in it"""
+        apply_to_aggregate(aggregate, expense)
+        # Stamped on every attempt, just before the commit
+        expense["updated_at"] = now_ms()
+        transaction.set(expense_ref, expense)
+        transaction.set(self._aggregate_ref(expense["uid"], month_key(expense)), aggregate)
+
+    @staticmethod
+    def _check_delete(uid, expense_doc):
+        """The error result for deleting expense_doc as uid, or None if it may be deleted"""
+        if not expense_doc.exists:
+            return {"success": False, "error": "Expense not found"}
+        if expense_doc.to_dict().get("uid") != uid:
+            return {"success": False, "error": "Unauthorized"}
+        return None
+
+    def _write_delete(self, transaction, uid, expense_ref, expense_data, aggregate):
+        """Queue a checked delete and its tombstone in its transaction. Returns the result."""
+        apply_to_aggregate(aggregate, expense_data, sign=-1)
+        transaction.delete(expense_ref)
+        transaction.set(self._tombstone_ref(expense_ref.id), make_tombstone(uid))
+        transaction.set(self._aggregate_ref(uid, month_key(expense_data)), aggregate)
+        return {"success": True, "expense": dict(expense_data, id=expense_ref.id)}
+
+class FirestoreRepository(FirestoreStore, ExpenseRepository):
+    """
+    Firestore storage. Expenses live in the expenses collection; each user's monthly
+    totals are kept in monthly_aggregates/{uid}_{YYYY-MM} and updated in the same
+    transaction or batch as the expenses they cover.
+    """
+
+    @property
+    def db(self):
+        # Without an explicit client, use the current process's (rebuilt after fork)
+        if self._db is not None:
+            return self._db
+        from firebase_config import get_db
+        return get_db()
+
+    def _read_aggregate(self, uid, month, transaction=None):
+        """
+        Read a monthly aggregate, building it from that month's expenses if it does not exist
+        yet (months written before aggregates were kept).
+        """
+        snapshot = self._aggregate_ref(uid, month).get(transaction=transaction)
+        if snapshot.exists:
+            return snapshot.to_dict()
+
+        aggregate = empty_aggregate(uid, month)
+        for doc in self._month_query(uid, month).stream(transaction=transaction):
+            apply_to_aggregate(aggregate, doc.to_dict())
+        return aggregate
+
+    def _ensure_aggregates(self, uid, months):
+        """Make sure aggregates exist before batches increment them"""
+        @firestore.transactional
+        def ensure(transaction, month):
+            ref = self._aggregate_ref(uid, month)
+            if not ref.get(transaction=transaction).exists:
+                transaction.set(ref, self._read_aggregate(uid, month, transaction))
+
+        for month in months:
+            ensure(self.db.transaction(), month)
+
+    def _commit_in_batches(self, uid, entries, write, sign, writes_per_entry=1):
+        """
+        Commit (key, expense) entries in parallel write batches. write(batch, key, expense)
+        adds the entry's writes (at most writes_per_entry) and returns its ID; each batch
+        also applies the entries to their monthly aggregates. Returns {key: ID or Exception}.
+        """
+        self._ensure_aggregates(uid, {month_key(expense) for _, expense in entries})
+
+        def commit_chunk(chunk):
+            batch = self.db.batch()
+            by_month = {}
+            ids = []
+            for key, expense in chunk:
+                ids.append(write(batch, key, expense))
+                by_month.setdefault(month_key(expense), []).append(expense)
+            for month, month_expenses in by_month.items():
+                batch.set(self._aggregate_ref(uid, month), _aggregate_increments(month_expenses, sign), merge=True)
+            batch.commit()
+            return ids
+
+        outcome = {}
+        chunks = list(_chunk_for_batches(entries, key=lambda entry: month_key(entry[1]), writes_per_entry=writes_per_entry))
+        with ThreadPoolExecutor(max_workers=BULK_WRITE_WORKERS) as executor:
+            futures = [(chunk, executor.submit(commit_chunk, chunk)) for chunk in chunks]
+            for chunk, future in futures:
+                try:
+                    for (key, _), expense_id in zip(chunk, future.result()):
+                        outcome[key] = expense_id
+                except Exception as e:
+                    for key, _ in chunk:
+                        outcome[key] = e
+        return outcome
+
+    def add_expense(self, expense):
+        @firestore.transactional
+        def add(transaction, expense_ref):
+            aggregate = self._read_aggregate(expense["uid"], month_key(expense), transaction)
+            self._write_add(transaction, expense_ref, expense, aggregate)
+
+        expense_ref = self.db.collection("expenses").document()
+        add(self.db.transaction(), expense_ref)
+        return expense_ref.id
+
+    def add_expenses(self, uid, expenses):
+        def write(batch, index, expense):
+            ref = self.db.collection("expenses").document()
+            # Written as its batch is built, just before that batch commits
+            expense["updated_at"] = now_ms()
+            batch.set(ref, expense)
+            return ref.id
+
+        outcome = self._commit_in_batches(uid, list(enumerate(expenses)), write, sign=1)
+        return [outcome[index] for index in range(len(expenses))]
+
+    def get_expenses(self, uid, start=None, end=None, category=None):
+        return [doc_to_expense(doc) for doc in self._range_query(uid, start, end, category).stream()]
+
+    def iter_expenses(self, uid, start=None, end=None):
+        for doc in self._range_query(uid, start, end).stream():
+            yield doc_to_expense(doc)
+
+    def get_expense_rows(self, uid, start=None, end=None, category=None):
+        # Projection query: only the selected fields are sent back
+        query = self._range_query(uid, start, end, category).select(list(ROW_FIELDS))
+        return [ExpenseRow.from_expense(doc.to_dict()) for doc in query.stream()]
+
+    def get_expenses_page(self, uid, limit, after=None):
+        return [doc_to_expense(doc) for doc in self._page_query(uid, limit, after).stream()]
+
+    def get_expenses_by_ids(self, expense_ids):
+        found = {}
+        for start in range(0, len(expense_ids), BATCH_WRITE_LIMIT):
+            refs = [self.db.collection("expenses").document(expense_id)
+                    for expense_id in expense_ids[start:start + BATCH_WRITE_LIMIT]]
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    found[doc.id] = doc_to_expense(doc)
+        return found
+
+    def delete_expense(self, uid, expense_id):
+        @firestore.transactional
+        def delete(transaction, expense_ref):
+            expense_doc = expense_ref.get(transaction=transaction)
+            error = self._check_delete(uid, expense_doc)
+            if error:
+                return error
+
+            expense_data = expense_doc.to_dict()
+            aggregate = self._read_aggregate(uid, month_key(expense_data), transaction)
+            return self._write_delete(transaction, uid, expense_ref, expense_data, aggregate)
+
+        return delete(self.db.transaction(), self.db.collection("expenses").document(expense_id))
+
+    def delete_expenses(self, uid, expenses):
+        def write(batch, expense_id, expense):
+            batch.delete(self.db.collection("expenses").document(expense_id))
+            batch.set(self._tombstone_ref(expense_id), make_tombstone(uid))
+            return expense_id
+
+        outcome = self._commit_in_batches(uid, list(expenses), write, sign=-1, writes_per_entry=2)
+        deleted = set()
+        for expense_id, result in outcome.items():
+            if isinstance(result, Exception):
+                print(f"Error deleting expense {expense_id}: {result}")
+            else:
+                deleted.add(expense_id)
+        return deleted
+
+    def get_changes(self, uid, since):
+        updated, deleted = self._change_queries(uid, since)
+        return [doc_to_expense(doc) for doc in updated.stream()], [doc.id for doc in deleted.stream()]
+
+    def has_changes(self, uid, since):
+        for query in self._change_queries(uid, since):
+            for _ in query.select([]).limit(1).stream():
+                return True
+        return False
+
+    def get_changed_ids(self, uid, since):
+        # Tombstones are keyed by the deleted expense's ID
+        return {doc.id for query in self._change_queries(uid, since) for doc in query.select([]).stream()}
+
+    def get_monthly_aggregate(self, uid, month):
+        return self._read_aggregate(uid, month)
+
+    def add_category(self, uid, category_name):
+        # One atomic write: concurrent adds cannot overwrite each other
+        self.db.collection("user_categories").document(uid).set(
+            {"categories": firestore.ArrayUnion([category_name])}, merge=True
+        )
+
+    def get_custom_categories(self, uid):
+        category_doc = self.db.collection("user_categories").document(uid).get()
+        if category_doc.exists:
+            return category_doc.to_dict().get("categories", [])
+        return []
+
+    def save_user(self, uid, email):
+        self.db.collection("users").document(uid).set({
+            "email": email,
+            "uid": uid
+        })
+
+    def find_user_by_email(self, email):
+        # Use where with positional arguments
+        query = self.db.collection("users").where("email", "==", email).limit(1).stream()
+        for doc in query:
+            return doc.id
+        return None
+
+    def user_exists(self, uid):
+        try:
+            return self.db.collection("users").document(uid).get().exists
+        except ValueError:
+            # Not a valid document ID (e.g. contains '/')
+            return False
+
+    def iter_user_ids(self):
+        # Paged by document ID, so a long listing is many short queries rather than one stream
+        query = self.db.collection("users").order_by("__name__").select([]).limit(USER_PAGE_SIZE)
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            for doc in page:
+                yield doc.id
+            if len(page) < USER_PAGE_SIZE:
+                return
+            last = page[-1]
+
+    def save_analysis_snapshot(self, uid, snapshot):
+        self.db.collection("analysis_snapshots").document(uid).set(snapshot_to_record(snapshot))
+
+    def get_analysis_snapshot(self, uid):
+        doc = self.db.collection("analysis_snapshots").document(uid).get()
+        return record_to_snapshot(doc.to_dict()) if doc.exists else None
@@ -0,0 +1,21 @@
+import os
+
+# gunicorn reads this file from the working directory (see the Procfile, app.yaml and Dockerfile).
+# Each worker imports the app itself, then builds its Firebase clients in post_fork
+# before it takes requests and starts the optional analysis pre-warm thread.
+# GUNICORN_PRELOAD=1 imports the app once in the master and forks it into the workers
+# instead (Firebase clients and SQLite connections are still made per process).
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+def post_fork(server, worker):
+    from analysis_service import start_prewarm
+    start_prewarm()
+
+    if os.getenv("STORAGE_BACKEND", "firestore").lower() != "firestore":
+        return
+    import time
+    from firebase_config import warm_up
+    started = time.perf_counter()
+    if warm_up():
+        server.log.info("Worker %s: Firestore client ready in %.2fs", worker.pid, time.perf_counter() - started)
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+# Storage backends for database_service.
+# STORAGE_BACKEND selects the engine: "firestore" (default) or "sqlite" (SQLITE_PATH).
+# get_async_repository() gives the same operations as coroutines for the ASGI app.
+
+def month_key(expense):
+    """Get the "YYYY-MM" month an expense is aggregated under (from its datetime)"""
+    return str(expense.get("datetime") or expense.get("date", ""))[:7]
+
+def month_range(month):
+    """Get the (start, end) day bounds for a "YYYY-MM" month; end is exclusive"""
+    year, mon = int(month[:4]), int(month[5:7])
+    end = f"{year + 1}-01-01" if mon == 12 else f"{year}-{mon + 1:02d}-01"
+    return f"{month}-01", end
+
+def empty_aggregate(uid, month):
+    return {"uid": uid, "month": month, "income": 0.0, "spend": 0.0, "count": 0, "categories": {}}
+
+def apply_to_aggregate(aggregate, expense, sign=1):
+    """Add (sign=1) or remove (sign=-1) one expense from a monthly aggregate in place"""
+    try:
+        amount = float(expense.get("amount", 0))
+    except (TypeError, ValueError):
+        return aggregate
+    aggregate["count"] += sign
+    if amount >= 0:
+        aggregate["income"] = round(aggregate["income"] + sign * amount, 2)
+    else:
+        category = expense.get("category", "other")
+        categories = aggregate["categories"]
+        categories[category] = round(categories.get(category, 0) + sign * abs(amount), 2)
+        if sign < 0 and categories[category] <= 0:
+            del categories[category]
+        aggregate["spend"] = round(aggregate["spend"] + sign * abs(amount), 2)
+    return aggregate
+
+# Deleted expenses leave a tombstone for delta sync; tombstones older than this are
+# purged (on Firestore, by a TTL policy on expire_at)
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+def now_ms():
+    """Current time in epoch milliseconds, the unit of updated_at and sync tokens"""
+    return int(time.time() * 1000)
+
+def make_tombstone(uid):
+    """Build the record a deleted expense leaves behind"""
+    return {
+        "uid": uid,
+        "deleted_at": now_ms(),
+        "expire_at": datetime.now(timezone.utc) + timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    }
+
+def snapshot_to_record(snapshot):
+    """
+    Flatten an analysis snapshot for storage: analysis and state are stored as JSON text,
+    one opaque field each, so Firestore does not index every key inside them
+    """
+    record = dict(snapshot)
+    record["analysis"] = json.dumps(snapshot["analysis"])
+    record["state"] = json.dumps(snapshot.get("state"))
+    return record
+
+def record_to_snapshot(record):
+    """Inverse of snapshot_to_record"""
+    snapshot = dict(record)
+    snapshot["analysis"] = json.loads(record["analysis"])
+    snapshot["state"] = json.loads(record["state"]) if record.get("state") else None
+    return snapshot
+
+# Fields read by callers that only aggregate amounts (totals, budgets, analysis)
+ROW_FIELDS = ("amount", "category", "date", "datetime")
+
+class ExpenseRow(namedtuple("ExpenseRow", ROW_FIELDS)):
+    """
+    An expense projected to ROW_FIELDS. Supports expense.get(field, default) like the
+    full expense dicts, so aggregate code can take either; missing fields are None.
+    """
+    __slots__ = ()
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in ROW_FIELDS else None
+        return default if value is None else value
+
+    @classmethod
+    def from_expense(cls, expense):
+        return cls(*(expense.get(field) for field in ROW_FIELDS))
+
+class ExpenseRepository(ABC):
+    """
+    Storage operations behind database_service.
+    Expenses are dicts with uid, category, amount, date, datetime, description and
+    updated_at (epoch ms); those returned by a repository also carry their ID under "id". Date bounds are
+    "YYYY-MM-DD" strings compared against datetime, start inclusive and end exclusive.
+    """
+
+    @abstractmethod
+    def add_expense(self, expense):
+        """
+        Store one expense and update its monthly aggregate atomically. Returns the new ID.
+        Sets expense["updated_at"] as close to the commit as the backend allows, so delta
+        sync does not skip a write that took long to commit (see SYNC_OVERLAP_MS).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_expenses(self, uid, expenses):
+        """
+        Store many expenses, stamping updated_at per commit as add_expense does. Returns,
+        per expense in order, its new ID or the Exception that failed it.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expenses(self, uid, start=None, end=None, category=None):
+        """Get a user's expenses, optionally filtered by date range and category"""
+        raise NotImplementedError
+
+    def iter_expenses(self, uid, start=None, end=None):
+        """Like get_expenses, but yields expenses as storage returns them instead of building a list"""
+        return iter(self.get_expenses(uid, start, end))
+
+    def get_expense_rows(self, uid, start=None, end=None, category=None):
+        """Like get_expenses, but reads only ROW_FIELDS and returns ExpenseRow tuples"""
+        return [ExpenseRow.from_expense(e) for e in self.get_expenses(uid, start, end, category)]
+
+    @abstractmethod
+    def get_expenses_page(self, uid, limit, after=None):
+        """
+        Get up to limit expenses ordered by (datetime, id) descending, starting after the
+        (datetime, id) pair in after
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expenses_by_ids(self, expense_ids):
+        """Get {id: expense} for the IDs that exist, whatever their owner"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_expense(self, uid, expense_id):
+        """
+        Delete one of a user's expenses, updating its monthly aggregate and leaving a tombstone atomically.
+        Returns {"success": True, "expense": the deleted expense} or {"success": False, "error"}.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_expenses(self, uid, expenses):
+        """
+        Delete (id, expense) pairs already checked to belong to uid, leaving tombstones.
+        Returns the set of IDs deleted.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_changes(self, uid, since):
+        """
+        Get (expenses updated after since, IDs of expenses deleted after since), with since
+        in epoch ms
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_monthly_aggregate(self, uid, month):
+        """Get income, spend, count and per-category spend for a "YYYY-MM" month"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_category(self, uid, category_name):
+        """
+        Add a custom category; an exact duplicate is ignored. database_service checks for
+        names that differ only in case first.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_custom_categories(self, uid):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_user(self, uid, email):
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_user_by_email(self, email):
+        """Get the uid registered with an email, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_exists(self, uid):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_user_ids(self):
+        """Yield every registered uid, in ID order"""
+        raise NotImplementedError
+
+    def has_changes(self, uid, since):
+        """Whether any of a user's expenses was added or deleted after since (epoch ms)"""
+        updated, deleted = self.get_changes(uid, since)
+        return bool(updated or deleted)
+
+    def get_changed_ids(self, uid, since):
+        """IDs of a user's expenses added or deleted after since (epoch ms), as a set"""
+        updated, deleted = self.get_changes(uid, since)
+        return {e["id"] for e in updated} | set(deleted)
+
+    @abstractmethod
+    def save_analysis_snapshot(self, uid, snapshot):
+        """
+        Store a user's precomputed analysis, replacing the previous one. A snapshot is
+        {"uid", "local_date", "as_of" (epoch ms before the expenses were read),
+        "analysis", "state" (AnalysisState.to_dict() or None)}.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_analysis_snapshot(self, uid):
+        """Get the snapshot stored by save_analysis_snapshot, or None"""
+        raise NotImplementedError
+
+_repository = None
+_repository_lock = threading.Lock()
+
+def get_repository():
+    """Get the configured storage backend, creating it on first use"""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                backend = os.getenv("STORAGE_BACKEND", "firestore").lower()
+                if backend == "sqlite":
+                    from sqlite_repository import SQLiteRepository
+                    _repository = SQLiteRepository(os.getenv("SQLITE_PATH", "expenses.db"))
+                elif backend == "firestore":
+                    from firestore_repository import FirestoreRepository
+                    _repository = FirestoreRepository()
+                else:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    return _repository
+
+def set_repository(repository):
+    """Replace the storage backend (e.g. for benchmarks)"""
+    global _repository
+    _repository = repository
+
+class ThreadedRepository:
+    """Async wrapper running a synchronous repository's methods in worker threads"""
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+    async def iter_expenses(self, uid, start=None, end=None):
+        # A sync iterator can be tied to the thread that opened it (SQLite connections
+        # are), so the expenses are read in one call
+        for expense in await asyncio.to_thread(self.repository.get_expenses, uid, start, end):
+            yield expense
+
+_async_repository = None
+_async_repository_lock = threading.Lock()
+
+def get_async_repository():
+    """
+    Get the configured storage backend with coroutine methods: Firestore uses its
+    AsyncClient, other backends run in worker threads.
+    """
+    global _async_repository
+    if _async_repository is None:
+        with _async_repository_lock:
+            if _async_repository is None:
+                if os.getenv("STORAGE_BACKEND", "firestore").lower() == "firestore":
+                    from async_firestore_repository import AsyncFirestoreRepository
+                    _async_repository = AsyncFirestoreRepository()
+                else:
+                    _async_repository = ThreadedRepository(get_repository())
+    return _async_repository
+
+def set_async_repository(repository):
+    """Replace the async storage backend (e.g. for benchmarks)"""
+    global _async_repository
+    _async_repository = repository
@@ -0,0 +1,132 @@
+import threading
+
+# In-memory inverted index over a user's transactions, used by search_transactions
+
+# Approximate bytes per posting and per indexed transaction, for the cache memory budget
+_POSTING_BYTES = 80
+_DOC_BYTES = 400
+
+def _field_texts(expense):
+    """Get the searchable texts of an expense: category, description and amount"""
+    return (
+        str(expense.get("category", "")).lower(),
+        str(expense.get("description", "")).lower(),
+        str(expense.get("amount", ""))
+    )
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _recency_key(expense):
+    return (str(expense.get("datetime") or expense.get("date") or ""), str(expense.get("id", "")))
+
+def sort_by_recency(expenses):
+    """Sort expenses newest first"""
+    return sorted(expenses, key=_recency_key, reverse=True)
+
+def matches_text(expense, query, prefix=False):
+    """
+    Check whether an expense's category, description or amount contains a lowercase
+    query (or, with prefix=True, has a word starting with it)
+    """
+    texts = _field_texts(expense)
+    if prefix:
+        return any(word.startswith(query) for text in texts for word in text.split())
+    return any(query in text for text in texts)
+
+class ExpenseSearchIndex:
+    """
+    Token and trigram index over one user's transactions.
+    Tokens are the whitespace-separated words of each field; trigrams are taken within
+    each field. Lookups narrow the candidates with the index and then confirm each one
+    with the same substring test a full scan would use, so results match a scan.
+    """
+
+    def __init__(self, expenses=()):
+        self._docs = {}
+        self._tokens = {}
+        self._trigrams = {}
+        self.postings = 0
+        self._lock = threading.Lock()
+        for expense in expenses:
+            self._add(expense)
+
+    def _keys(self, expense):
+        tokens, trigrams = set(), set()
+        for text in _field_texts(expense):
+            tokens.update(text.split())
+            trigrams.update(_trigrams(text))
+        return tokens, trigrams
+
+    def _add(self, expense):
+        expense_id = expense.get("id")
+        if expense_id is None:
+            return
+        if expense_id in self._docs:
+            self._remove(expense_id)
+        self._docs[expense_id] = expense
+        tokens, trigrams = self._keys(expense)
+        for index, keys in ((self._tokens, tokens), (self._trigrams, trigrams)):
+            for key in keys:
+                index.setdefault(key, set()).add(expense_id)
+        self.postings += len(tokens) + len(trigrams)
+
+    def _remove(self, expense_id):
+        expense = self._docs.pop(expense_id, None)
+        if expense is None:
+            return
+        tokens, trigrams = self._keys(expense)
+        for index, keys in ((self._tokens, tokens), (self._trigrams, trigrams)):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(expense_id)
+                    if not ids:
+                        del index[key]
+        self.postings -= len(tokens) + len(trigrams)
+
+    def add(self, expense):
+        with self._lock:
+            self._add(expense)
+
+    def remove(self, expense_id):
+        with self._lock:
+            self._remove(expense_id)
+
+    def weight(self):
+        """Estimated memory use in bytes"""
+        return self.postings * _POSTING_BYTES + len(self._docs) * _DOC_BYTES
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _candidates(self, query, prefix):
+        if prefix:
+            return set().union(*[ids for token, ids in self._tokens.items() if token.startswith(query)])
+        if len(query) >= 3:
+            # A field containing the query contains all of its trigrams
+            postings = sorted((self._trigrams.get(t, set()) for t in _trigrams(query)), key=len)
+            return set.intersection(*postings) if postings else set()
+        if any(c.isspace() for c in query):
+            # A short query containing whitespace can span tokens
+            return set(self._docs)
+        # A field containing a short query has a token containing it
+        return set().union(*[ids for token, ids in self._tokens.items() if query in token])
+
+    def search(self, query, prefix=False, limit=None):
+        """
+        Find transactions whose category, description or amount contains the query
+        (or, with prefix=True, has a word starting with it), newest first.
+        """
+        query = query.strip().lower()
+        with self._lock:
+            if not query:
+                matches = list(self._docs.values())
+            else:
+                matches = []
+                for expense_id in self._candidates(query, prefix):
+                    expense = self._docs[expense_id]
+                    if matches_text(expense, query, prefix):
+                        matches.append(expense)
+        matches = sort_by_recency(matches)
+        return matches[:limit] if limit is not None else matches
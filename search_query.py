@@ -0,0 +1,116 @@
+import re
+from datetime import datetime, timedelta
+
+# Filter language for /search_transactions, e.g.
+#   category:food amount>100 date>=2024-01-01 before:2024-02-01 "coffee"
+# date filters are pushed down to the storage query; the category (ignoring case),
+# amount filters and text are applied to the narrowed set.
+
+_TOKEN = re.compile(r'(\w+)(>=|<=|:|=|>|<)("[^"]*"|\S+)|"([^"]*)"|(\S+)')
+
+_AMOUNT_OPS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "=": lambda a, b: a == b,
+    ":": lambda a, b: a == b
+}
+
+def _parse_day(value, token):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Invalid date in filter {token} (use YYYY-MM-DD)")
+
+def _day(value):
+    return value.strftime("%Y-%m-%d")
+
+def _narrow(plan, start=None, end=None):
+    """Intersect the plan's date range with [start, end)"""
+    if start is not None and (plan["start"] is None or start > plan["start"]):
+        plan["start"] = start
+    if end is not None and (plan["end"] is None or end < plan["end"]):
+        plan["end"] = end
+
+def parse_search_query(query):
+    """
+    Compile a search string into a plan:
+    {"category", "start", "end", "amount": [(op, value)], "text": [phrases]}
+    start/end are "YYYY-MM-DD" bounds (start inclusive, end exclusive). Each quoted
+    string is a phrase; the remaining free words form one phrase. category and text are
+    lowercased. Words that are not recognized filters (e.g. "12:30") are free text.
+    Raises ValueError for bad values.
+    """
+    plan = {"category": None, "start": None, "end": None, "amount": [], "text": []}
+    words = []
+
+    for match in _TOKEN.finditer(query or ""):
+        key, op, value, quoted, word = match.groups()
+        token = match.group(0)
+        if quoted is not None:
+            if quoted.strip():
+                plan["text"].append(quoted.strip().lower())
+            continue
+        if word is not None:
+            words.append(word)
+            continue
+
+        key = key.lower()
+        if value.startswith('"') and value.endswith('"') and len(value) > 1:
+            value = value[1:-1]
+
+        if key == "category" and op in (":", "="):
+            value = value.lower()
+            if plan["category"] is not None and plan["category"] != value:
+                raise ValueError("Only one category filter is allowed")
+            plan["category"] = value
+        elif key == "amount" and op in _AMOUNT_OPS:
+            try:
+                plan["amount"].append((op, float(value)))
+            except ValueError:
+                raise ValueError(f"Invalid amount in filter {token}")
+        elif key == "date" and op in _AMOUNT_OPS:
+            day = _parse_day(value, token)
+            next_day = _day(day + timedelta(days=1))
+            if op in (":", "="):
+                _narrow(plan, start=_day(day), end=next_day)
+            elif op == ">":
+                _narrow(plan, start=next_day)
+            elif op == ">=":
+                _narrow(plan, start=_day(day))
+            elif op == "<":
+                _narrow(plan, end=_day(day))
+            else:
+                _narrow(plan, end=next_day)
+        elif key == "before" and op == ":":
+            _narrow(plan, end=_day(_parse_day(value, token)))
+        elif key == "after" and op == ":":
+            _narrow(plan, start=_day(_parse_day(value, token) + timedelta(days=1)))
+        else:
+            words.append(token)
+
+    if words:
+        plan["text"].append(" ".join(words).lower())
+    return plan
+
+def has_filters(plan):
+    """Check whether a plan narrows by anything other than text"""
+    return plan["category"] is not None or plan["start"] is not None or plan["end"] is not None or bool(plan["amount"])
+
+def matches_amount(expense, amount_filters):
+    """Check an expense's (signed) amount against [(op, value)] filters"""
+    if not amount_filters:
+        return True
+    try:
+        amount = float(expense.get("amount"))
+    except (TypeError, ValueError):
+        return False
+    return all(_AMOUNT_OPS[op](amount, value) for op, value in amount_filters)
+
+def matches_category(expense, category):
+    """Check an expense's category against a lowercased category filter (None matches all)"""
+    if category is None:
+        return True
+    value = expense.get("category")
+    return isinstance(value, str) and value.lower() == category
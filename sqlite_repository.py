@@ -0,0 +1,281 @@
+import os
+import sqlite3
+import threading
+import uuid
+from repository import ExpenseRepository, ExpenseRow, ROW_FIELDS, month_range, empty_aggregate, make_tombstone, TOMBSTONE_RETENTION_DAYS
+from repository import snapshot_to_record, record_to_snapshot, now_ms
+
+# SQLite limits the number of bound parameters per statement
+_MAX_PARAMS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    id TEXT PRIMARY KEY,
+    uid TEXT NOT NULL,
+    category TEXT,
+    amount REAL,
+    date TEXT,
+    datetime TEXT,
+    description TEXT,
+    updated_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_uid_date ON expenses (uid, datetime);
+CREATE INDEX IF NOT EXISTS idx_expenses_uid_category ON expenses (uid, category, datetime);
+CREATE TABLE IF NOT EXISTS expense_tombstones (
+    id TEXT PRIMARY KEY,
+    uid TEXT NOT NULL,
+    deleted_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tombstones_uid_deleted ON expense_tombstones (uid, deleted_at);
+CREATE TABLE IF NOT EXISTS user_categories (
+    uid TEXT NOT NULL,
+    category TEXT NOT NULL,
+    PRIMARY KEY (uid, category)
+);
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    email TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users (email);
+CREATE TABLE IF NOT EXISTS analysis_snapshots (
+    uid TEXT PRIMARY KEY,
+    local_date TEXT NOT NULL,
+    as_of INTEGER NOT NULL,
+    analysis TEXT NOT NULL,
+    state TEXT
+);
+"""
+
+# Run after _SCHEMA, once databases created before updated_at have the column
+_UPDATED_AT_INDEX = "CREATE INDEX IF NOT EXISTS idx_expenses_uid_updated ON expenses (uid, updated_at)"
+
+_EXPENSE_COLUMNS = ("uid", "category", "amount", "date", "datetime", "description", "updated_at")
+
+def _row_to_expense(row):
+    expense = {column: row[column] for column in _EXPENSE_COLUMNS}
+    expense["id"] = row["id"]
+    return expense
+
+class SQLiteRepository(ExpenseRepository):
+    """
+    Local SQLite storage for offline runs, benchmarks and single-node deployments.
+    Each thread gets its own connection to the database file (WAL mode), and a forked
+    process opens new ones rather than using its parent's. Monthly
+    aggregates are computed with an indexed range query rather than stored.
+    """
+
+    def __init__(self, path="expenses.db"):
+        self.path = path
+        self._local = threading.local()
+        self._pid = os.getpid()
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(expenses)")}
+        if "updated_at" not in columns:
+            connection.execute("ALTER TABLE expenses ADD COLUMN updated_at INTEGER")
+        connection.execute(_UPDATED_AT_INDEX)
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # SQLite connections cannot be shared across fork (gunicorn --preload, batch_analysis)
+            self._local = threading.local()
+            self._pid = os.getpid()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _insert(self, connection, expenses):
+        # Take the write lock first, so updated_at is stamped just before the commit
+        # rather than before a wait for another writer
+        if not connection.in_transaction:
+            connection.execute("BEGIN IMMEDIATE")
+        stamp = now_ms()
+        for expense in expenses:
+            expense["updated_at"] = stamp
+        ids = [uuid.uuid4().hex for _ in expenses]
+        connection.executemany(
+            f"INSERT INTO expenses (id, {', '.join(_EXPENSE_COLUMNS)}) VALUES ({', '.join('?' * (len(_EXPENSE_COLUMNS) + 1))})",
+            [(expense_id,) + tuple(expense.get(column) for column in _EXPENSE_COLUMNS)
+             for expense_id, expense in zip(ids, expenses)]
+        )
+        return ids
+
+    def add_expense(self, expense):
+        with self._connection() as connection:
+            return self._insert(connection, [expense])[0]
+
+    def add_expenses(self, uid, expenses):
+        try:
+            with self._connection() as connection:
+                return self._insert(connection, expenses)
+        except sqlite3.Error as e:
+            return [e] * len(expenses)
+
+    def _select(self, columns, uid, start=None, end=None, category=None):
+        sql = f"SELECT {columns} FROM expenses WHERE uid = ?"
+        params = [uid]
+        if category is not None:
+            sql += " AND category = ?"
+            params.append(category)
+        if start is not None:
+            sql += " AND datetime >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND datetime < ?"
+            params.append(end)
+        return self._connection().execute(sql, params)
+
+    def get_expenses(self, uid, start=None, end=None, category=None):
+        return [_row_to_expense(row) for row in self._select("*", uid, start, end, category)]
+
+    def iter_expenses(self, uid, start=None, end=None):
+        for row in self._select("*", uid, start, end):
+            yield _row_to_expense(row)
+
+    def get_expense_rows(self, uid, start=None, end=None, category=None):
+        rows = self._select(", ".join(ROW_FIELDS), uid, start, end, category)
+        return [ExpenseRow(*row) for row in rows]
+
+    def get_expenses_page(self, uid, limit, after=None):
+        sql = "SELECT * FROM expenses WHERE uid = ? AND datetime IS NOT NULL"
+        params = [uid]
+        if after:
+            sql += " AND (datetime, id) < (?, ?)"
+            params.extend(after)
+        sql += " ORDER BY datetime DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return [_row_to_expense(row) for row in self._connection().execute(sql, params)]
+
+    def get_expenses_by_ids(self, expense_ids):
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(expense_ids), _MAX_PARAMS):
+            chunk = expense_ids[start:start + _MAX_PARAMS]
+            sql = f"SELECT * FROM expenses WHERE id IN ({', '.join('?' * len(chunk))})"
+            for row in connection.execute(sql, chunk):
+                found[row["id"]] = _row_to_expense(row)
+        return found
+
+    def delete_expense(self, uid, expense_id):
+        with self._connection() as connection:
+            row = connection.execute("SELECT * FROM expenses WHERE id = ?", (expense_id,)).fetchone()
+            if row is None:
+                return {"success": False, "error": "Expense not found"}
+            if row["uid"] != uid:
+                return {"success": False, "error": "Unauthorized"}
+            connection.execute("DELETE FROM expenses WHERE id = ?", (expense_id,))
+            self._add_tombstones(connection, uid, [expense_id])
+        return {"success": True, "expense": _row_to_expense(row)}
+
+    def _add_tombstones(self, connection, uid, expense_ids):
+        tombstone = make_tombstone(uid)
+        connection.executemany(
+            "INSERT OR REPLACE INTO expense_tombstones (id, uid, deleted_at) VALUES (?, ?, ?)",
+            [(expense_id, uid, tombstone["deleted_at"]) for expense_id in expense_ids]
+        )
+        # Purge this user's expired tombstones
+        connection.execute(
+            "DELETE FROM expense_tombstones WHERE uid = ? AND deleted_at < ?",
+            (uid, tombstone["deleted_at"] - TOMBSTONE_RETENTION_DAYS * 86400 * 1000)
+        )
+
+    def delete_expenses(self, uid, expenses):
+        expense_ids = [expense_id for expense_id, _ in expenses]
+        deleted = set()
+        with self._connection() as connection:
+            # Hold the write lock from the SELECT, so the IDs found are the ones deleted
+            if not connection.in_transaction:
+                connection.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(expense_ids), _MAX_PARAMS):
+                chunk = expense_ids[start:start + _MAX_PARAMS]
+                params = [uid] + chunk
+                where = f"uid = ? AND id IN ({', '.join('?' * len(chunk))})"
+                found = [row["id"] for row in connection.execute(f"SELECT id FROM expenses WHERE {where}", params)]
+                if found:
+                    connection.execute(f"DELETE FROM expenses WHERE {where}", params)
+                    deleted.update(found)
+            if deleted:
+                self._add_tombstones(connection, uid, deleted)
+        return deleted
+
+    def get_changes(self, uid, since):
+        connection = self._connection()
+        updated = connection.execute("SELECT * FROM expenses WHERE uid = ? AND updated_at > ?", (uid, since))
+        deleted = connection.execute("SELECT id FROM expense_tombstones WHERE uid = ? AND deleted_at > ?", (uid, since))
+        return [_row_to_expense(row) for row in updated], [row["id"] for row in deleted]
+
+    def get_monthly_aggregate(self, uid, month):
+        start, end = month_range(month)
+        rows = self._connection().execute(
+            """SELECT category,
+                      SUM(CASE WHEN amount >= 0 THEN amount ELSE 0 END) AS income,
+                      SUM(CASE WHEN amount < 0 THEN -amount ELSE 0 END) AS spend,
+                      COUNT(*) AS count
+               FROM expenses
+               WHERE uid = ? AND datetime >= ? AND datetime < ? AND amount IS NOT NULL
+               GROUP BY category""",
+            (uid, start, end)
+        )
+        aggregate = empty_aggregate(uid, month)
+        for row in rows:
+            aggregate["income"] += row["income"]
+            aggregate["spend"] += row["spend"]
+            aggregate["count"] += row["count"]
+            if row["spend"] > 0:
+                aggregate["categories"][row["category"]] = round(row["spend"], 2)
+        aggregate["income"] = round(aggregate["income"], 2)
+        aggregate["spend"] = round(aggregate["spend"], 2)
+        return aggregate
+
+    def add_category(self, uid, category_name):
+        with self._connection() as connection:
+            existing = connection.execute(
+                "SELECT 1 FROM user_categories WHERE uid = ? AND lower(category) = lower(?)",
+                (uid, category_name)
+            ).fetchone()
+            if existing is None:
+                connection.execute("INSERT INTO user_categories (uid, category) VALUES (?, ?)", (uid, category_name))
+
+    def get_custom_categories(self, uid):
+        rows = self._connection().execute("SELECT category FROM user_categories WHERE uid = ? ORDER BY rowid", (uid,))
+        return [row["category"] for row in rows]
+
+    def save_user(self, uid, email):
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO users (uid, email) VALUES (?, ?)", (uid, email))
+
+    def find_user_by_email(self, email):
+        row = self._connection().execute("SELECT uid FROM users WHERE email = ? LIMIT 1", (email,)).fetchone()
+        return row["uid"] if row else None
+
+    def user_exists(self, uid):
+        return self._connection().execute("SELECT 1 FROM users WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def iter_user_ids(self):
+        for row in self._connection().execute("SELECT uid FROM users ORDER BY uid"):
+            yield row["uid"]
+
+    def has_changes(self, uid, since):
+        row = self._connection().execute(
+            """SELECT EXISTS (SELECT 1 FROM expenses WHERE uid = ? AND updated_at > ?)
+                   OR EXISTS (SELECT 1 FROM expense_tombstones WHERE uid = ? AND deleted_at > ?) AS changed""",
+            (uid, since, uid, since)
+        ).fetchone()
+        return bool(row["changed"])
+
+    def save_analysis_snapshot(self, uid, snapshot):
+        record = snapshot_to_record(snapshot)
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO analysis_snapshots (uid, local_date, as_of, analysis, state) VALUES (?, ?, ?, ?, ?)",
+                (uid, record["local_date"], record["as_of"], record["analysis"], record["state"])
+            )
+
+    def get_analysis_snapshot(self, uid):
+        row = self._connection().execute("SELECT * FROM analysis_snapshots WHERE uid = ?", (uid,)).fetchone()
+        return record_to_snapshot(dict(row)) if row else None
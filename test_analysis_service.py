@@ -0,0 +1,103 @@
+"""analyze_expenses against the per-row loop it replaced"""
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+import pytest
+from analysis_service import analyze_expenses, get_local_time, get_spending_trends
+from repository import ExpenseRow
+
+CATEGORIES = ["food", "transport", "shopping", "bills", "entertainment"]
+
+def make_history(seed, count=400, days=120):
+    """Random expenses over the last days, with amounts that do not add up exactly in floating point"""
+    rng = random.Random(seed)
+    today = get_local_time()
+    expenses = []
+    for _ in range(count):
+        date = (today - timedelta(days=rng.randrange(days))).strftime("%Y-%m-%d")
+        if rng.random() < 0.1:
+            amount = round(rng.uniform(100, 5000), 2)
+            category = "salary"
+        else:
+            amount = -round(rng.uniform(0.01, 300), 2)
+            category = rng.choice(CATEGORIES)
+        expenses.append({"uid": "u", "amount": amount, "category": category, "date": date,
+                         "datetime": f"{date} 12:00:00", "description": ""})
+    return expenses
+
+def reference_totals(expenses):
+    """The totals as the original per-row loop in analyze_expenses computed them"""
+    now = get_local_time()
+    current_month_start = datetime(now.year, now.month, 1)
+    total_income = total_expense = 0
+    category_totals = defaultdict(float)
+    current_month = []
+    for expense in expenses:
+        amount = float(expense.get("amount", 0))
+        try:
+            if datetime.strptime(expense.get("date", ""), "%Y-%m-%d") >= current_month_start:
+                current_month.append(amount)
+        except (TypeError, ValueError):
+            pass
+        if amount >= 0:
+            total_income += amount
+        else:
+            total_expense += abs(amount)
+            category_totals[expense.get("category", "other")] += abs(amount)
+    monthly_spent = sum(abs(a) for a in current_month if a < 0)
+    return total_income, total_expense, dict(category_totals), monthly_spent
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_totals_match_per_row_loop(seed):
+    expenses = make_history(seed)
+    total_income, total_expense, category_totals, monthly_spent = reference_totals(expenses)
+
+    result = analyze_expenses(expenses)
+
+    # Exact: the same sums in the same order, rounded as the result always was
+    assert result["total_income"] == round(total_income, 2)
+    assert result["total_spent"] == round(total_expense, 2)
+    assert result["balance"] == round(total_income - total_expense, 2)
+    assert list(result["categories"].items()) == [(c, round(amount, 2)) for c, amount in category_totals.items()]
+    assert result["percentages"] == {c: round(amount / total_expense * 100, 1) for c, amount in category_totals.items()}
+    top = max(category_totals.items(), key=lambda item: item[1])
+    assert result["most_spent_category"]["name"] == top[0]
+    assert result["most_spent_category"]["amount"] == round(top[1], 2)
+    assert result["monthly_stats"]["monthly_spent"] == round(monthly_spent, 2)
+
+def test_rows_and_dicts_give_the_same_analysis():
+    expenses = make_history(4)
+    rows = [ExpenseRow.from_expense(e) for e in expenses]
+    assert analyze_expenses(rows) == analyze_expenses(expenses)
+
+def test_monthly_aggregate_overrides_monthly_sums():
+    expenses = make_history(5)
+    result = analyze_expenses(expenses, monthly_aggregate={"spend": 123.0, "income": 456.0})
+    assert result["monthly_stats"]["monthly_spent"] == 123.0
+
+def test_missing_and_invalid_fields():
+    expenses = [
+        {"amount": -10, "category": None, "date": "2024-01-01"},
+        {"amount": -5, "date": "not a date"},
+        {"amount": None, "category": "food", "date": "2024-01-02"},
+        {"amount": 100, "category": "salary"}
+    ]
+    result = analyze_expenses(expenses)
+    assert result["total_spent"] == 15
+    assert result["total_income"] == 100
+    assert result["categories"] == {"other": 15}
+
+def test_no_expenses():
+    result = analyze_expenses([])
+    assert result["error"] == "No expenses found"
+    assert result["total_spent"] == 0
+
+def test_spending_trends_match_analysis():
+    expenses = make_history(4)
+    trend = get_spending_trends(expenses)
+    pandas_analysis = analyze_expenses(expenses)["pandas_analysis"]
+
+    assert trend["trend"] == pandas_analysis["spending_trend"]
+    assert trend["slope"] == pandas_analysis["trend_slope"]
+    assert trend["predicted_next_month"] == pandas_analysis["predicted_next_month"]
+    assert get_spending_trends(expenses[:1]) is None
@@ -0,0 +1,96 @@
+"""AnalysisState updates against a rebuild from the full expense list"""
+import random
+from datetime import timedelta
+import pytest
+from analysis_service import analyze_expenses, analyze_state, get_local_time, to_expense_frame
+from analysis_state import AnalysisState
+
+def make_history(seed, count=300, days=90):
+    """
+    Random expenses over the last days. Amounts are multiples of 0.25, which add up
+    exactly in any order, so incremental and rebuilt totals can be compared with ==.
+    """
+    rng = random.Random(seed)
+    today = get_local_time()
+    expenses = []
+    for i in range(count):
+        date = (today - timedelta(days=rng.randrange(days))).strftime("%Y-%m-%d")
+        if rng.random() < 0.1:
+            amount, category = rng.randrange(400, 20000) / 4, "salary"
+        else:
+            amount, category = -rng.randrange(1, 1200) / 4, rng.choice(["food", "transport", "bills", "fun"])
+        expenses.append({"id": str(i), "amount": amount, "category": category, "date": date})
+    return expenses
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_analysis_matches_full_recompute(seed):
+    expenses = make_history(seed)
+    assert analyze_state(AnalysisState.from_expenses(expenses)) == analyze_expenses(expenses)
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_updates_match_rebuild(seed):
+    rng = random.Random(seed)
+    expenses = make_history(seed)
+    current = expenses[:200]
+    state = AnalysisState.from_expenses(current)
+
+    # Interleave single applies/reverts with batched updates
+    for expense in expenses[200:250]:
+        state.apply(expense)
+        current.append(expense)
+    for expense in rng.sample(current, 40):
+        state.revert(expense)
+        current.remove(expense)
+    removed = rng.sample(current, 30)
+    state.update(added=expenses[250:], removed=removed)
+    current = [e for e in current if e not in removed] + expenses[250:]
+
+    rebuilt = AnalysisState.from_expenses(current)
+    assert state.to_dict() == rebuilt.to_dict()
+    assert analyze_state(state) == analyze_expenses(current)
+
+def test_revert_everything_leaves_empty_state():
+    expenses = make_history(4, count=50)
+    state = AnalysisState.from_expenses(expenses)
+    state.update(removed=expenses)
+
+    assert state.to_dict() == AnalysisState().to_dict()
+    assert analyze_state(state) == analyze_expenses([])
+
+def test_invalid_fields_match_full_recompute():
+    today = get_local_time().strftime("%Y-%m-%d")
+    expenses = [
+        {"amount": -10, "category": None, "date": today},
+        {"amount": -5, "category": "food", "date": "not a date"},
+        {"amount": None, "category": "food", "date": today},
+        {"amount": "12.5", "category": "salary", "date": today},
+        {"amount": -2.5, "category": "food"}
+    ]
+    state = AnalysisState.from_expenses(expenses)
+    assert analyze_state(state) == analyze_expenses(expenses)
+
+    state.revert(expenses[0])
+    assert state.to_dict() == AnalysisState.from_expenses(expenses[1:]).to_dict()
+
+def test_from_expenses_matches_apply():
+    rng = random.Random(6)
+    expenses = make_history(6)
+    for expense in rng.sample(expenses, 30):
+        expense.update(rng.choice([{"category": None}, {"date": "not a date"}, {"amount": None}, {"amount": "-7.5"}]))
+    applied = AnalysisState()
+    for expense in expenses:
+        applied.apply(expense)
+
+    built = AnalysisState.from_expenses(to_expense_frame(expenses))
+    assert built.to_dict() == applied.to_dict()
+    # Same insertion order too, which analyze_state sums in
+    assert list(built.categories) == list(applied.categories)
+    assert list(built.spend_days) == list(applied.spend_days)
+    assert AnalysisState.from_expenses([]).to_dict() == AnalysisState().to_dict()
+
+def test_round_trip():
+    state = AnalysisState.from_expenses(make_history(5, count=100))
+    restored = AnalysisState.from_dict(state.to_dict())
+    assert restored.to_dict() == state.to_dict()
+    with pytest.raises(ValueError):
+        AnalysisState.from_dict(dict(state.to_dict(), format=0))
@@ -0,0 +1,74 @@
+"""Session token issue, verification and key rotation"""
+import pytest
+import auth_service
+from auth_service import issue_session_token, verify_session_token, is_session_token
+
+@pytest.fixture
+def keyring(monkeypatch):
+    """Set SESSION_SECRET_KEYS and make the next token operation reload it"""
+    def use(value):
+        monkeypatch.setenv("SESSION_SECRET_KEYS", value)
+        monkeypatch.setattr(auth_service, "_session_keys", None)
+    monkeypatch.delenv("SESSION_EPHEMERAL_KEY", raising=False)
+    return use
+
+def test_issue_and_verify(keyring):
+    keyring("k1:first-secret")
+    token = issue_session_token("user-1")
+
+    assert is_session_token(token)
+    assert token.split(".")[1] == "k1"
+    assert verify_session_token(token) == "user-1"
+
+def test_rejects_tampered_tokens(keyring):
+    keyring("k1:first-secret")
+    prefix, kid, payload, signature = issue_session_token("user-1").split(".")
+    other_payload = issue_session_token("user-2").split(".")[2]
+
+    assert verify_session_token(f"{prefix}.{kid}.{other_payload}.{signature}") is None
+    assert verify_session_token(f"{prefix}.{kid}.{payload}.{signature[:-2]}xx") is None
+    assert verify_session_token(f"{prefix}.k9.{payload}.{signature}") is None
+    assert verify_session_token(f"s0.{kid}.{payload}.{signature}") is None
+    assert verify_session_token("not-a-token") is None
+    assert verify_session_token(f"{prefix}.{kid}.\xe9.x") is None
+    assert verify_session_token(f"{prefix}.{kid}.{payload}.{signature[:-1]}\xe9") is None
+    assert auth_service.resolve_uid(f"{prefix}.{kid}.\xe9.x") is None
+
+def test_rejects_expired_tokens(keyring):
+    keyring("k1:first-secret")
+    assert verify_session_token(issue_session_token("user-1", ttl=-1)) is None
+
+def test_rejects_tokens_signed_with_another_secret(keyring):
+    keyring("k1:first-secret")
+    token = issue_session_token("user-1")
+    keyring("k1:other-secret")
+    assert verify_session_token(token) is None
+
+def test_key_rotation(keyring):
+    keyring("k1:first-secret")
+    old_token = issue_session_token("user-1")
+
+    # New key first: new tokens are signed with it, old ones still verify
+    keyring("k2:second-secret,k1:first-secret")
+    new_token = issue_session_token("user-1")
+    assert new_token.split(".")[1] == "k2"
+    assert verify_session_token(old_token) == "user-1"
+    assert verify_session_token(new_token) == "user-1"
+
+    # Retiring the old key ends its sessions
+    keyring("k2:second-secret")
+    assert verify_session_token(old_token) is None
+    assert verify_session_token(new_token) == "user-1"
+
+def test_missing_keyring_fails_outside_firestore(keyring, monkeypatch):
+    keyring("")
+    monkeypatch.setenv("STORAGE_BACKEND", "sqlite")
+    with pytest.raises(RuntimeError):
+        auth_service.init_session_keys()
+
+def test_ephemeral_key_opt_in(keyring, monkeypatch):
+    keyring("")
+    monkeypatch.setenv("STORAGE_BACKEND", "sqlite")
+    monkeypatch.setenv("SESSION_EPHEMERAL_KEY", "1")
+    auth_service.init_session_keys()
+    assert verify_session_token(issue_session_token("user-1")) == "user-1"
@@ -0,0 +1,119 @@
+"""Cursor paging, filtered search and bulk add validation in database_service"""
+import pytest
+import database_service
+import user_cache
+from conftest import make_expense
+
+def _add_history(repository, uid):
+    # Two expenses share a datetime, so the ID has to break the tie
+    times = [("2024-01-01", "09:00:00"), ("2024-01-02", "09:00:00"), ("2024-01-02", "09:00:00"),
+             ("2024-01-03", "18:30:00"), ("2024-01-05", "07:15:00"), ("2024-01-04", "12:00:00"),
+             ("2024-01-06", "20:00:00")]
+    for i, (date, time) in enumerate(times):
+        repository.add_expense(make_expense(uid, -(i + 1), date=date, time=time))
+    expenses = repository.get_expenses(uid)
+    return [e["id"] for e in sorted(expenses, key=lambda e: (e["datetime"], e["id"]), reverse=True)]
+
+def _all_pages(uid, limit):
+    pages, cursor = [], None
+    while True:
+        page, cursor = database_service.get_expenses_page(uid, limit=limit, cursor=cursor)
+        pages.append([e["id"] for e in page])
+        if cursor is None:
+            return pages
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 50])
+def test_pages_from_storage(repository, uid, limit):
+    expected = _add_history(repository, uid)
+
+    pages = _all_pages(uid, limit)
+
+    assert [expense_id for page in pages for expense_id in page] == expected
+    assert all(len(page) == limit for page in pages[:-1])
+    assert 0 < len(pages[-1]) <= limit
+
+@pytest.mark.parametrize("limit", [1, 3, 7])
+def test_cached_pages_match_storage(repository, uid, limit):
+    _add_history(repository, uid)
+    from_storage = _all_pages(uid, limit)
+
+    database_service.get_expenses(uid)
+    assert user_cache.has_cached_expenses(uid)
+    assert _all_pages(uid, limit) == from_storage
+
+def test_exact_last_page_has_no_cursor(repository, uid):
+    expected = _add_history(repository, uid)
+    page, cursor = database_service.get_expenses_page(uid, limit=len(expected))
+    assert len(page) == len(expected)
+    assert cursor is None
+
+def test_no_expenses(repository, uid):
+    assert database_service.get_expenses_page(uid, limit=10) == ([], None)
+
+def test_invalid_cursor_and_order(repository, uid):
+    with pytest.raises(ValueError):
+        database_service.get_expenses_page(uid, cursor="not a cursor")
+    with pytest.raises(ValueError):
+        database_service.get_expenses_page(uid, order_by="amount")
+
+def test_search_category_filter_ignores_case(repository, uid):
+    repository.add_expense(make_expense(uid, -10, "Food", "2024-01-01", description="noodles"))
+    repository.add_expense(make_expense(uid, -20, "food", "2024-01-02", description="coffee"))
+    repository.add_expense(make_expense(uid, -30, "transport", "2024-01-03", description="taxi"))
+
+    for query in ("category:food", "category:FOOD", 'category:"Food"'):
+        assert sorted(e["amount"] for e in database_service.search_transactions(uid, query)) == [-20, -10]
+    assert [e["amount"] for e in database_service.search_transactions(uid, "category:food date>=2024-01-02")] == [-20]
+    assert [e["amount"] for e in database_service.search_transactions(uid, "category:food noodles")] == [-10]
+
+@pytest.mark.parametrize("item, error", [
+    ("not an object", "Item must be an object"),
+    ({"amount": -10, "date": "2024-01-01"}, "Missing category"),
+    ({"category": ["food"], "amount": -10, "date": "2024-01-01"}, "Category must be a non-empty string"),
+    ({"category": 7, "amount": -10, "date": "2024-01-01"}, "Category must be a non-empty string"),
+    ({"category": "  ", "amount": -10, "date": "2024-01-01"}, "Category must be a non-empty string"),
+    ({"category": "food", "amount": -10, "date": "2024-01-01", "description": {"text": "x"}}, "Description must be a string"),
+    ({"category": "food", "amount": "ten", "date": "2024-01-01"}, "Amount must be a number"),
+    ({"category": "food", "amount": -10, "date": "01/02/2024"}, "Date must be YYYY-MM-DD"),
+    ({"category": "food", "amount": -10, "date": "2024-01-01", "time": "noon"}, "Time must be HH:MM or HH:MM:SS"),
+])
+def test_validate_expense_item_errors(item, error):
+    assert database_service.validate_expense_item(item) == (None, error)
+
+def test_validate_expense_item_defaults():
+    fields, error = database_service.validate_expense_item(
+        {"category": "food", "amount": "-10.5", "date": "2024-01-01", "description": None})
+    assert error is None
+    assert fields == {"category": "food", "amount": -10.5, "date": "2024-01-01", "description": "", "time": "00:00:00"}
+
+def test_add_expenses_reports_errors_per_item(repository, uid):
+    results = database_service.add_expenses(uid, [
+        {"category": "food", "amount": -10, "date": "2024-01-01", "description": "lunch"},
+        {"category": 5, "amount": -20, "date": "2024-01-02"},
+        {"category": "food", "amount": -30, "date": "2024-01-03", "description": 30}
+    ])
+
+    assert results[0]["success"] is True
+    assert results[1] == {"index": 1, "success": False, "error": "Category must be a non-empty string"}
+    assert results[2] == {"index": 2, "success": False, "error": "Description must be a string"}
+    assert [e["id"] for e in repository.get_expenses(uid)] == [results[0]["id"]]
+
+def test_writes_by_other_workers_drop_the_cache(repository, uid, monkeypatch):
+    monkeypatch.setattr(user_cache, "CACHE_CHECK_INTERVAL_MS", 0)
+    database_service.add_expense(uid, "food", -10, "2024-01-01", description="noodles", time="09:00")
+    assert [e["amount"] for e in database_service.get_expenses(uid)] == [-10]
+
+    # This worker's own writes are written through and keep the cache
+    database_service.add_expense(uid, "food", -20, "2024-01-02", description="noodles", time="09:00")
+    assert sorted(e["amount"] for e in database_service.get_expenses(uid)) == [-20, -10]
+    assert len(database_service.search_transactions(uid, "noodles")) == 2
+    assert user_cache.has_cached_expenses(uid)
+
+    # Written straight to storage, as another worker would
+    other_id = repository.add_expense(make_expense(uid, -30, date="2024-01-03", description="noodles"))
+    assert sorted(e["amount"] for e in database_service.get_expenses(uid)) == [-30, -20, -10]
+    assert len(database_service.search_transactions(uid, "noodles")) == 3
+
+    repository.delete_expense(uid, other_id)
+    assert sorted(e["amount"] for e in database_service.get_expenses(uid)) == [-20, -10]
+    assert database_service.get_analysis(uid)["total_spent"] == 30
@@ -0,0 +1,138 @@
+"""Contract tests for the SQLite ExpenseRepository"""
+import time
+import pytest
+from conftest import make_expense
+from repository import ExpenseRepository, ExpenseRow
+
+def test_base_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ExpenseRepository()
+
+def test_add_and_get_expenses(repository, uid):
+    expense_id = repository.add_expense(make_expense(uid, -60, description="lunch"))
+
+    expenses = repository.get_expenses(uid)
+    assert [e["id"] for e in expenses] == [expense_id]
+    assert expenses[0]["amount"] == -60
+    assert expenses[0]["description"] == "lunch"
+    assert expenses[0]["updated_at"] > 0
+    assert repository.get_expenses("someone-else") == []
+
+def test_add_expenses_returns_ids_in_order(repository, uid):
+    batch = [make_expense(uid, -i, date=f"2024-01-{i:02d}") for i in range(1, 6)]
+    ids = repository.add_expenses(uid, batch)
+
+    assert len(set(ids)) == 5
+    stored = repository.get_expenses_by_ids(ids)
+    assert [stored[expense_id]["amount"] for expense_id in ids] == [-1, -2, -3, -4, -5]
+
+def test_get_expenses_filters(repository, uid):
+    repository.add_expense(make_expense(uid, -10, "food", "2024-01-31", "23:59:59"))
+    repository.add_expense(make_expense(uid, -20, "transport", "2024-02-01", "00:00:00"))
+    repository.add_expense(make_expense(uid, -30, "food", "2024-02-15"))
+
+    def amounts(**filters):
+        return sorted(e["amount"] for e in repository.get_expenses(uid, **filters))
+
+    # start inclusive, end exclusive
+    assert amounts(start="2024-02-01") == [-30, -20]
+    assert amounts(end="2024-02-01") == [-10]
+    assert amounts(start="2024-02-01", end="2024-02-02") == [-20]
+    assert amounts(category="food") == [-30, -10]
+    assert amounts(start="2024-02-01", category="food") == [-30]
+
+def test_get_expense_rows(repository, uid):
+    repository.add_expense(make_expense(uid, -10, "food", "2024-01-31"))
+
+    rows = repository.get_expense_rows(uid)
+    assert rows == [ExpenseRow(-10, "food", "2024-01-31", "2024-01-31 12:00:00")]
+    assert rows[0].get("description", "none") == "none"
+
+def test_get_expenses_page_orders_by_datetime_then_id(repository, uid):
+    for day in (3, 1, 2, 2):
+        repository.add_expense(make_expense(uid, -day, date=f"2024-01-{day:02d}"))
+
+    page = repository.get_expenses_page(uid, 10)
+    keys = [(e["datetime"], e["id"]) for e in page]
+    assert keys == sorted(keys, reverse=True)
+
+    rest = repository.get_expenses_page(uid, 10, after=keys[1])
+    assert [(e["datetime"], e["id"]) for e in rest] == keys[2:]
+
+def test_delete_expense(repository, uid):
+    expense_id = repository.add_expense(make_expense(uid, -60))
+
+    assert repository.delete_expense("intruder", expense_id) == {"success": False, "error": "Unauthorized"}
+    result = repository.delete_expense(uid, expense_id)
+    assert result["success"] is True
+    assert result["expense"]["id"] == expense_id
+    assert repository.delete_expense(uid, expense_id) == {"success": False, "error": "Expense not found"}
+    assert repository.get_expenses(uid) == []
+
+def test_delete_expenses_returns_only_deleted_ids(repository, uid):
+    mine = repository.add_expense(make_expense(uid, -1))
+    theirs = repository.add_expense(make_expense("other-user", -2))
+    gone = repository.add_expense(make_expense(uid, -3))
+    repository.delete_expense(uid, gone)
+
+    deleted = repository.delete_expenses(uid, [(mine, {}), (theirs, {}), (gone, {}), ("missing", {})])
+
+    assert deleted == {mine}
+    assert [e["id"] for e in repository.get_expenses("other-user")] == [theirs]
+
+def test_get_changes_and_tombstones(repository, uid):
+    kept = repository.add_expense(make_expense(uid, -1))
+    removed = repository.add_expense(make_expense(uid, -2))
+    stamps = [e["updated_at"] for e in repository.get_expenses(uid)]
+    since = max(stamps)
+
+    assert repository.get_changes(uid, since) == ([], [])
+    assert not repository.has_changes(uid, since)
+
+    # Make sure the tombstone is stamped after since
+    time.sleep(0.002)
+    repository.delete_expense(uid, removed)
+    assert repository.get_changes(uid, since) == ([], [removed])
+    assert repository.has_changes(uid, since)
+
+    updated, deleted = repository.get_changes(uid, min(stamps) - 1)
+    assert [e["id"] for e in updated] == [kept]
+    assert deleted == [removed]
+
+def test_monthly_aggregate(repository, uid):
+    repository.add_expense(make_expense(uid, 1000, "salary", "2024-01-01"))
+    repository.add_expense(make_expense(uid, -60, "food", "2024-01-10"))
+    repository.add_expense(make_expense(uid, -40, "food", "2024-01-31"))
+    repository.add_expense(make_expense(uid, -25, "transport", "2024-02-01"))
+
+    aggregate = repository.get_monthly_aggregate(uid, "2024-01")
+    assert aggregate["income"] == 1000
+    assert aggregate["spend"] == 100
+    assert aggregate["count"] == 3
+    assert aggregate["categories"] == {"food": 100}
+
+def test_custom_categories_ignore_duplicates(repository, uid):
+    repository.add_category(uid, "Pets")
+    repository.add_category(uid, "Gifts")
+    repository.add_category(uid, "Pets")
+
+    assert repository.get_custom_categories(uid) == ["Pets", "Gifts"]
+    assert repository.get_custom_categories("other-user") == []
+
+def test_users(repository):
+    repository.save_user("b-user", "b@example.com")
+    repository.save_user("a-user", "a@example.com")
+
+    assert repository.find_user_by_email("b@example.com") == "b-user"
+    assert repository.find_user_by_email("nobody@example.com") is None
+    assert repository.user_exists("a-user")
+    assert not repository.user_exists("c-user")
+    assert list(repository.iter_user_ids()) == ["a-user", "b-user"]
+
+def test_analysis_snapshot_round_trip(repository, uid):
+    assert repository.get_analysis_snapshot(uid) is None
+
+    snapshot = {"uid": uid, "local_date": "2024-01-15", "as_of": 123,
+                "analysis": {"total_spent": 60.0}, "state": None}
+    repository.save_analysis_snapshot(uid, snapshot)
+    assert repository.get_analysis_snapshot(uid) == snapshot
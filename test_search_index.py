@@ -0,0 +1,97 @@
+"""ExpenseSearchIndex against a brute-force matches_text scan"""
+import random
+import pytest
+from search_index import ExpenseSearchIndex, matches_text, sort_by_recency
+
+WORDS = ["coffee", "coffeeshop", "cafe", "noodles", "taxi", "tax", "bus", "rent", "a", "ab", "pho", "phone"]
+CATEGORIES = ["food", "Food", "transport", "bills", "other"]
+
+def make_expense(rng, expense_id):
+    day = rng.randrange(1, 29)
+    return {
+        "id": expense_id,
+        "category": rng.choice(CATEGORIES),
+        "description": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(0, 4))),
+        "amount": rng.choice([-rng.randrange(1, 500), -rng.randrange(1, 5000) / 100, rng.randrange(100, 2000)]),
+        "date": f"2024-01-{day:02d}",
+        "datetime": f"2024-01-{day:02d} {rng.randrange(24):02d}:00:00"
+    }
+
+def make_queries(rng, expenses):
+    queries = ["", "  ", "zzz", "COFFEE", " taxi ", "a", "ab", "e", "1", "-", ".5", "ee s", "tax", "x b"]
+    for expense in rng.sample(expenses, min(len(expenses), 30)):
+        text = rng.choice([expense["category"], expense["description"], str(expense["amount"])]).lower()
+        if text:
+            start = rng.randrange(len(text))
+            queries.append(text[start:start + rng.randrange(1, 8)])
+    return queries
+
+def scan(expenses, query, prefix):
+    query = query.strip().lower()
+    return [e["id"] for e in sort_by_recency(e for e in expenses if matches_text(e, query, prefix))]
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_search_matches_scan_after_adds_and_removes(seed):
+    rng = random.Random(seed)
+    live = {}
+    index = ExpenseSearchIndex()
+    for _ in range(600):
+        if live and rng.random() < 0.3:
+            expense_id = rng.choice(sorted(live))
+            index.remove(expense_id)
+            del live[expense_id]
+        else:
+            # Some adds reuse an ID, replacing that expense
+            expense = make_expense(rng, str(rng.randrange(400)))
+            index.add(expense)
+            live[expense["id"]] = expense
+    index.remove("not-indexed")
+
+    expenses = list(live.values())
+    assert len(index) == len(expenses)
+    for query in make_queries(rng, expenses):
+        for prefix in (False, True):
+            assert [e["id"] for e in index.search(query, prefix=prefix)] == scan(expenses, query, prefix), (query, prefix)
+    assert [e["id"] for e in index.search("a", limit=5)] == scan(expenses, "a", False)[:5]
+
+def test_candidates_narrow_and_cover_matches():
+    rng = random.Random(4)
+    expenses = [make_expense(rng, str(i)) for i in range(300)]
+    index = ExpenseSearchIndex(expenses)
+
+    def covered(query, prefix=False):
+        candidates = index._candidates(query, prefix)
+        assert set(scan(expenses, query, prefix)) <= candidates
+        return candidates
+
+    # Trigram and token lookups only return expenses that can match
+    assert len(covered("coffeeshop")) < len(expenses)
+    assert len(covered("phon", prefix=True)) < len(expenses)
+    assert len(covered("ab")) < len(expenses)
+    assert covered("zzz") == set()
+    # A short query with whitespace can span two tokens, so every expense is a candidate
+    assert covered("a ") == {e["id"] for e in expenses}
+
+def test_weight_tracks_adds_and_removes():
+    rng = random.Random(5)
+    expenses = [make_expense(rng, str(i)) for i in range(100)]
+    index = ExpenseSearchIndex()
+    for expense in expenses:
+        index.add(expense)
+    for expense in expenses[:40]:
+        index.remove(expense["id"])
+    # Replacing an expense swaps its postings
+    replacement = dict(expenses[50], description="completely different words")
+    index.add(replacement)
+    remaining = expenses[40:50] + [replacement] + expenses[51:]
+
+    rebuilt = ExpenseSearchIndex(remaining)
+    assert index.postings == rebuilt.postings
+    assert index.weight() == rebuilt.weight()
+    assert index._tokens == rebuilt._tokens
+    assert index._trigrams == rebuilt._trigrams
+
+    for expense in remaining:
+        index.remove(expense["id"])
+    assert (len(index), index.postings, index.weight()) == (0, 0, 0)
+    assert index._tokens == {} and index._trigrams == {}
@@ -0,0 +1,77 @@
+"""The /search_transactions filter language"""
+import pytest
+from search_query import parse_search_query, has_filters, matches_amount, matches_category
+
+def test_empty_query():
+    plan = parse_search_query("")
+    assert plan == {"category": None, "start": None, "end": None, "amount": [], "text": []}
+    assert not has_filters(plan)
+    assert parse_search_query(None) == plan
+
+def test_free_text_and_phrases():
+    plan = parse_search_query('Lunch "Coffee Shop" with Team')
+    assert plan["text"] == ["coffee shop", "lunch with team"]
+    assert not has_filters(plan)
+
+def test_category_filter():
+    assert parse_search_query("category:food")["category"] == "food"
+    assert parse_search_query('category="eating out"')["category"] == "eating out"
+    assert parse_search_query("category:food category:food")["category"] == "food"
+    assert parse_search_query("category:Food category:FOOD")["category"] == "food"
+    with pytest.raises(ValueError):
+        parse_search_query("category:food category:transport")
+
+def test_amount_filters():
+    plan = parse_search_query("amount>=-100 amount<0")
+    assert plan["amount"] == [(">=", -100.0), ("<", 0.0)]
+    assert has_filters(plan)
+    with pytest.raises(ValueError):
+        parse_search_query("amount>lots")
+
+@pytest.mark.parametrize("query, start, end", [
+    ("date:2024-01-15", "2024-01-15", "2024-01-16"),
+    ("date=2024-01-15", "2024-01-15", "2024-01-16"),
+    ("date>2024-01-15", "2024-01-16", None),
+    ("date>=2024-01-15", "2024-01-15", None),
+    ("date<2024-01-15", None, "2024-01-15"),
+    ("date<=2024-01-15", None, "2024-01-16"),
+    ("after:2024-01-15", "2024-01-16", None),
+    ("before:2024-01-15", None, "2024-01-15"),
+    ("date:2024-12-31", "2024-12-31", "2025-01-01"),
+])
+def test_date_filters(query, start, end):
+    plan = parse_search_query(query)
+    assert (plan["start"], plan["end"]) == (start, end)
+
+def test_date_filters_intersect():
+    plan = parse_search_query("after:2024-01-01 date>=2024-01-10 before:2024-02-01 date<2024-03-01")
+    assert (plan["start"], plan["end"]) == ("2024-01-10", "2024-02-01")
+
+def test_invalid_date():
+    with pytest.raises(ValueError):
+        parse_search_query("date:2024-13-01")
+    with pytest.raises(ValueError):
+        parse_search_query("before:yesterday")
+
+def test_unknown_filters_are_text():
+    plan = parse_search_query("lunch at 12:30 colour:red")
+    assert plan["text"] == ["lunch at 12:30 colour:red"]
+    assert not has_filters(plan)
+
+def test_matches_amount():
+    filters = parse_search_query("amount>=-100 amount<0")["amount"]
+    assert matches_amount({"amount": -60}, filters)
+    assert matches_amount({"amount": "-100"}, filters)
+    assert not matches_amount({"amount": -150}, filters)
+    assert not matches_amount({"amount": 20}, filters)
+    assert not matches_amount({"amount": None}, filters)
+    assert matches_amount({"amount": None}, [])
+
+def test_matches_category_ignores_case():
+    category = parse_search_query("category:Food")["category"]
+    assert matches_category({"category": "food"}, category)
+    assert matches_category({"category": "FOOD"}, category)
+    assert not matches_category({"category": "seafood"}, category)
+    assert not matches_category({"category": None}, category)
+    assert not matches_category({}, category)
+    assert matches_category({}, None)
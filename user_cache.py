@@ -0,0 +1,356 @@
+import base64
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from cache_service import LRUCache
+from analysis_service import get_local_time
+from repository import now_ms
+
+# Per-user caches shared by database_service and async_database_service, which only do
+# the storage I/O: a read asks here for a hit, reads storage on a miss and hands the
+# result back to be stored (with the data version taken before the read); a write
+# reports what it stored or deleted so the caches are written through. Hits are first
+# checked against storage (start_check/finish_check) for other workers' writes.
+
+# Per-user expense lists: uid -> list of expense dicts (shared, treat as read-only).
+# add_expense/delete_expense write through to the cached list. Entry weight is an
+# estimate in bytes.
+EXPENSE_CACHE_TTL = int(os.getenv("EXPENSE_CACHE_TTL", "300"))
+EXPENSE_CACHE_MAX_BYTES = int(os.getenv("EXPENSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+_expense_cache = LRUCache(max_entries=10000, default_ttl=EXPENSE_CACHE_TTL, max_weight=EXPENSE_CACHE_MAX_BYTES)
+
+# Per-user search indexes, kept in step with the expense cache
+SEARCH_INDEX_MAX_BYTES = int(os.getenv("SEARCH_INDEX_MAX_BYTES", str(64 * 1024 * 1024)))
+_search_indexes = LRUCache(max_entries=10000, default_ttl=EXPENSE_CACHE_TTL, max_weight=SEARCH_INDEX_MAX_BYTES)
+
+# Per-user custom category lists; add_category drops a user's entry
+CATEGORY_CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", "300"))
+_category_cache = LRUCache(max_entries=10000, default_ttl=CATEGORY_CACHE_TTL)
+
+# Per-user analyze_expenses results: uid -> ((data version, local date), analysis).
+# An entry is used only while the user has had no writes and the local date (which
+# days_passed/days_remaining and the current month depend on) is unchanged.
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", str(EXPENSE_CACHE_TTL)))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "10000"))
+_analysis_cache = LRUCache(max_entries=ANALYSIS_CACHE_MAX_ENTRIES, default_ttl=ANALYSIS_CACHE_TTL)
+
+# Per-user AnalysisState running totals, which writes update in place so a changed
+# analysis is derived from them instead of from a re-read of the history. They do not
+# expire: this process's writes keep them current and start_check drops them after
+# another worker's. Rebuilt from storage on a miss, and by get_analysis(uid, full=True).
+_analysis_states = LRUCache(max_entries=ANALYSIS_CACHE_MAX_ENTRIES)
+
+# Per-user data versions, so a cache fill that raced with a write is not stored. A
+# write sets the user's version to the next value of a process-wide counter. Only the
+# most recently written DATA_VERSION_MAX_ENTRIES users are kept; the others read as the
+# highest version evicted so far, which never equals a version taken before a later write.
+DATA_VERSION_MAX_ENTRIES = int(os.getenv("DATA_VERSION_MAX_ENTRIES", "100000"))
+_data_versions = OrderedDict()
+_version_counter = 0
+_version_floor = 0
+_versions_lock = threading.Lock()
+
+# Striped per-user locks: a write-through (read the cached entry, build the new one,
+# store it) and a cache fill's version check and store happen under the user's lock
+_user_locks = [threading.Lock() for _ in range(64)]
+
+# Writes by other workers: before a user's cached data is served, the IDs changed in
+# storage since their last check are read (at most once per CACHE_CHECK_INTERVAL_MS),
+# and any change this process did not write itself drops everything cached for them.
+# _checked_at holds the epoch ms each user was last checked at; _own_writes the IDs this
+# process added or deleted, with when, until a check can no longer see them.
+CACHE_CHECK_INTERVAL_MS = int(os.getenv("CACHE_CHECK_INTERVAL_MS", "1000"))
+_checked_at = LRUCache(max_entries=DATA_VERSION_MAX_ENTRIES)
+_own_writes = LRUCache(max_entries=DATA_VERSION_MAX_ENTRIES)
+
+def get_data_version(uid):
+    """Get a value that changes whenever this process writes a user's data"""
+    return _data_versions.get(uid, _version_floor)
+
+def _bump_data_version(uid):
+    global _version_counter, _version_floor
+    with _versions_lock:
+        _version_counter += 1
+        _data_versions[uid] = _version_counter
+        _data_versions.move_to_end(uid)
+        while len(_data_versions) > DATA_VERSION_MAX_ENTRIES:
+            _, evicted = _data_versions.popitem(last=False)
+            _version_floor = max(_version_floor, evicted)
+
+def _user_lock(uid):
+    return _user_locks[hash(uid) % len(_user_locks)]
+
+def _drop_user(uid):
+    """
+    Drop everything cached for a user, and keep fills already reading storage from
+    being stored. Call with the user's lock held.
+    """
+    _bump_data_version(uid)
+    for cache in (_expense_cache, _search_indexes, _analysis_cache, _analysis_states):
+        cache.pop(uid)
+
+def _note_own_writes(uid, expense_ids):
+    """Remember IDs this process wrote, so a check does not take them for another worker's. Call with the user's lock held."""
+    own = _own_writes.peek(uid)
+    if own is None:
+        own = {}
+        _own_writes.set(uid, own)
+    written_at = now_ms()
+    for expense_id in expense_ids:
+        own[expense_id] = written_at
+
+def start_check(uid):
+    """
+    Begin checking a user's cached data against storage: returns (started, checked_at),
+    and the IDs changed since checked_at (less the sync overlap) go to finish_check.
+    Returns None when the user was checked within CACHE_CHECK_INTERVAL_MS, or was not
+    checked yet, which drops anything still cached for them and checks from now on.
+    """
+    started = now_ms()
+    checked_at = _checked_at.get(uid)
+    if checked_at is None:
+        with _user_lock(uid):
+            _drop_user(uid)
+            _checked_at.set(uid, started)
+        return None
+    if started - checked_at < CACHE_CHECK_INTERVAL_MS:
+        return None
+    return started, checked_at
+
+def finish_check(uid, started, since, changed_ids):
+    """
+    Finish a check that read the IDs changed in storage after since: any this process
+    did not write drop the user's cached data
+    """
+    with _user_lock(uid):
+        own = _own_writes.peek(uid) or {}
+        if any(expense_id not in own for expense_id in changed_ids):
+            _drop_user(uid)
+        # Later checks read from after since, so writes noted before it cannot show up again
+        for expense_id in [i for i, written_at in own.items() if written_at < since]:
+            del own[expense_id]
+        if started > _checked_at.peek(uid, 0):
+            _checked_at.set(uid, started)
+
+def _estimate_size(expense):
+    """Rough in-memory size of an expense dict in bytes"""
+    return sys.getsizeof(expense) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in expense.items())
+
+# Expense lists
+
+def date_bound(value):
+    """Normalize a date bound (date, datetime or "YYYY-MM-DD...") to a "YYYY-MM-DD" string, keeping None"""
+    if value is None:
+        return None
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d")
+    return str(value)[:10]
+
+def cached_expenses(uid, start=None, end=None, category=None):
+    """
+    A user's cached expenses filtered as in get_expenses (start/end already normalized
+    with date_bound), or None if their list is not cached
+    """
+    cached = _expense_cache.get(uid)
+    if cached is None:
+        return None
+    return _filter_cached(cached, start, end, category)
+
+def has_cached_expenses(uid):
+    """Whether a user's list is cached (without counting a hit or miss)"""
+    return _expense_cache.peek(uid) is not None
+
+def store_expenses(uid, expenses, version):
+    """Cache a user's complete expense list read at a data version, unless a write has landed since"""
+    weight = sum(_estimate_size(e) for e in expenses)
+    with _user_lock(uid):
+        if get_data_version(uid) == version:
+            _expense_cache.set(uid, expenses, weight=weight)
+
+def _filter_cached(cached, start=None, end=None, category=None):
+    """Apply get_expenses filters to a cached list (start/end already normalized)"""
+    if category is not None:
+        cached = [e for e in cached if e.get("category") == category]
+    if start is None and end is None:
+        return list(cached)
+    # String comparison matches Firestore's ordering of the datetime field
+    return [e for e in cached
+            if isinstance(e.get("datetime"), str)
+            and (start is None or e["datetime"] >= start)
+            and (end is None or e["datetime"] < end)]
+
+def expense_cache_stats():
+    """Get hit/miss/eviction counters for the expense cache"""
+    return _expense_cache.stats()
+
+# Pages, ordered by (datetime, ID) descending in storage and in the cache alike
+
+def _encode_cursor(expense):
+    """Build an opaque page cursor from the last expense on a page"""
+    data = json.dumps({"d": expense.get("datetime"), "id": expense["id"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Decode a page cursor into the (datetime, ID) to start after. Raises ValueError if it is malformed."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return data["d"], data["id"]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+def cached_page(uid, limit, after=None):
+    """Cut a page from a user's cached list: (page, next_cursor), or None if it is not cached"""
+    cached = _expense_cache.get(uid)
+    if cached is None:
+        return None
+    ordered = sorted((e for e in cached if e.get("datetime") is not None),
+                     key=lambda e: (e["datetime"], e["id"]), reverse=True)
+    if after:
+        ordered = [e for e in ordered if (e["datetime"], e["id"]) < after]
+    return finish_page(ordered, limit)
+
+def finish_page(ordered, limit):
+    """Cut a page from expenses in page order (read with one extra to spot a next page). Returns (page, next_cursor)."""
+    page = ordered[:limit]
+    next_cursor = _encode_cursor(page[-1]) if len(ordered) > limit and page else None
+    return page, next_cursor
+
+# Writes
+
+def record_add(uid, expense):
+    """Write a stored expense (with its ID) through to the cached list, search index and running totals"""
+    with _user_lock(uid):
+        _bump_data_version(uid)
+        _note_own_writes(uid, [expense["id"]])
+        cached = _expense_cache.peek(uid)
+        # Copy-on-write, readers may hold the old list. A fill that read storage after
+        # the write committed already has the expense.
+        if cached is not None and not any(e.get("id") == expense["id"] for e in cached):
+            _expense_cache.replace(uid, cached + [expense], weight_delta=_estimate_size(expense))
+        _update_search_index(uid, added=expense)
+        _update_analysis_state(uid, added=[expense])
+
+def record_delete(uid, expense_id, expense=None):
+    """Remove a deleted expense from the cached list, search index and running totals"""
+    with _user_lock(uid):
+        _bump_data_version(uid)
+        _note_own_writes(uid, [expense_id])
+        cached = _expense_cache.peek(uid)
+        if cached is not None:
+            remaining = [e for e in cached if e.get("id") != expense_id]
+            removed_weight = sum(_estimate_size(e) for e in cached if e.get("id") == expense_id)
+            _expense_cache.replace(uid, remaining, weight_delta=-removed_weight)
+        _update_search_index(uid, removed_id=expense_id)
+        if expense is not None:
+            _update_analysis_state(uid, removed=[expense])
+        else:
+            # Without the deleted fields the totals cannot be reverted
+            _analysis_states.pop(uid)
+
+def invalidate(uid, added=(), removed=()):
+    """
+    Drop a user's cached expenses and search index after a bulk write, applying the
+    expenses it added and removed (with their IDs) to their running totals
+    """
+    with _user_lock(uid):
+        _bump_data_version(uid)
+        _note_own_writes(uid, [e["id"] for e in list(added) + list(removed)])
+        _expense_cache.pop(uid)
+        _search_indexes.pop(uid)
+        _update_analysis_state(uid, added, removed)
+
+def _update_analysis_state(uid, added=(), removed=()):
+    """
+    Apply added and revert removed expenses on a user's running totals, if they are
+    loaded, as one change. Call with the user's lock held.
+    """
+    state = _analysis_states.peek(uid)
+    if state is not None:
+        state.update(added, removed)
+
+def _update_search_index(uid, added=None, removed_id=None):
+    """Apply one add or delete to a user's search index, if it is loaded. Call with the user's lock held."""
+    index = _search_indexes.peek(uid)
+    if index is None:
+        return
+    if added is not None:
+        index.add(added)
+    if removed_id is not None:
+        index.remove(removed_id)
+    # Refresh the entry's weight, keeping its expiry
+    _search_indexes.replace(uid, index, weight=index.weight())
+
+# Search indexes
+
+def cached_search_index(uid):
+    return _search_indexes.get(uid)
+
+def store_search_index(uid, index, version):
+    """Cache a search index built at a data version, unless a write has landed since"""
+    with _user_lock(uid):
+        if get_data_version(uid) == version:
+            _search_indexes.set(uid, index, weight=index.weight())
+
+# Custom categories
+
+def cached_categories(uid):
+    """A user's cached custom categories (a tuple), or None"""
+    return _category_cache.get(uid)
+
+def store_categories(uid, custom):
+    _category_cache.set(uid, tuple(custom))
+
+def drop_categories(uid):
+    _category_cache.pop(uid)
+
+# Analysis results and running totals
+
+def analysis_key(uid):
+    """What a cached analysis depends on: (data version, local date)"""
+    return (get_data_version(uid), get_local_time().strftime("%Y-%m-%d"))
+
+def cached_analysis(uid, key):
+    cached = _analysis_cache.get(uid)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    return None
+
+def store_analysis(uid, key, analysis):
+    # Not stored if a write landed while it was being computed
+    with _user_lock(uid):
+        if get_data_version(uid) == key[0]:
+            _analysis_cache.set(uid, (key, analysis))
+
+def analysis_cache_stats():
+    """Get hit/miss/eviction counters for the analysis cache"""
+    return _analysis_cache.stats()
+
+def cached_state(uid):
+    """A user's AnalysisState, or None if it is not loaded"""
+    return _analysis_states.get(uid)
+
+def has_state(uid):
+    """Whether a user's AnalysisState is loaded (without counting a hit or miss)"""
+    return _analysis_states.peek(uid) is not None
+
+def store_state(uid, version, state):
+    # Not stored if a write landed while it was being built
+    with _user_lock(uid):
+        if get_data_version(uid) == version:
+            _analysis_states.set(uid, state)
+
+def snapshot_for_today(snapshot, key):
+    """Whether a batch snapshot (or None) was computed for the local date in an analysis key"""
+    return snapshot is not None and snapshot["local_date"] == key[1]
+
+def use_snapshot(uid, key, snapshot):
+    """Load a current batch snapshot's running totals and return its analysis"""
+    from analysis_state import AnalysisState
+    if snapshot.get("state"):
+        try:
+            store_state(uid, key[0], AnalysisState.from_dict(snapshot["state"]))
+        except ValueError as e:
+            print(f"Ignoring analysis state in snapshot for {uid}: {e}")
+    return snapshot["analysis"]